@@ -120,6 +120,10 @@ if __name__ == "__main__":
     params_dict["save_tensorboard"] = [False]
     params_dict["save_model"] = [False]
 
+    # checkpoint the training state every hour, so that a job killed by the time limit can be resubmitted
+    # with --resume_from=its RLT_DIR
+    params_dict["checkpoint_interval"] = [60]
+
     # --------------------- parameters part ends --------------------- #
     param_keys = list(params_dict.keys())
     param_values = list(params_dict.values())
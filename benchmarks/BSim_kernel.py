@@ -0,0 +1,67 @@
+"""
+Wall time of one backward-simulation weighting step (forward + gradient) as n_particles grows,
+comparing the exhaustive kernel, which sums over all forward particles, with the sampled kernel,
+which draws n_ancestors forward particles from the filtering weights for each backward particle.
+"""
+
+import os
+import sys
+import time
+
+import tensorflow as tf
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from transformation.MLP import MLP_transformation
+from distribution.mvn import tf_mvn
+from SMC.backward_kernel import log_predictive, sampled_log_predictive
+
+
+n_particles_list = [16, 32, 64, 128, 256, 512, 1024]
+M = 4
+n_ancestors = 4
+chunk_size = 0
+batch_size = 1
+Dx = 2
+Dhs = [32]
+n_repeats = 10
+
+
+def build(n_particles, kernel):
+    tf.reset_default_graph()
+
+    f = tf_mvn(MLP_transformation(Dhs, Dx, name="f_tran"), name="f_dist")
+
+    bw_X_t = tf.Variable(tf.random_normal((M, n_particles, batch_size, Dx)), name="bw_X_t")
+    X_tm1 = tf.Variable(tf.random_normal((n_particles, batch_size, Dx)), name="X_tm1")
+    log_W_tm1 = tf.nn.log_softmax(tf.Variable(tf.random_normal((n_particles, batch_size)), name="log_W_tm1"), axis=0)
+
+    if kernel == "exhaustive":
+        log_W_t = log_predictive(f, bw_X_t, X_tm1, log_W_tm1, chunk_size)
+    else:
+        log_W_t = sampled_log_predictive(f, bw_X_t, X_tm1, log_W_tm1, n_ancestors)
+
+    loss = tf.reduce_sum(log_W_t)
+    grads = tf.gradients(loss, tf.trainable_variables())
+
+    return loss, grads
+
+
+def time_kernel(n_particles, kernel):
+    loss, grads = build(n_particles, kernel)
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        sess.run([loss, grads])  # warm up
+
+        start = time.time()
+        for _ in range(n_repeats):
+            sess.run([loss, grads])
+        return (time.time() - start) / n_repeats
+
+
+if __name__ == "__main__":
+    print("{:>12}{:>16}{:>16}".format("n_particles", "exhaustive (ms)", "sampled (ms)"))
+    for n_particles in n_particles_list:
+        exhaustive_time = time_kernel(n_particles, "exhaustive")
+        sampled_time = time_kernel(n_particles, "sampled")
+        print("{:>12}{:>16.3f}{:>16.3f}".format(n_particles, exhaustive_time * 1000, sampled_time * 1000))
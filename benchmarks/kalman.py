@@ -0,0 +1,123 @@
+"""
+Exact linear-Gaussian references from src/utils/kalman.py.
+
+baseline: fits a linear-Gaussian SSM with EM to all training trials of a data set at once, and reports the time per
+EM iteration and the log-likelihood per time step on the training and test sets, as a baseline for the nonlinear
+models.
+
+log_ZSMC bias: on data simulated from a known linear-Gaussian SSM, the SMC objectives are run with the true model as
+f and g and the transition as proposal (a bootstrap particle filter), and log_ZSMC is compared with the exact
+log-likelihood for increasing n_particles. log_ZSMC is a lower bound in expectation, so the gap should shrink
+towards 0 as n_particles grows.
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from runner_flag import FLAGS
+from model import SSM
+from SMC.AESMC import AESMC
+from SMC.IWAE import IWAE
+from distribution.mvn import tf_mvn
+from transformation.linear import tf_linear_transformation
+from utils.data_loader import load_data
+from utils.kalman import linear_gaussian_ssm
+
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# (path of datadict, Dx)
+datasets = [("data/fhn/[1,0]_obs_cov_0.01/datadict", 2),
+            ("data/lorenz/[1,0,0]_obs_cov_0.4/datadict", 3)]
+n_EM_iter = 20
+
+# true model of the bias experiment, Q and R have to be diagonal to be expressed by tf_mvn
+A = np.array([[0.95, 0.1], [-0.1, 0.95]])
+C = np.array([[1.0, 0.5]])
+Q = 0.1 * np.eye(2)
+R = 0.5 * np.eye(1)
+
+n_particles_list = [4, 16, 64, 256]
+n_trials = 16
+time_steps = 50
+n_repeats = 20
+
+
+def baseline(datadict_path, Dx):
+    obs_train, obs_test = load_data(os.path.join(repo_dir, datadict_path), Dx, False, False)[2:]
+
+    np.random.seed(0)
+    model = linear_gaussian_ssm.from_obs(obs_train, Dx)
+    start = time.time()
+    model.em(obs_train, n_iter=n_EM_iter)
+    EM_iter_time = (time.time() - start) / n_EM_iter
+
+    n_steps_train = np.sum(~np.isnan(obs_train).any(axis=-1))
+    n_steps_test = np.sum(~np.isnan(obs_test).any(axis=-1))
+    return EM_iter_time, \
+        np.sum(model.log_likelihood(obs_train)) / n_steps_train, \
+        np.sum(model.log_likelihood(obs_test)) / n_steps_test
+
+
+def inverse_softplus(x):
+    return np.log(np.expm1(x))
+
+
+def build_bootstrap_log_ZSMC(objective, n_particles):
+    tf.reset_default_graph()
+    FLAGS(["kalman.py",
+           "--PSVO=False", "--AESMC={}".format(objective == "AESMC"), "--IWAE={}".format(objective == "IWAE"),
+           "--Dx={}".format(A.shape[0]), "--Dy={}".format(C.shape[0]),
+           "--time={}".format(time_steps), "--batch_size={}".format(n_trials),
+           "--n_particles={}".format(n_particles),
+           "--use_bootstrap=True", "--use_2_q=False"])
+
+    SSM_model = SSM(FLAGS)
+
+    # x_0 ~ N(0, Q): the input of f at t = 0, otherwise a learned embedding of y_0, is 0
+    SSM_model.X0_transformer = lambda Input: tf.zeros((n_trials, A.shape[0]))
+    SSM_model.f_dist = tf_mvn(tf_linear_transformation(tf.constant(A, dtype=tf.float32)),
+                              sigma_init=inverse_softplus(np.sqrt(np.diag(Q))), sigma_min=0.0, name="f_dist")
+    SSM_model.g_dist = tf_mvn(tf_linear_transformation(tf.constant(C, dtype=tf.float32)),
+                              sigma_init=inverse_softplus(np.sqrt(np.diag(R))), sigma_min=0.0, name="g_dist")
+    SSM_model.q0_dist = SSM_model.q1_dist = SSM_model.f_dist
+
+    SMC = AESMC(SSM_model, FLAGS) if objective == "AESMC" else IWAE(SSM_model, FLAGS)
+    log_ZSMC, _ = SMC.get_log_ZSMC(SSM_model.obs, SSM_model.hidden)
+    return SSM_model, log_ZSMC
+
+
+def log_ZSMC_bias(objective, n_particles, obs, exact_log_likelihood):
+    SSM_model, log_ZSMC = build_bootstrap_log_ZSMC(objective, n_particles)
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        log_ZSMCs = [sess.run(log_ZSMC, feed_dict={SSM_model.obs: obs}) for _ in range(n_repeats)]
+
+    # log_ZSMC is averaged over trials
+    gaps = np.array(log_ZSMCs) - np.mean(exact_log_likelihood)
+    return np.mean(gaps), np.std(gaps)
+
+
+if __name__ == "__main__":
+    print("{:<48}{:>16}{:>16}{:>16}".format("data set", "EM iter (s)", "train ll/step", "test ll/step"))
+    for datadict_path, Dx in datasets:
+        print("{:<48}{:>16.3f}{:>16.3f}{:>16.3f}".format(datadict_path, *baseline(datadict_path, Dx)))
+    print()
+
+    np.random.seed(0)
+    true_model = linear_gaussian_ssm(A, C, Q, R, Sigma0=Q)
+    _, obs = true_model.sample(n_trials, time_steps)
+    exact_log_likelihood = true_model.log_likelihood(obs)
+    print("exact log-likelihood per trial: {:.3f}".format(np.mean(exact_log_likelihood)))
+
+    print("{:>12}{:>12}{:>24}{:>24}".format("objective", "n_particles", "log_ZSMC - exact (mean)",
+                                            "log_ZSMC - exact (std)"))
+    for objective in ["AESMC", "IWAE"]:
+        for n_particles in n_particles_list:
+            print("{:>12}{:>12}{:>24.3f}{:>24.3f}"
+                  .format(objective, n_particles, *log_ZSMC_bias(objective, n_particles, obs, exact_log_likelihood)))
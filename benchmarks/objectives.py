@@ -0,0 +1,117 @@
+"""
+Training and evaluation speed, peak memory and graph-build time of each objective over a grid of
+n_particles, n_particles_for_BSim_proposal, time, batch_size and Dx, on simulated FHN (Dx = 2) or Lorenz (Dx = 3)
+data. Each config trains in its own process through src/runner_flag.py, so that peak RSS is per config,
+and the results are saved to objectives.csv and objectives.json in the current dir, to be compared across commits.
+
+steps/s is averaged over the epochs that don't evaluate (all but the first and the last one),
+and eval (s) is one evaluation on the training and test sets.
+"""
+
+import csv
+import glob
+import itertools
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+runner_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "runner_flag.py")
+
+runner_flags = ["--generateTrainingData=True",
+                "--n_test=8",
+                "--epoch=4",
+                "--print_freq=4",
+                "--MSE_steps=5",
+                "--saving_num=1",
+                "--profile_graph_build=True",
+                "--save_trajectory=False",
+                "--save_y_hat=False"]
+
+# flags that select each objective, the others are set to False
+objectives = ["SVO", "PSVO", "PSVOwR", "AESMC", "IWAE"]
+
+# n_particles_for_BSim_proposal only matters for PSVO and PSVOwR, so other objectives run once with its first value
+grid = {"n_particles":                   [16, 64],
+        "n_particles_for_BSim_proposal": [4, 16],
+        "time":                          [50, 200],
+        "batch_size":                    [1, 8],
+        "Dx":                            [2, 3]}
+
+# number of training steps per epoch, n_train = n_steps_per_epoch * batch_size
+n_steps_per_epoch = 10
+
+
+def get_configs():
+    configs = []
+    for objective in objectives:
+        for values in itertools.product(*grid.values()):
+            config = dict(zip(grid.keys(), values))
+            if objective not in ["PSVO", "PSVOwR"] and \
+                    config["n_particles_for_BSim_proposal"] != grid["n_particles_for_BSim_proposal"][0]:
+                continue
+            config["objective"] = objective
+            configs.append(config)
+    return configs
+
+
+def get_config_flags(config):
+    config_flags = ["--{}={}".format(objective, objective == config["objective"]) for objective in objectives]
+    config_flags += ["--{}={}".format(key, config[key]) for key in grid]
+    config_flags += ["--n_train={}".format(n_steps_per_epoch * config["batch_size"])]
+    return config_flags
+
+
+def run(config_flags):
+    # run in a temporary dir so that results of the runs don't end up in the repo
+    rslt_dir = tempfile.mkdtemp()
+    process = subprocess.Popen([sys.executable, runner_path] + runner_flags + config_flags + sys.argv[1:],
+                               cwd=rslt_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               universal_newlines=True)
+    output = process.stdout.read()
+
+    # wait for this process only, so that ru_maxrss isn't the max over all previous configs
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = status
+
+    epoch_times = [float(x) for x in re.findall(r"epoch \d+\s+took ([\d.]+) seconds", output)]
+    eval_times = [float(x) for x in re.findall(r"evaluation took ([\d.]+) seconds", output)]
+    profile_paths = glob.glob(os.path.join(rslt_dir, "rslts", "*", "*", "graph_build_profile.json"))
+    if len(epoch_times) < 3 or not eval_times or not profile_paths:
+        raise RuntimeError("run failed with {}:\n{}".format(config_flags, output))
+
+    with open(profile_paths[0], "r") as f:
+        graph_build_profile = json.load(f)
+
+    return {"steps_per_second":    n_steps_per_epoch / np.mean(epoch_times[1:-1]),
+            "eval_seconds":        np.mean(eval_times),
+            "peak_rss_MB":         rusage.ru_maxrss / 1024,  # ru_maxrss is in KB on linux
+            "graph_build_seconds": graph_build_profile["total_seconds"],
+            "n_ops":               graph_build_profile["total_n_ops"]}
+
+
+if __name__ == "__main__":
+    # extra flags are passed to all runs, e.g. python objectives.py --use_input_pipeline=False
+    header = ["objective"] + list(grid.keys()) + \
+             ["steps_per_second", "eval_seconds", "peak_rss_MB", "graph_build_seconds", "n_ops"]
+    print(("{:>8}" + "{:>12}" * (len(header) - 1)).format("objective", "np", "np_BSim", "time", "bs", "Dx",
+                                                         "steps/s", "eval (s)", "RSS (MB)", "build (s)", "n_ops"))
+
+    results = []
+    for config in get_configs():
+        result = dict(config)
+        result.update(run(get_config_flags(config)))
+        results.append(result)
+        print(("{:>8}" + "{:>12}" * 5 + "{:>12.2f}" * 4 + "{:>12}").format(*[result[key] for key in header]))
+
+    with open("objectives.csv", "w") as f:
+        writer = csv.DictWriter(f, fieldnames=header)
+        writer.writeheader()
+        writer.writerows(results)
+
+    with open("objectives.json", "w") as f:
+        json.dump(results, f, indent=4)
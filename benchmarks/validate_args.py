@@ -0,0 +1,51 @@
+"""
+Per-epoch training time with distributions built with (debug) and without (fast) argument validation.
+Each mode trains in its own process through src/runner_flag.py on simulated FHN data, and the epoch times
+it prints are collected. The first and last epochs are dropped, as they include warm-up and evaluation.
+"""
+
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+runner_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "runner_flag.py")
+
+runner_flags = ["--generateTrainingData=True",
+                "--time=100",
+                "--n_train=20",
+                "--n_test=4",
+                "--epoch=7",
+                "--print_freq=7",
+                "--MSE_steps=5",
+                "--saving_num=2",
+                "--save_trajectory=False",
+                "--save_y_hat=False"]
+
+modes = {"debug": ["--validate_args=True"],
+         "fast":  ["--validate_args=False"]}
+
+
+def time_epochs(mode_flags):
+    # run in a temporary dir so that results of the runs don't end up in the repo
+    rslt_dir = tempfile.mkdtemp()
+    output = subprocess.run([sys.executable, runner_path] + runner_flags + mode_flags + sys.argv[1:],
+                            cwd=rslt_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True).stdout
+
+    epoch_times = [float(x) for x in re.findall(r"epoch \d+\s+took ([\d.]+) seconds", output)]
+    if not epoch_times:
+        raise RuntimeError("no epoch finished with {}:\n{}".format(mode_flags, output))
+
+    return epoch_times
+
+
+if __name__ == "__main__":
+    # extra flags are passed to both runs, e.g. python validate_args.py --PSVO=False --AESMC=True
+    print("{:>8}{:>20}{:>20}".format("mode", "mean epoch (s)", "std epoch (s)"))
+    for mode, mode_flags in modes.items():
+        epoch_times = time_epochs(mode_flags)[1:-1]
+        print("{:>8}{:>20.3f}{:>20.3f}".format(mode, np.mean(epoch_times), np.std(epoch_times)))
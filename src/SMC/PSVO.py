@@ -3,6 +3,8 @@ import tensorflow as tf
 from tensorflow_probability import distributions as tfd
 
 from SMC.SVO import SVO
+from SMC.backward_kernel import backward_kernel
+from distribution.mvn import dist_cache_scope
 
 
 class PSVO(SVO):
@@ -10,6 +12,7 @@ class PSVO(SVO):
         SVO.__init__(self, model, FLAGS, name="log_ZSMC")
 
         self.n_particles_for_BSim_proposal = FLAGS.n_particles_for_BSim_proposal
+        self.BSim_kernel = backward_kernel(self.f, FLAGS)
 
         self.smooth_obs = False
         self.BSim_use_single_RNN = FLAGS.BSim_use_single_RNN
@@ -18,18 +21,22 @@ class PSVO(SVO):
         self.BSim_q_init = model.Bsim_q_init_dist
         self.BSim_q2 = model.BSim_q2_dist
 
-    def get_log_ZSMC(self, obs, hidden):
+    def get_log_ZSMC(self, obs, hidden, mask=None):
         """
         Get log_ZSMC from obs y_1:T
         Input:
             obs.shape = (batch_size, time, Dy)
             hidden.shape = (batch_size, time, Dz)
+            mask.shape = (batch_size, time), 1.0 for valid steps and 0.0 for padding after the end of a sequence,
+                None if all sequences have length time
         Output:
             log_ZSMC: shape = scalar
             log: stuff to debug
         """
         batch_size, time, _ = obs.get_shape().as_list()
         self.Dx, self.batch_size, self.time = self.model.Dx, batch_size, time
+        self.set_mask(mask)
+        obs, hidden = self.fill_padding(obs, hidden)
 
         with tf.variable_scope(self.name):
 
@@ -46,6 +53,9 @@ class PSVO(SVO):
             Xs = tf.transpose(Xs, perm=[2, 0, 1, 3], name="Xs")
 
             log["Xs"] = Xs
+            log["ESS"] = tf.transpose(self.ESSs, name="ESS")
+            log["n_unique_ancestors"] = tf.transpose(self.count_unique_ancestors(self.ancestor_idxs),
+                                                     name="n_unique_ancestors")
 
         return log_ZSMC, log
 
@@ -86,12 +96,10 @@ class PSVO(SVO):
         bw_X_Tm1, bw_q_log_prob = \
             self.BSim_q_init.sample_and_log_prob(preprocessed_obs[-1], sample_shape=(M, n_particles))
 
-        bw_X_Tm1_tiled = tf.tile(tf.expand_dims(bw_X_Tm1, axis=2), (1, 1, n_particles, 1, 1))
-        f_Tm2_log_prob = self.f.log_prob(Xs[time - 2], bw_X_Tm1_tiled)  # (M, n_particles, n_particles, batch_size)
         g_Tm1_log_prob = self.g.log_prob(bw_X_Tm1, obs[:, time - 1])    # (M, n_particles, batch_size)
 
         log_W_Tm2 = log_Ws[time - 2] - tf.reduce_logsumexp(log_Ws[time - 2], axis=0)  # (n_particles, batch_size)
-        log_W_Tm1 = tf.reduce_logsumexp(f_Tm2_log_prob + log_W_Tm2, axis=2)
+        log_W_Tm1 = self.BSim_kernel.log_predictive(bw_X_Tm1, Xs[time - 2], log_W_Tm2)
 
         bw_log_omega_Tm1 = log_W_Tm1 + g_Tm1_log_prob - bw_q_log_prob  # (n_particles, batch_size)
         bw_log_omega_Tm1 = bw_log_omega_Tm1 - tf.reduce_logsumexp(bw_log_omega_Tm1, axis=0, keepdims=True)
@@ -103,6 +111,10 @@ class PSVO(SVO):
 
         bw_log_Omega_Tm1 = bw_log_omega_Tm1 + bw_q_log_prob + tf.log(float(M))
 
+        # padded steps contribute neither to the target nor to the proposal
+        g_Tm1_log_prob = self.mask_log_prob(g_Tm1_log_prob, time - 1)
+        bw_log_Omega_Tm1 = self.mask_log_prob(bw_log_Omega_Tm1, time - 1)
+
         bw_Xs_ta = bw_Xs_ta.write(time - 1, bw_X_Tm1)
         g_log_probs_ta = g_log_probs_ta.write(time - 1, g_Tm1_log_prob)
         bw_log_Omegas_ta = bw_log_Omegas_ta.write(time - 1, bw_log_Omega_Tm1)
@@ -121,16 +133,15 @@ class PSVO(SVO):
                                                                bw_X_tp1, preprocessed_obs_ta.read(t),
                                                                sample_size=M)
 
-            # f(x_t+1 | x_t) (M, n_particles, batch_size)
-            f_t_log_prob = self.f.log_prob(bw_X_t, bw_X_tp1)
+            # f(x_t+1 | x_t) (M, n_particles, batch_size), no transition out of the last step of a sequence
+            f_t_log_prob = self.f.log_prob(bw_X_t, bw_X_tp1, name="f_t_log_prob")
+            f_t_log_prob = self.mask_log_prob(f_t_log_prob, t + 1)
 
             # p(x_t | y_{1:t}) is proprotional to \int p(x_t-1 | y_{1:t-1}) * f(x_t | x_t-1) dx_t-1 * g(y_t | x_t)
-            bw_X_t_tiled = tf.tile(tf.expand_dims(bw_X_t, axis=2), (1, 1, n_particles, 1, 1))
-            f_tm1_log_prob = self.f.log_prob(Xs[t - 1], bw_X_t_tiled)   # (M, n_particles, n_particles, batch_size)
-            g_t_log_prob = self.g.log_prob(bw_X_t, obs[:, t])           # (M, n_particles, batch_size)
+            g_t_log_prob = self.g.log_prob(bw_X_t, obs[:, t], name="g_t_log_prob")  # (M, n_particles, batch_size)
 
             log_W_tm1 = log_Ws[t - 1] - tf.reduce_logsumexp(log_Ws[t - 1], axis=0)
-            log_W_t = tf.reduce_logsumexp(f_tm1_log_prob + log_W_tm1, axis=2)
+            log_W_t = self.BSim_kernel.log_predictive(bw_X_t, Xs[t - 1], log_W_tm1)
 
             # p(x_t | x_{t+1:T}, y_{1:T})
             bw_log_omega_t = log_W_t + f_t_log_prob + g_t_log_prob - bw_q_log_prob
@@ -143,6 +154,9 @@ class PSVO(SVO):
 
             bw_log_Omega_t = bw_log_omega_t + bw_q_log_prob + tf.log(float(M))
 
+            g_t_log_prob = self.mask_log_prob(g_t_log_prob, t)
+            bw_log_Omega_t = self.mask_log_prob(bw_log_Omega_t, t)
+
             bw_Xs_ta = bw_Xs_ta.write(t, bw_X_t)
             f_log_probs_ta = f_log_probs_ta.write(t + 1, f_t_log_prob)
             g_log_probs_ta = g_log_probs_ta.write(t, g_t_log_prob)
@@ -152,8 +166,9 @@ class PSVO(SVO):
 
         # conduct the while loop
         init_state = (time - 2, bw_X_Tm1, bw_Xs_ta, f_log_probs_ta, g_log_probs_ta, bw_log_Omegas_ta)
-        t, bw_X_1, bw_Xs_ta, f_log_probs_ta, g_log_probs_ta, bw_log_Omegas_ta = \
-            tf.while_loop(while_cond, while_body, init_state)
+        with dist_cache_scope():
+            t, bw_X_1, bw_Xs_ta, f_log_probs_ta, g_log_probs_ta, bw_log_Omegas_ta = \
+                tf.while_loop(while_cond, while_body, init_state)
 
         # t = 0
         # bw_X_t.shape = (M, n_particles, batch_size, Dx)
@@ -163,6 +178,7 @@ class PSVO(SVO):
                                                            sample_size=M)
 
         f_0_log_prob = self.f.log_prob(bw_X_0, bw_X_1)          # (M, n_particles, batch_size)
+        f_0_log_prob = self.mask_log_prob(f_0_log_prob, 1)
         g_0_log_prob = self.g.log_prob(bw_X_0, obs[:, 0])       # (M, n_particles, batch_size)
 
         # self.preprocessed_X0_f is cached in self.SMC()
@@ -209,7 +225,9 @@ class PSVO(SVO):
                 cells = self.y_smoother_f
                 if isinstance(self.y_smoother_f, list):
                     cells = tf.nn.rnn_cell.MultiRNNCell(self.y_smoother_f)
-                preprocessed_obs, preprocessed_X0 = tf.nn.static_rnn(cells, tf.unstack(obs, axis=1), dtype=tf.float32)
+                preprocessed_obs, preprocessed_X0 = tf.nn.static_rnn(cells, tf.unstack(obs, axis=1),
+                                                                     sequence_length=self.seq_lengths,
+                                                                     dtype=tf.float32)
             else:
                 preprocessed_X0, preprocessed_obs = self.preprocess_obs_w_bRNN(obs)
 
@@ -2,6 +2,9 @@ import numpy as np
 import tensorflow as tf
 from tensorflow_probability import distributions as tfd
 
+from SMC.resampler import resample, resample_schemes
+from distribution.mvn import dist_cache_scope
+
 
 class SVO:
     def __init__(self, model, FLAGS, name="log_ZSMC"):
@@ -16,6 +19,7 @@ class SVO:
         self.g  = model.g_dist
 
         self.n_particles = FLAGS.n_particles
+        self.validate_args = FLAGS.validate_args
         self.q_uses_true_X = FLAGS.q_uses_true_X
 
         # bidirectional RNN as full sequence observations encoder
@@ -25,21 +29,36 @@ class SVO:
         self.model = model
         self.smooth_obs = True
         self.resample_particles = True
+        self.resample_scheme = FLAGS.resample_scheme
+        if self.resample_scheme not in resample_schemes:
+            raise ValueError("Unknown resample_scheme {}".format(self.resample_scheme))
+
+        # only resample when the effective sample size drops below ESS_threshold * n_particles
+        self.use_adaptive_resampling = FLAGS.use_adaptive_resampling
+        self.ESS_threshold = FLAGS.ESS_threshold
+
+        # padding mask of variable length sequences, set in get_log_ZSMC
+        self.mask = None
+        self.seq_lengths = None
 
         self.name = name
 
-    def get_log_ZSMC(self, obs, hidden):
+    def get_log_ZSMC(self, obs, hidden, mask=None):
         """
         Get log_ZSMC from obs y_1:T
         Input:
             obs.shape = (batch_size, time, Dy)
             hidden.shape = (batch_size, time, Dz)
+            mask.shape = (batch_size, time), 1.0 for valid steps and 0.0 for padding after the end of a sequence,
+                None if all sequences have length time
         Output:
             log_ZSMC: shape = scalar
             log: stuff to debug
         """
         batch_size, time, _ = obs.get_shape().as_list()
         self.Dx, self.batch_size, self.time = self.model.Dx, batch_size, time
+        self.set_mask(mask)
+        obs, hidden = self.fill_padding(obs, hidden)
 
         with tf.variable_scope(self.name):
 
@@ -54,6 +73,9 @@ class SVO:
             Xs = tf.transpose(Xs, perm=[2, 0, 1, 3], name="Xs")
 
             log["Xs"] = Xs
+            log["ESS"] = tf.transpose(self.ESSs, name="ESS")
+            log["n_unique_ancestors"] = tf.transpose(self.count_unique_ancestors(self.ancestor_idxs),
+                                                     name="n_unique_ancestors")
 
         return log_ZSMC, log
 
@@ -96,20 +118,19 @@ class SVO:
 
         log_alpha_0 = f_0_log_prob + g_0_log_prob - q_0_log_prob
         log_W_0 = log_alpha_0 - tf.log(float(n_particles))
-        X_ancestor_0 = self.resample_X(X_0, log_W_0, sample_size=n_particles,
-                                       resample_particles=self.resample_particles)
-
-        log_normalized_W_0 = log_W_0 - tf.reduce_logsumexp(log_W_0, axis=0)
-        if self.resample_particles:
-            log_normalized_W_0 = -tf.log(tf.constant(n_particles, dtype=tf.float32, shape=(n_particles, batch_size)))
+        with tf.name_scope("resample"):
+            X_ancestor_0, ancestor_idx_0, log_normalized_W_0, ESS_0 = self.resample_and_normalize(X_0, log_W_0)
 
+        # only ancestor indices are stored, resampled particles are gathered from Xs after the loop
         Xs_ta = tf.TensorArray(tf.float32, size=time, name="Xs_ta")
-        X_ancestors_ta = tf.TensorArray(tf.float32, size=time, name="X_ancestors_ta")
+        ancestor_idxs_ta = tf.TensorArray(tf.int32, size=time, name="ancestor_idxs_ta")
         log_Ws_ta = tf.TensorArray(tf.float32, size=time, name="log_Ws_ta")
+        ESSs_ta = tf.TensorArray(tf.float32, size=time, name="ESSs_ta")
 
         Xs_ta = Xs_ta.write(0, X_0)
-        X_ancestors_ta = X_ancestors_ta.write(0, X_ancestor_0)
+        ancestor_idxs_ta = ancestor_idxs_ta.write(0, ancestor_idx_0)
         log_Ws_ta = log_Ws_ta.write(0, log_W_0)
+        ESSs_ta = ESSs_ta.write(0, ESS_0)
 
         # -------------------------------------- t = 1, ..., T - 1 -------------------------------------- #
         # prepare tensor arrays
@@ -120,7 +141,7 @@ class SVO:
         def while_cond(t, *unused_args):
             return t < time
 
-        def while_body(t, X_ancestor_tm1, log_normalized_W_tm1, Xs_ta, X_ancestors_ta, log_Ws_ta):
+        def while_body(t, X_ancestor_tm1, log_normalized_W_tm1, Xs_ta, ancestor_idxs_ta, log_Ws_ta, ESSs_ta):
             q_f_t_feed = X_ancestor_tm1
 
             # proposal
@@ -149,40 +170,82 @@ class SVO:
             g_t_log_prob = self.g.log_prob(X_t, obs[:, t], name="g_t_log_prob")
 
             log_alpha_t = f_t_log_prob + g_t_log_prob - q_t_log_prob
+            log_alpha_t = self.mask_log_prob(log_alpha_t, t)
             log_W_t = log_alpha_t + log_normalized_W_tm1
 
-            X_ancestor_t = self.resample_X(X_t, log_W_t, sample_size=n_particles,
-                                           resample_particles=self.resample_particles)
-            log_normalized_W_t = log_W_t - tf.reduce_logsumexp(log_W_t, axis=0)
-            if self.resample_particles:
-                log_normalized_W_t = -tf.log(tf.constant(n_particles, dtype=tf.float32, shape=(n_particles, batch_size)))
+            with tf.name_scope("resample"):
+                X_ancestor_t, ancestor_idx_t, log_normalized_W_t, ESS_t = self.resample_and_normalize(X_t, log_W_t)
 
             # write results in this loop to tensor arrays
             Xs_ta = Xs_ta.write(t, X_t)
-            X_ancestors_ta = X_ancestors_ta.write(t, X_ancestor_t)
+            ancestor_idxs_ta = ancestor_idxs_ta.write(t, ancestor_idx_t)
             log_Ws_ta = log_Ws_ta.write(t, log_W_t)
+            ESSs_ta = ESSs_ta.write(t, ESS_t)
 
-            return t + 1, X_ancestor_t, log_normalized_W_t, Xs_ta, X_ancestors_ta, log_Ws_ta
+            return t + 1, X_ancestor_t, log_normalized_W_t, Xs_ta, ancestor_idxs_ta, log_Ws_ta, ESSs_ta
 
         # conduct the while loop
-        init_state = (1, X_ancestor_0, log_normalized_W_0, Xs_ta, X_ancestors_ta, log_Ws_ta)
-        _, _, _, Xs_ta, X_ancestors_ta, log_Ws_ta = tf.while_loop(while_cond, while_body, init_state)
+        init_state = (1, X_ancestor_0, log_normalized_W_0, Xs_ta, ancestor_idxs_ta, log_Ws_ta, ESSs_ta)
+        with dist_cache_scope():
+            _, _, _, Xs_ta, ancestor_idxs_ta, log_Ws_ta, ESSs_ta = tf.while_loop(while_cond, while_body, init_state)
 
         # convert tensor arrays to tensors
         Xs = Xs_ta.stack()
-        X_ancestors = X_ancestors_ta.stack()
+        self.ancestor_idxs = ancestor_idxs_ta.stack()
         log_Ws = log_Ws_ta.stack()
+        self.ESSs = ESSs_ta.stack()
 
         Xs.set_shape((time, n_particles, batch_size, Dx))
-        X_ancestors.set_shape((time, n_particles, batch_size, Dx))
+        self.ancestor_idxs.set_shape((time, n_particles, batch_size))
         log_Ws.set_shape((time, n_particles, batch_size))
+        self.ESSs.set_shape((time, batch_size))
+
+        X_ancestors = self.gather_ancestors(Xs, self.ancestor_idxs)
 
         return Xs, X_ancestors, log_Ws
 
+    def set_mask(self, mask):
+        self.mask = mask
+        if mask is None:
+            self.seq_lengths = None
+        else:
+            self.seq_lengths = tf.cast(tf.reduce_sum(mask, axis=1), tf.int32, name="seq_lengths")
+
+    def fill_padding(self, obs, hidden):
+        """
+        Replace obs and hidden at padded steps with zeros. The distributions still evaluate padded steps before
+        mask_log_prob zeros them out, and the NaN padding of the data would give NaN log probs and gradients
+        """
+        if self.mask is None:
+            return obs, hidden
+
+        with tf.name_scope("fill_padding"):
+            obs = tf.where(self.mask[..., None] + tf.zeros_like(obs) > 0, obs, tf.zeros_like(obs))
+            hidden = tf.where(self.mask[..., None] + tf.zeros_like(hidden) > 0, hidden, tf.zeros_like(hidden))
+
+        return obs, hidden
+
+    def mask_log_prob(self, log_prob, t):
+        """
+        Zero out log_prob of sequences that have ended before step t,
+        so that padded steps contribute nothing to log_ZSMC
+        Input:
+            log_prob.shape = (..., batch_size)
+        """
+        if self.mask is None:
+            return log_prob
+        # selected rather than multiplied by the mask, as 0 * -inf or 0 * NaN would be NaN
+        return tf.where(self.mask[:, t] + tf.zeros_like(log_prob) > 0, log_prob, tf.zeros_like(log_prob))
+
     def sample_from_2_dist(self, dist1, dist2, d1_input, d2_input, sample_size=()):
         d1_mvn = dist1.get_mvn(d1_input)
         d2_mvn = dist2.get_mvn(d2_input)
 
+        # the name scope starts after get_mvn, as the names of keras variables depend on the scope they're built in
+        with tf.name_scope("sample_from_2_dist"):
+            return self.sample_from_product(d1_mvn, d2_mvn, sample_size)
+
+    def sample_from_product(self, d1_mvn, d2_mvn, sample_size=()):
         if isinstance(d1_mvn, tfd.MultivariateNormalDiag) and isinstance(d2_mvn, tfd.MultivariateNormalDiag):
             d1_mvn_mean, d1_mvn_cov = d1_mvn.mean(), d1_mvn.stddev()
             d2_mvn_mean, d2_mvn_cov = d2_mvn.mean(), d2_mvn.stddev()
@@ -193,106 +256,272 @@ class SVO:
 
             mvn = tfd.MultivariateNormalDiag(combined_mean,
                                              combined_cov,
-                                             validate_args=True,
+                                             validate_args=self.validate_args,
                                              allow_nan_stats=False)
+
+            X = mvn.sample(sample_size)
+            q_t_log_prob = mvn.log_prob(X)
         else:
-            if isinstance(d1_mvn, tfd.MultivariateNormalDiag):
-                d1_mvn_mean, d1_mvn_cov = d1_mvn.mean(), tf.diag(d1_mvn.stddev())
-            elif isinstance(d1_mvn, tfd.MultivariateNormalFullCovariance):
-                d1_mvn_mean, d1_mvn_cov = d1_mvn.mean(), d1_mvn.covariance()
-
-            if isinstance(d2_mvn, tfd.MultivariateNormalDiag):
-                d2_mvn_mean, d2_mvn_cov = d2_mvn.mean(), tf.diag(d2_mvn.stddev())
-            elif isinstance(d2_mvn, tfd.MultivariateNormalFullCovariance):
-                d2_mvn_mean, d2_mvn_cov = d2_mvn.mean(), d2_mvn.covariance()
-
-            if len(d1_mvn_cov.shape.as_list()) == 2:
-                d1_mvn_cov = tf.expand_dims(d1_mvn_cov, axis=0)
-
-            d1_mvn_cov_inv, d2_mvn_cov_inv = tf.linalg.inv(d1_mvn_cov), tf.linalg.inv(d2_mvn_cov)
-            combined_cov = tf.linalg.inv(d1_mvn_cov_inv + d2_mvn_cov_inv)
-            perm = list(range(len(combined_cov.shape)))
-            perm[-2], perm[-1] = perm[-1], perm[-2]
-            combined_cov = (combined_cov + tf.transpose(combined_cov, perm=perm)) / 2
-            combined_mean = tf.matmul(combined_cov,
-                                      tf.matmul(d1_mvn_cov_inv, tf.expand_dims(d1_mvn_mean, axis=-1)) +
-                                      tf.matmul(d2_mvn_cov_inv, tf.expand_dims(d2_mvn_mean, axis=-1))
-                                      )
-            combined_mean = tf.squeeze(combined_mean, axis=-1)
-
-            mvn = tfd.MultivariateNormalFullCovariance(combined_mean,
-                                                       combined_cov,
-                                                       validate_args=True,
-                                                       allow_nan_stats=False)
-
-        X = mvn.sample(sample_size)
-        q_t_log_prob = mvn.log_prob(X)
+            # the product of N(mu1, P1^-1) and N(mu2, P2^-1) is proportional to N(P^-1 (P1 mu1 + P2 mu2), P^-1)
+            # with P = P1 + P2, so work with precisions and a single Cholesky factor of P instead of inverses
+            d1_precision, d2_precision = self.get_precision(d1_mvn), self.get_precision(d2_mvn)
+            combined_precision = d1_precision + d2_precision
+            combined_precision_mean = tf.reduce_sum(d1_precision * tf.expand_dims(d1_mvn.mean(), axis=-2), axis=-1) + \
+                tf.reduce_sum(d2_precision * tf.expand_dims(d2_mvn.mean(), axis=-2), axis=-1)
+
+            X, q_t_log_prob = self.sample_from_precision(combined_precision, combined_precision_mean, sample_size)
+
         f_t_log_prob = d1_mvn.log_prob(X)
 
         return X, q_t_log_prob, f_t_log_prob
 
+    @staticmethod
+    def get_precision(mvn):
+        # as in the diagonal case of sample_from_2_dist, the stddev of a diagonal mvn is combined as its covariance
+        if isinstance(mvn, tfd.MultivariateNormalDiag):
+            return tf.matrix_diag(1 / mvn.stddev())
+
+        # covariance L L^T with the lower triangular scale L, so the precision is L^-T L^-1,
+        # which takes a triangular solve for L^-1 rather than the two of a cholesky_solve
+        scale_tril = mvn.scale.to_dense()
+        identity = tf.eye(scale_tril.shape.as_list()[-1]) + tf.zeros_like(scale_tril)
+        scale_tril_inv = tf.matrix_triangular_solve(scale_tril, identity, lower=True)
+        return tf.matmul(scale_tril_inv, scale_tril_inv, adjoint_a=True)
+
+    @staticmethod
+    def sample_from_precision(precision, precision_mean, sample_size=()):
+        """
+        Sample from N(P^-1 b, P^-1) and evaluate the log prob of samples, using one Cholesky factor P = L L^T
+        Input:
+            precision.shape = (batch_shape, Dx, Dx), P
+            precision_mean.shape = (batch_shape, Dx), b
+            sample_size: () or int
+        Output:
+            X.shape = (sample_size, batch_shape, Dx)
+            log_prob.shape = (sample_size, batch_shape)
+        """
+        # broadcast to the same batch shape, as linalg ops don't broadcast batch dims
+        precision = precision + tf.expand_dims(tf.zeros_like(precision_mean), axis=-1)
+        precision_mean = precision_mean + tf.zeros_like(precision[..., 0])
+        Dx = precision_mean.shape.as_list()[-1]
+        batch_shape = precision_mean.shape.as_list()[:-1]
+        n_samples = 1 if sample_size == () else sample_size
+
+        L = tf.cholesky(precision)
+        mean = tf.cholesky_solve(L, tf.expand_dims(precision_mean, axis=-1))   # (batch_shape, Dx, 1)
+
+        # X = mean + L^-T z has covariance L^-T L^-1 = P^-1, samples are put on the last axis to solve them at once
+        z = tf.random_normal(batch_shape + [Dx, n_samples])
+        X = mean + tf.matrix_triangular_solve(L, z, lower=True, adjoint=True)  # (batch_shape, Dx, n_samples)
+
+        # log N(X; P^-1 b, P^-1) = -|L^T (X - P^-1 b)|^2 / 2 + log|L| - Dx / 2 * log(2 pi), and L^T (X - P^-1 b) = z
+        log_prob = -0.5 * tf.reduce_sum(z ** 2, axis=-2) \
+            + tf.reduce_sum(tf.log(tf.matrix_diag_part(L)), axis=-1, keepdims=True) \
+            - 0.5 * Dx * np.log(2 * np.pi)                                     # (batch_shape, n_samples)
+
+        n_batch_axes = len(batch_shape)
+        X = tf.transpose(X, perm=[n_batch_axes + 1] + list(range(n_batch_axes)) + [n_batch_axes])
+        log_prob = tf.transpose(log_prob, perm=[n_batch_axes] + list(range(n_batch_axes)))
+        if sample_size == ():
+            X, log_prob = X[0], log_prob[0]
+
+        return X, log_prob
+
     def sample_from_true_X(self, hidden, q_cov, sample_shape=(), name="q_t_mvn"):
         mvn = tfd.MultivariateNormalDiag(hidden,
                                          q_cov * tf.ones(self.Dx, dtype=tf.float32),
+                                         validate_args=self.validate_args,
                                          name=name)
         X = mvn.sample(sample_shape)
         q_t_log_prob = mvn.log_prob(X)
 
         return X, q_t_log_prob
 
+    def resample_and_normalize(self, X, log_W):
+        """
+        Resample X according to log_W if needed, and get the normalized log weights carried to the next step
+        Input:
+            X.shape = (n_particles, batch_size, Dx)
+            log_W.shape = (n_particles, batch_size)
+        Output:
+            X_ancestor.shape = (n_particles, batch_size, Dx)
+            ancestor_idx.shape = (n_particles, batch_size), X_ancestor[k, b] = X[ancestor_idx[k, b], b]
+            log_normalized_W.shape = (n_particles, batch_size)
+            ESS.shape = (batch_size,), effective sample size before resampling
+        """
+        n_particles, batch_size = log_W.shape.as_list()
+
+        log_normalized_W = log_W - tf.reduce_logsumexp(log_W, axis=0)
+        ESS = tf.exp(-tf.reduce_logsumexp(2 * log_normalized_W, axis=0), name="ESS")
+        identity_idx = tf.tile(tf.range(n_particles)[:, None], (1, batch_size))
+
+        if not self.resample_particles:
+            return X, identity_idx, log_normalized_W, ESS
+
+        log_uniform_W = -tf.log(tf.constant(n_particles, dtype=tf.float32, shape=(n_particles, batch_size)))
+        if not self.use_adaptive_resampling:
+            X_ancestor, ancestor_idx = self.resample_ancestors(X, log_W)
+            return X_ancestor, ancestor_idx, log_uniform_W, ESS
+
+        # resample only batches whose ESS is below the threshold, and skip resampling when none of them is
+        resample_mask = ESS < self.ESS_threshold * n_particles
+
+        def resample_branch():
+            X_resampled, resampled_idx = self.resample_ancestors(X, log_W)
+            X_mask = tf.tile(resample_mask[None, :, None], (n_particles, 1, X.shape.as_list()[-1]))
+            W_mask = tf.tile(resample_mask[None, :], (n_particles, 1))
+            return tf.where(X_mask, X_resampled, X), \
+                tf.where(W_mask, resampled_idx, identity_idx), \
+                tf.where(W_mask, log_uniform_W, log_normalized_W)
+
+        X_ancestor, ancestor_idx, log_normalized_W = tf.cond(tf.reduce_any(resample_mask),
+                                                             resample_branch,
+                                                             lambda: (X, identity_idx, log_normalized_W))
+
+        return X_ancestor, ancestor_idx, log_normalized_W, ESS
+
+    def resample_ancestors(self, X, log_W):
+        """
+        Resample n_particles particles from X, and also return their indices in X
+        Input:
+            X.shape = (n_particles, batch_size, Dx)
+            log_W.shape = (n_particles, batch_size)
+        Output:
+            X_ancestor.shape = (n_particles, batch_size, Dx)
+            ancestor_idx.shape = (n_particles, batch_size)
+        """
+        n_particles = log_W.shape.as_list()[0]
+        with tf.name_scope("resample"):
+            resample_idx = self.get_resample_idx(log_W, sample_size=n_particles)
+            return tf.gather_nd(X, resample_idx), resample_idx[..., 0]
+
+    @staticmethod
+    def gather_ancestors(Xs, ancestor_idxs):
+        """
+        Gather resampled particles of all steps at once
+        Input:
+            Xs.shape = (time, n_particles, batch_size, Dx)
+            ancestor_idxs.shape = (time, n_particles, batch_size)
+        Output:
+            X_ancestors.shape = (time, n_particles, batch_size, Dx), X_ancestors[t, k, b] = Xs[t, ancestor_idxs[t, k, b], b]
+        """
+        time, n_particles, batch_size = ancestor_idxs.shape.as_list()
+        time_idx, _, batch_idx = tf.meshgrid(tf.range(time), tf.range(n_particles), tf.range(batch_size), indexing='ij')
+
+        return tf.gather_nd(Xs, tf.stack([time_idx, ancestor_idxs, batch_idx], axis=-1))
+
+    @staticmethod
+    def trace_genealogy(ancestor_idxs):
+        """
+        Trace the ancestry of particles at the last step back through the stored ancestor indices
+        Input:
+            ancestor_idxs.shape = (time, n_particles, batch_size)
+        Output:
+            genealogy.shape = (time, n_particles, batch_size), genealogy[t, k, b] is the index of the particle at t
+                that particle k at the last step descends from
+        """
+        time, n_particles, batch_size = ancestor_idxs.shape.as_list()
+        last_idx = tf.tile(tf.range(n_particles)[:, None], (1, batch_size))
+        batch_idx = tf.tile(tf.range(batch_size)[None, :], (n_particles, 1))
+
+        def trace_back(lineage_tp1, ancestor_idx_t):
+            # particles at t + 1 were proposed from particles at t resampled with ancestor_idx_t
+            return tf.gather_nd(ancestor_idx_t, tf.stack([lineage_tp1, batch_idx], axis=-1))
+
+        genealogy = tf.scan(trace_back, ancestor_idxs[:-1], initializer=last_idx, reverse=True)
+        genealogy = tf.concat([genealogy, last_idx[None]], axis=0)
+
+        return genealogy
+
+    def count_unique_ancestors(self, ancestor_idxs):
+        """
+        Number of distinct particles at each step that survive as ancestors of the particles at the last step,
+        which collapses to 1 in early steps when paths degenerate
+        Output:
+            n_unique_ancestors.shape = (time, batch_size)
+        """
+        time, n_particles, batch_size = ancestor_idxs.shape.as_list()
+        genealogy = self.trace_genealogy(ancestor_idxs)
+
+        # number of descendants of each particle at each step, counted with one segment per (t, b, particle),
+        # which takes O(time * n_particles * batch_size) memory
+        time_idx, _, batch_idx = tf.meshgrid(tf.range(time), tf.range(n_particles), tf.range(batch_size), indexing='ij')
+        segment_ids = (time_idx * batch_size + batch_idx) * n_particles + genealogy
+        n_descendants = tf.unsorted_segment_sum(tf.ones_like(genealogy), segment_ids, time * batch_size * n_particles)
+        n_descendants = tf.reshape(n_descendants, (time, batch_size, n_particles))
+
+        return tf.reduce_sum(tf.cast(n_descendants > 0, tf.float32), axis=-1)
+
     def resample_X(self, X, log_W, sample_size=(), resample_particles=True):
         """
-        Resample X using categorical with logits = log_W
+        Resample X with weights proportional to exp(log_W) using self.resample_scheme
         Input:
             X: can be a list, each element e.shape = (K, batch_size_0, ..., batch_size_last, e_dim_0, ..., e_dim_last)
             log_W.shape = (K, batch_size_0, ..., batch_size_last)
             sample_size: () or int
         """
-        if resample_particles:
-            if log_W.shape.as_list()[0] != 1:
-                resample_idx = self.get_resample_idx(log_W, sample_size)
-                if isinstance(X, list):
-                    X_resampled = [tf.gather_nd(item, resample_idx) for item in X]
+        with tf.name_scope("resample"):
+            if resample_particles:
+                if log_W.shape.as_list()[0] != 1:
+                    resample_idx = self.get_resample_idx(log_W, sample_size)
+                    if isinstance(X, list):
+                        X_resampled = self.gather_items(X, resample_idx, len(log_W.shape.as_list()))
+                    else:
+                        X_resampled = tf.gather_nd(X, resample_idx)
                 else:
-                    X_resampled = tf.gather_nd(X, resample_idx)
+                    assert sample_size == 1
+                    X_resampled = X
             else:
-                assert sample_size == 1
                 X_resampled = X
-        else:
-            X_resampled = X
 
-        return X_resampled
+            return X_resampled
+
+    @staticmethod
+    def gather_items(items, resample_idx, n_leading_axes):
+        """
+        Gather a list of tensors sharing the same n_leading_axes leading dims with a single gather_nd,
+        by concatenating their flattened trailing dims
+        """
+        idx_shape = resample_idx.shape.as_list()[:-1]
+        trailing_shapes = [item.shape.as_list()[n_leading_axes:] for item in items]
+        sizes = [int(np.prod(trailing_shape)) for trailing_shape in trailing_shapes]
+
+        items = [tf.reshape(item, item.shape.as_list()[:n_leading_axes] + [size]) for item, size in zip(items, sizes)]
+        items_resampled = tf.split(tf.gather_nd(tf.concat(items, axis=-1), resample_idx), sizes, axis=-1)
+
+        return [tf.reshape(item, idx_shape + trailing_shape)
+                for item, trailing_shape in zip(items_resampled, trailing_shapes)]
 
-    def get_resample_idx(self, log_W, sample_size=()):
+    def get_resample_idx(self, log_W, sample_size=(), resample_scheme=None):
         """
-        Get resample index a_t^k ~ Categorical(w_t^1, ..., w_t^K) with logits = log_W last axis
+        Get resample index a_t^k of the first axis of log_W with resample_scheme (see SMC.resampler.resample),
+        each index is drawn with probability w_t^k, but only multinomial draws them independently
         Input:
             log_W.shape = (K, batch_size_0, ..., batch_size_last)
+            resample_scheme: one of SMC.resampler.resample_schemes, default to self.resample_scheme
+        Output:
+            resample_idx.shape = (sample_size, batch_size_0, ..., batch_size_last, 1 + len(batch_shape))
         """
+        if resample_scheme is None:
+            resample_scheme = self.resample_scheme
+
         nb_classes  = log_W.shape.as_list()[0]
         batch_shape = log_W.shape.as_list()[1:]
         perm = list(range(1, len(batch_shape) + 1)) + [0]
 
-        log_W = tf.transpose(log_W, perm=perm)
-        categorical = tfd.Categorical(logits=log_W, validate_args=True, name="Categorical")
-
-        # sample multiple times to remove idx out of range
         if sample_size == ():
+            n_samples = 1
             idx_shape = batch_shape
         else:
             assert isinstance(sample_size, int), "sample_size should be int, {} is given".format(sample_size)
+            n_samples = sample_size
             idx_shape = [sample_size] + batch_shape
 
-        idx = tf.ones(idx_shape, dtype=tf.int32) * nb_classes
-        for _ in range(1):
-            fixup_idx = categorical.sample(sample_size)
-            idx = tf.where(idx >= nb_classes, fixup_idx, idx)
+        log_W = tf.reshape(tf.transpose(log_W, perm=perm), (-1, nb_classes))
+        idx = resample(log_W, n_samples, resample_scheme)                     # (prod(batch_shape), n_samples)
+        idx = tf.reshape(tf.transpose(idx), idx_shape)
 
-        # if still got idx out of range, replace them with idx from uniform distribution
-        final_fixup = tf.random.uniform(idx_shape, maxval=nb_classes, dtype=tf.int32)
-        idx = tf.where(idx >= nb_classes, final_fixup, idx)
-
-        batch_idx = np.meshgrid(*[range(i) for i in idx_shape], indexing='ij')
+        batch_idx = tf.meshgrid(*[tf.range(i) for i in idx_shape], indexing='ij')
         if sample_size != ():
             batch_idx = batch_idx[1:]
         resample_idx = tf.stack([idx] + batch_idx, axis=-1)
@@ -338,11 +567,13 @@ class SVO:
                 tf.contrib.rnn.stack_bidirectional_dynamic_rnn(self.y_smoother_f,
                                                                self.y_smoother_b,
                                                                obs,
+                                                               sequence_length=self.seq_lengths,
                                                                dtype=tf.float32)
         else:
             outputs, (state_fw, state_bw) = tf.nn.bidirectional_dynamic_rnn(self.y_smoother_f,
                                                                             self.y_smoother_b,
                                                                             obs,
+                                                                            sequence_length=self.seq_lengths,
                                                                             dtype=tf.float32)
         smoothed_obs = tf.concat(outputs, axis=-1)
         preprocessed_obs = tf.unstack(smoothed_obs, axis=1)
@@ -353,18 +584,26 @@ class SVO:
                     tf.contrib.rnn.stack_bidirectional_dynamic_rnn(self.X0_smoother_f,
                                                                    self.X0_smoother_b,
                                                                    obs,
+                                                                   sequence_length=self.seq_lengths,
                                                                    dtype=tf.float32)
             else:
                 outputs, (state_fw, state_bw) = tf.nn.bidirectional_dynamic_rnn(self.X0_smoother_f,
                                                                                 self.X0_smoother_b,
                                                                                 obs,
+                                                                                sequence_length=self.seq_lengths,
                                                                                 dtype=tf.float32)
         if self.use_stack_rnn:
             outputs_fw = outputs_bw = outputs
         else:
             outputs_fw, outputs_bw = outputs
         output_fw_list, output_bw_list = tf.unstack(outputs_fw, axis=1), tf.unstack(outputs_bw, axis=1)
-        preprocessed_X0 = tf.concat([output_fw_list[-1], output_bw_list[0]], axis=-1)
+        if self.seq_lengths is None:
+            output_fw_last = output_fw_list[-1]
+        else:
+            # forward outputs after the end of a sequence are zeros, take the one at its last valid step instead
+            last_idx = tf.stack([tf.range(self.batch_size), self.seq_lengths - 1], axis=-1)
+            output_fw_last = tf.gather_nd(outputs_fw, last_idx)
+        preprocessed_X0 = tf.concat([output_fw_last, output_bw_list[0]], axis=-1)
 
         return preprocessed_X0, preprocessed_obs
 
@@ -387,8 +626,8 @@ class SVO:
                 y_hat_BxTmkxDy = self.g.mean(x_BxTmkxDz)                            # (batch_size, time - k, Dy)
                 y_hat_N_BxTxDy.append(y_hat_BxTmkxDy)
 
-                x_Tmk_BxDz = tf.unstack(x_BxTmkxDz, axis=1, name="x_Tmk_BxDz")      # list of (batch_size, Dx)
-                x_BxTmkxDz = tf.stack(x_Tmk_BxDz[:-1], axis=1, name="x_BxTmkxDz")   # (batch_size, time - k - 1, Dx)
+                # a single slice instead of unstacking time, so that the graph size doesn't grow with time
+                x_BxTmkxDz = x_BxTmkxDz[:, :-1]                                     # (batch_size, time - k - 1, Dx)
                 f_k_input = x_BxTmkxDz
                 x_BxTmkxDz = self.f.mean(f_k_input)                                 # (batch_size, time - k - 1, Dx)
 
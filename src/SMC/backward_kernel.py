@@ -0,0 +1,239 @@
+import numpy as np
+import tensorflow as tf
+from tensorflow_probability import distributions as tfd
+
+from SMC.resampler import resample
+from distribution.mvn import dist_cache_scope
+
+BSim_kernels = ["exhaustive", "sampled"]
+
+
+def log_predictive(f, X_t, X_tm1, log_W_tm1, chunk_size=0):
+    """
+    Evaluate the filtering predictive density log sum_j W_tm1^j * f(X_t | X_tm1^j) used to weight
+    backward particles, marginalizing over all forward particles at t - 1
+    Input:
+        f: tf_mvn, transition distribution
+        X_t.shape = (..., batch_size, Dx)
+        X_tm1.shape = (n_particles, batch_size, Dx)
+        log_W_tm1.shape = (n_particles, batch_size), normalized across n_particles
+        chunk_size: number of forward particles evaluated at once, <= 0 to evaluate all of them together
+    Output:
+        log_W_t.shape = (..., batch_size)
+    """
+    n_particles = X_tm1.shape.as_list()[0]
+
+    if chunk_size <= 0 or chunk_size >= n_particles:
+        n_leading_axes = len(X_t.shape.as_list()) - 2
+        X_t_tiled = tf.expand_dims(X_t, axis=n_leading_axes)
+        X_t_tiled = tf.tile(X_t_tiled, [1] * n_leading_axes + [n_particles, 1, 1])
+        f_tm1_log_prob = f.log_prob(X_tm1, X_t_tiled)  # (..., n_particles, batch_size)
+        return tf.reduce_logsumexp(f_tm1_log_prob + log_W_tm1, axis=n_leading_axes)
+
+    f_tm1 = f.get_mvn(X_tm1)
+    if isinstance(f_tm1, tfd.MultivariateNormalDiag):
+        return diag_mvn_log_predictive(X_t, f_tm1.mean(), f_tm1.stddev(), log_W_tm1, chunk_size)
+
+    return chunked_log_predictive(f, X_t, X_tm1, log_W_tm1, chunk_size)
+
+
+def pad_particles(x, n_padded, value):
+    # pad the particle axis (axis 0) of x with n_padded entries of value
+    if n_padded == 0:
+        return x
+    padding = tf.fill([n_padded] + x.shape.as_list()[1:], value)
+    return tf.concat([x, padding], axis=0)
+
+
+def chunked_log_predictive(f, X_t, X_tm1, log_W_tm1, chunk_size):
+    """
+    Stream the logsumexp over blocks of chunk_size forward particles, so that only
+    (..., chunk_size, batch_size, Dx) is materialized at a time in the forward pass.
+    Works for any transition distribution, but backprop still keeps every block.
+    """
+    X_shape = X_t.shape.as_list()
+    n_particles, batch_size, Dx = X_tm1.shape.as_list()
+
+    n_chunks = -(-n_particles // chunk_size)
+    n_padded = n_chunks * chunk_size - n_particles
+
+    X_t = tf.expand_dims(tf.reshape(X_t, (-1, batch_size, Dx)), axis=1)  # (K, 1, batch_size, Dx)
+    X_tm1_chunks = tf.reshape(pad_particles(X_tm1, n_padded, 0.0), (n_chunks, chunk_size, batch_size, Dx))
+    log_W_tm1_chunks = tf.reshape(pad_particles(log_W_tm1, n_padded, -np.inf), (n_chunks, chunk_size, batch_size))
+
+    def chunk_log_predictive(i):
+        f_tm1_log_prob = f.log_prob(X_tm1_chunks[i], X_t)  # (K, chunk_size, batch_size)
+        return tf.reduce_logsumexp(f_tm1_log_prob + log_W_tm1_chunks[i], axis=1)
+
+    def while_cond(i, *unused_args):
+        return i < n_chunks
+
+    def while_body(i, log_W_t):
+        log_W_t = tf.reduce_logsumexp(tf.stack([log_W_t, chunk_log_predictive(i)]), axis=0)
+        return i + 1, log_W_t
+
+    with dist_cache_scope():
+        _, log_W_t = tf.while_loop(while_cond, while_body, (1, chunk_log_predictive(0)), parallel_iterations=1)
+
+    return tf.reshape(log_W_t, X_shape[:-1])
+
+
+def diag_mvn_log_predictive(X_t, mu, sigma, log_W_tm1, chunk_size):
+    """
+    Closed-form path for a diagonal Gaussian transition f(x_t | x_tm1^j) = N(x_t; mu^j, diag(sigma^j)^2).
+    Both the forward pass and the gradient stream over blocks of chunk_size forward particles,
+    so memory is O(K * chunk_size * batch_size * Dx) instead of O(K * n_particles * batch_size * Dx).
+    Input:
+        mu.shape = (n_particles, batch_size, Dx)
+        sigma: stddev, broadcastable to mu.shape
+    """
+    X_shape = X_t.shape.as_list()
+    n_particles, batch_size, Dx = mu.shape.as_list()
+
+    n_chunks = -(-n_particles // chunk_size)
+    n_padded = n_chunks * chunk_size - n_particles
+    log_norm_const = 0.5 * Dx * np.log(2 * np.pi)
+
+    X_t = tf.reshape(X_t, (-1, batch_size, Dx))  # (K, batch_size, Dx)
+    sigma = sigma * tf.ones_like(mu)
+
+    @tf.custom_gradient
+    def log_predictive_fn(x, mu, sigma, log_W):
+        mu_chunks = tf.reshape(pad_particles(mu, n_padded, 0.0), (n_chunks, chunk_size, batch_size, Dx))
+        sigma_chunks = tf.reshape(pad_particles(sigma, n_padded, 1.0), (n_chunks, chunk_size, batch_size, Dx))
+        log_W_chunks = tf.reshape(pad_particles(log_W, n_padded, -np.inf), (n_chunks, chunk_size, batch_size))
+        x_expanded = tf.expand_dims(x, axis=1)  # (K, 1, batch_size, Dx)
+
+        def chunk_log_joint(i, x_expanded, mu_chunks, sigma_chunks, log_W_chunks):
+            # standardized residual r.shape = (K, chunk_size, batch_size, Dx)
+            # log_joint.shape = (K, chunk_size, batch_size)
+            r = (x_expanded - mu_chunks[i]) / sigma_chunks[i]
+            log_prob = -0.5 * tf.reduce_sum(r ** 2, axis=-1) \
+                - tf.reduce_sum(tf.log(sigma_chunks[i]), axis=-1) - log_norm_const
+            return log_prob + log_W_chunks[i], r
+
+        fw_chunks = (x_expanded, mu_chunks, sigma_chunks, log_W_chunks)
+
+        def fw_while_cond(i, *unused_args):
+            return i < n_chunks
+
+        def fw_while_body(i, log_W_t):
+            log_joint, _ = chunk_log_joint(i, *fw_chunks)
+            log_W_t = tf.reduce_logsumexp(tf.stack([log_W_t, tf.reduce_logsumexp(log_joint, axis=1)]), axis=0)
+            return i + 1, log_W_t
+
+        log_joint_0, _ = chunk_log_joint(0, *fw_chunks)
+        _, log_W_t = tf.while_loop(fw_while_cond, fw_while_body,
+                                   (1, tf.reduce_logsumexp(log_joint_0, axis=1)),
+                                   parallel_iterations=1)
+
+        def grad(d_log_W_t):
+            # bring forward tensors into the gradient context before using them in the inner while loop,
+            # which is required when this kernel itself runs inside a while loop
+            bw_chunks = [tf.identity(tensor) for tensor in fw_chunks]
+            bw_log_W_t = tf.identity(log_W_t)
+
+            def bw_while_cond(i, *unused_args):
+                return i < n_chunks
+
+            def bw_while_body(i, d_x, d_mu_ta, d_sigma_ta, d_log_W_ta):
+                log_joint, r = chunk_log_joint(i, *bw_chunks)
+                sigma_i = bw_chunks[2][i]
+
+                # posterior responsibility of each forward particle, weighted by incoming gradient
+                w = tf.expand_dims(d_log_W_t, axis=1) * tf.exp(log_joint - tf.expand_dims(bw_log_W_t, axis=1))
+                w_expanded = tf.expand_dims(w, axis=-1)
+                w_r_over_sigma = w_expanded * r / sigma_i
+
+                d_x -= tf.reduce_sum(w_r_over_sigma, axis=1)
+                d_mu_ta = d_mu_ta.write(i, tf.reduce_sum(w_r_over_sigma, axis=0))
+                d_sigma_ta = d_sigma_ta.write(i, tf.reduce_sum(w_expanded * (r ** 2 - 1) / sigma_i, axis=0))
+                d_log_W_ta = d_log_W_ta.write(i, tf.reduce_sum(w, axis=0))
+
+                return i + 1, d_x, d_mu_ta, d_sigma_ta, d_log_W_ta
+
+            init_state = (0, tf.zeros_like(bw_chunks[0][:, 0]),
+                          tf.TensorArray(tf.float32, size=n_chunks, name="d_mu_ta"),
+                          tf.TensorArray(tf.float32, size=n_chunks, name="d_sigma_ta"),
+                          tf.TensorArray(tf.float32, size=n_chunks, name="d_log_W_ta"))
+            _, d_x, d_mu_ta, d_sigma_ta, d_log_W_ta = \
+                tf.while_loop(bw_while_cond, bw_while_body, init_state, parallel_iterations=1)
+
+            d_mu = tf.reshape(d_mu_ta.stack(), (-1, batch_size, Dx))[:n_particles]
+            d_sigma = tf.reshape(d_sigma_ta.stack(), (-1, batch_size, Dx))[:n_particles]
+            d_log_W = tf.reshape(d_log_W_ta.stack(), (-1, batch_size))[:n_particles]
+
+            return d_x, d_mu, d_sigma, d_log_W
+
+        return log_W_t, grad
+
+    log_W_t = log_predictive_fn(X_t, mu, sigma, log_W_tm1)
+
+    return tf.reshape(log_W_t, X_shape[:-1])
+
+
+def sampled_log_predictive(f, X_t, X_tm1, log_W_tm1, n_ancestors):
+    """
+    Unbiased estimate of sum_j W_tm1^j * f(X_t | X_tm1^j) from n_ancestors forward particles drawn from W_tm1
+    for each backward particle, log 1/K sum_k f(X_t | X_tm1^{a_k}) with a_k ~ Categorical(W_tm1),
+    which costs O(K) per backward particle instead of O(n_particles).
+    Each term is reweighted by W_tm1^{a_k} / stop_gradient(W_tm1^{a_k}), which is 1 in value, so that the gradient
+    w.r.t. log_W_tm1 is an unbiased estimate of the one of the exhaustive sum, rather than lost in the draws.
+    Input:
+        X_t.shape = (..., batch_size, Dx)
+        X_tm1.shape = (n_particles, batch_size, Dx)
+        log_W_tm1.shape = (n_particles, batch_size), normalized across n_particles
+    Output:
+        log_W_t.shape = (..., batch_size)
+    """
+    X_shape = X_t.shape.as_list()
+    batch_size, Dx = X_shape[-2:]
+    n_bw_particles = int(np.prod(X_shape[:-2]))
+
+    # drawn multinomially, so that the draws of every backward particle are exchangeable
+    ancestor_idx = resample(tf.transpose(log_W_tm1), n_ancestors * n_bw_particles, "multinomial")
+    ancestor_idx = tf.reshape(tf.transpose(ancestor_idx), (n_ancestors, n_bw_particles, batch_size))
+    batch_idx = tf.tile(tf.range(batch_size)[None, None, :], (n_ancestors, n_bw_particles, 1))
+    ancestor_idx = tf.stack([ancestor_idx, batch_idx], axis=-1)
+
+    X_tm1_ancestors = tf.gather_nd(X_tm1, ancestor_idx)        # (K, prod(...), batch_size, Dx)
+    log_W_tm1_ancestors = tf.gather_nd(log_W_tm1, ancestor_idx)  # (K, prod(...), batch_size)
+
+    X_t = tf.reshape(X_t, (1, n_bw_particles, batch_size, Dx))
+    f_tm1_log_prob = f.log_prob(X_tm1_ancestors, X_t)           # (K, prod(...), batch_size)
+    f_tm1_log_prob += log_W_tm1_ancestors - tf.stop_gradient(log_W_tm1_ancestors)
+    log_W_t = tf.reduce_logsumexp(f_tm1_log_prob, axis=0) - tf.log(float(n_ancestors))
+
+    return tf.reshape(log_W_t, X_shape[:-1])
+
+
+class backward_kernel:
+    """
+    Weigh backward particles at t with the filtering predictive p(x_t | y_{1:t-1}) ~ sum_j W_tm1^j f(x_t | x_tm1^j)
+    in the backward simulations of PSVO and PSVOwR, with one of BSim_kernels
+        exhaustive: sum over all forward particles, see log_predictive
+        sampled: estimate from BSim_n_ancestors forward particles drawn from W_tm1, see sampled_log_predictive
+    """
+    def __init__(self, f, FLAGS):
+        self.f = f
+        self.kernel = FLAGS.BSim_kernel
+        self.chunk_size = FLAGS.BSim_chunk_size
+        self.n_ancestors = FLAGS.BSim_n_ancestors
+        if self.kernel not in BSim_kernels:
+            raise ValueError("Unknown BSim_kernel {}".format(self.kernel))
+
+    def log_predictive(self, bw_X_t, X_tm1, log_W_tm1):
+        """
+        Input:
+            bw_X_t.shape = (M, n_particles, batch_size, Dx)
+            X_tm1.shape = (n_particles, batch_size, Dx)
+            log_W_tm1.shape = (n_particles, batch_size), normalized
+        Output:
+            log_W_t.shape = (M, n_particles, batch_size)
+        """
+        # f has been built in the forward pass, so the name scope doesn't change the names of its variables
+        with tf.name_scope("BSim_log_predictive"):
+            if self.kernel == "sampled":
+                return sampled_log_predictive(self.f, bw_X_t, X_tm1, log_W_tm1, self.n_ancestors)
+
+            return log_predictive(self.f, bw_X_t, X_tm1, log_W_tm1, self.chunk_size)
@@ -0,0 +1,175 @@
+from collections import deque
+
+import numpy as np
+import tensorflow as tf
+
+from SMC.online_filter import online_filter
+from SMC.PSVO import PSVO
+from distribution.mvn import dist_cache_scope
+
+
+class fixed_lag_smoother(online_filter, PSVO):
+    """
+    Online filter that also smooths x_t-lag given y_0:t, with the backward simulation of PSVO restricted to the last
+    lag + 1 steps: backward particles start from the filtering distribution at t, and go back to t - lag with the
+    q1_inv and BSim_q2 proposals, weighted against the forward particles and weights kept for these steps.
+    Each new observation costs O(lag) rather than the O(time) of smoothing the whole sequence again,
+    and a larger lag trades delay for accuracy.
+
+    BSim_q2 takes the bidirectional RNN of the observations in the window, so the model has to be trained with
+    PSVO or PSVOwR, the objectives that learn q1_inv and BSim_q2.
+    """
+    def __init__(self, model, FLAGS, lag, name="log_ZSMC"):
+        if not (FLAGS.PSVO or FLAGS.PSVOwR):
+            raise ValueError("fixed-lag smoothing needs q1_inv and BSim_q2, which are only trained by PSVO or PSVOwR")
+        if lag < 1:
+            raise ValueError("lag should be at least 1, {} is given".format(lag))
+        self.lag = lag
+
+        # PSVO attributes of backward simulation, get_log_ZSMC of PSVO then builds all variables of the checkpoint
+        PSVO.__init__(self, model, FLAGS, name)
+        online_filter.__init__(self, model, FLAGS, name=name)
+
+        with tf.variable_scope(self.name):
+            self.smoothing_outputs = self.build_smoothing_step()
+
+    def build_smoothing_step(self):
+        """
+        Backward simulation over the window of steps t - lag, ..., t
+        Output:
+            dict of
+            "smoothed_means": E[x_s | y_0:t] for s = t - lag, ..., t, shape (batch_size, lag + 1, Dx)
+        """
+        lag, n_particles, batch_size, Dx, Dy = self.lag, self.n_particles, self.batch_size, self.Dx, self.Dy
+        M = self.n_particles_for_BSim_proposal
+
+        self.window_obs = tf.placeholder(tf.float32, shape=(batch_size, lag + 1, Dy), name="window_obs")
+        # forward particles and log weights of steps t - lag - 1, ..., t, the first ones are unused when t = lag
+        self.window_Xs = tf.placeholder(tf.float32, shape=(lag + 2, n_particles, batch_size, Dx), name="window_Xs")
+        self.window_log_Ws = tf.placeholder(tf.float32, shape=(lag + 2, n_particles, batch_size),
+                                            name="window_log_Ws")
+        self.window_starts_at_0 = tf.placeholder(tf.bool, shape=(), name="window_starts_at_0")
+
+        # the input of q0 and f at t = 0, as in the forward SMC
+        mu_0, _ = self.preprocess_obs(self.window_obs[:, :1])
+        _, preprocessed_obs = self.BS_preprocess_obs(self.window_obs)
+        preprocessed_obs_ta = \
+            tf.TensorArray(tf.float32, size=lag + 1, name="preprocessed_obs_ta").unstack(preprocessed_obs)
+
+        def backward_step(i, bw_X_tp1, get_log_W_t):
+            # step i of the window, backward particles of the next step bw_X_tp1.shape = (n_particles, batch_size, Dx)
+            bw_X_t, bw_q_log_prob, _ = self.sample_from_2_dist(self.q1_inv, self.BSim_q2,
+                                                               bw_X_tp1, preprocessed_obs_ta.read(i),
+                                                               sample_size=M)
+
+            f_t_log_prob = self.f.log_prob(bw_X_t, bw_X_tp1, name="f_t_log_prob")
+            g_t_log_prob = self.g.log_prob(bw_X_t, self.window_obs[:, i], name="g_t_log_prob")
+            log_W_t = get_log_W_t(bw_X_t)
+
+            bw_log_omega_t = log_W_t + f_t_log_prob + g_t_log_prob - bw_q_log_prob
+            bw_log_omega_t = bw_log_omega_t - tf.reduce_logsumexp(bw_log_omega_t, axis=0)
+            return self.resample_X(bw_X_t, bw_log_omega_t, sample_size=())
+
+        def get_log_predictive(i):
+            # p(x_t | y_0:t-1) from the forward particles of the previous step, at window_Xs[i]
+            def log_predictive(bw_X_t):
+                log_W_tm1 = self.window_log_Ws[i] - tf.reduce_logsumexp(self.window_log_Ws[i], axis=0)
+                return self.BSim_kernel.log_predictive(bw_X_t, self.window_Xs[i], log_W_tm1)
+            return log_predictive
+
+        def log_prior(bw_X_0):
+            if not (self.model.use_bootstrap and self.model.use_2_q):
+                return self.f.log_prob(mu_0, bw_X_0)
+            return self.q0.log_prob(mu_0, bw_X_0)
+
+        def log_prior_or_predictive(bw_X_0):
+            # step 0 of the window is the first step of the sequence only when t = lag
+            def branch(log_prob_fn):
+                # each branch is its own control flow context
+                with dist_cache_scope():
+                    return log_prob_fn(bw_X_0)
+
+            with dist_cache_scope():
+                return tf.cond(self.window_starts_at_0,
+                               lambda: branch(log_prior),
+                               lambda: branch(get_log_predictive(0)))
+
+        with tf.name_scope("fixed_lag_smoothing"):
+            # t: the filtering distribution p(x_t | y_0:t)
+            bw_Xs_ta = tf.TensorArray(tf.float32, size=lag + 1, name="backward_X_ta")
+            bw_X_t = self.resample_X(self.window_Xs[-1], self.window_log_Ws[-1], sample_size=n_particles)
+            bw_Xs_ta = bw_Xs_ta.write(lag, bw_X_t)
+
+            # t - 1, ..., t - lag + 1
+            def while_cond(i, *unused_args):
+                return i >= 1
+
+            def while_body(i, bw_X_tp1, bw_Xs_ta):
+                bw_X_t = backward_step(i, bw_X_tp1, get_log_predictive(i))
+                bw_Xs_ta = bw_Xs_ta.write(i, bw_X_t)
+                return i - 1, bw_X_t, bw_Xs_ta
+
+            with dist_cache_scope():
+                _, bw_X_1, bw_Xs_ta = tf.while_loop(while_cond, while_body, (lag - 1, bw_X_t, bw_Xs_ta))
+
+            # t - lag, which has no previous step when it is 0
+            bw_X_0 = backward_step(0, bw_X_1, log_prior_or_predictive)
+            bw_Xs_ta = bw_Xs_ta.write(0, bw_X_0)
+
+            bw_Xs = bw_Xs_ta.stack()
+            bw_Xs.set_shape((lag + 1, n_particles, batch_size, Dx))
+
+            # backward particles are equally weighted
+            smoothed_means = tf.transpose(tf.reduce_mean(bw_Xs, axis=1), perm=[1, 0, 2], name="smoothed_means")
+
+        return {"smoothed_means": smoothed_means}
+
+    def reset(self):
+        online_filter.reset(self)
+        # the last lag + 1 observations, and forward particles and log weights of the last lag + 2 steps
+        self.window = {"obs":    deque(maxlen=self.lag + 1),
+                       "Xs":     deque(maxlen=self.lag + 2),
+                       "log_Ws": deque(maxlen=self.lag + 2)}
+
+    def filter(self, obs):
+        """
+        Filter and smooth the next observations of the sequence, continuing from the previous call
+        Input:
+            obs.shape = (batch_size, Dy) for one observation, or (batch_size, n_obs, Dy) for a chunk of them
+        Output:
+            means, log_increments: as in online_filter.filter
+            smoothed_means: E[x_t-lag | y_0:t] for each new step t, shape (batch_size, n_obs, Dx),
+                NaN for t < lag, where x_t-lag doesn't exist
+        """
+        obs = np.asarray(obs)
+        if obs.ndim == 2:
+            obs = obs[:, None]
+
+        t_start = self.n_filtered
+        outputs = self.filter_steps(obs)
+
+        smoothed_means = np.full((self.batch_size, obs.shape[1], self.Dx), np.nan, dtype=np.float32)
+        for i, output in enumerate(outputs):
+            t = t_start + i
+            self.window["obs"].append(obs[:, i])
+            self.window["Xs"].append(output["X"])
+            self.window["log_Ws"].append(output["log_W"])
+            if t < self.lag:
+                continue
+
+            # when t = lag, forward particles of step t - lag - 1 don't exist and are padded with zeros
+            window_Xs, window_log_Ws = list(self.window["Xs"]), list(self.window["log_Ws"])
+            if t == self.lag:
+                window_Xs.insert(0, np.zeros_like(window_Xs[0]))
+                window_log_Ws.insert(0, np.zeros_like(window_log_Ws[0]))
+
+            smoothing_outputs = self.sess.run(self.smoothing_outputs,
+                                              feed_dict={self.window_obs:         np.stack(self.window["obs"], axis=1),
+                                                         self.window_Xs:          np.stack(window_Xs),
+                                                         self.window_log_Ws:      np.stack(window_log_Ws),
+                                                         self.window_starts_at_0: t == self.lag})
+            smoothed_means[:, i] = smoothing_outputs["smoothed_means"][:, 0]
+
+        means = np.stack([output["mean"] for output in outputs], axis=1)
+        log_increments = np.stack([output["log_increment"] for output in outputs], axis=1)
+        return means, log_increments, smoothed_means
@@ -0,0 +1,184 @@
+import numpy as np
+import tensorflow as tf
+
+from SMC.SVO import SVO
+from utils.checkpoint import restore_model_variables
+
+
+class online_filter(SVO):
+    """
+    Particle filter of a trained model for observations that arrive one (or a few) at a time.
+    The particles and their weights are kept between calls to filter, so each observation costs one SMC step,
+    whatever the number of observations before it.
+
+    Proposals only use observations up to the current step:
+        t = 0: q0 (and q2) on y_0, or for SVO, which smooths obs, on the bidirectional RNN of the first n_init_obs
+            observations, a look-ahead of n_init_obs - 1 steps
+        t > 0: q1(x_t | x_t-1), combined with q2(x_t | y_t) except for SVO,
+            whose q2 takes the bidirectional RNN of the whole sequence
+
+    usage, with FLAGS of the trained model (see rslts_saving.load_experiment_param):
+        filter = online_filter(SSM(FLAGS), FLAGS)
+        filter.restore(RLT_DIR + "model/")
+        means, log_increments = filter.filter(obs_t)
+    """
+    def __init__(self, model, FLAGS, n_init_obs=1, name="log_ZSMC"):
+        SVO.__init__(self, model, FLAGS, name)
+        # same choice of objective as in runner, only SVO smooths obs in its forward SMC
+        self.smooth_obs = FLAGS.SVO and not (FLAGS.PSVO or FLAGS.PSVOwR)
+        self.resample_particles = not FLAGS.IWAE
+        self.n_init_obs = n_init_obs
+
+        self.batch_size = model.batch_size
+        self.Dx, self.Dy = model.Dx, model.Dy
+
+        # the objective the model was trained with creates the variables with the names they have in checkpoints,
+        # the networks are then reused by the filtering steps
+        self.get_log_ZSMC(model.obs, model.hidden)
+        self.model_variables = tf.global_variables()
+
+        with tf.variable_scope(self.name):
+            self.init_outputs = self.build_init_step()
+            self.step_outputs = self.build_step()
+
+        self.sess = None
+        self.reset()
+
+    def build_init_step(self):
+        n_particles, batch_size, Dy = self.n_particles, self.batch_size, self.Dy
+        self.init_obs = tf.placeholder(tf.float32, shape=(batch_size, self.n_init_obs, Dy), name="init_obs")
+
+        preprocessed_X0, preprocessed_obs = self.preprocess_obs(self.init_obs)
+        q_f_0_feed = preprocessed_X0
+
+        if self.model.use_2_q:
+            X_0, q_0_log_prob, f_0_log_prob = self.sample_from_2_dist(self.q0,
+                                                                      self.q2,
+                                                                      q_f_0_feed,
+                                                                      preprocessed_obs[0],
+                                                                      sample_size=n_particles)
+        else:
+            X_0, q_0_log_prob = self.q0.sample_and_log_prob(q_f_0_feed,
+                                                            sample_shape=n_particles,
+                                                            name="q_0_sample_and_log_prob")
+        if not (self.model.use_bootstrap and self.model.use_2_q):
+            f_0_log_prob = self.f.log_prob(q_f_0_feed, X_0, name="f_0_log_prob")
+
+        g_0_log_prob = self.g.log_prob(X_0, self.init_obs[:, 0], name="g_0_log_prob")
+
+        log_W_0 = f_0_log_prob + g_0_log_prob - q_0_log_prob - tf.log(float(n_particles))
+        return self.get_step_outputs(X_0, log_W_0)
+
+    def build_step(self):
+        n_particles, batch_size, Dx, Dy = self.n_particles, self.batch_size, self.Dx, self.Dy
+        self.obs_t = tf.placeholder(tf.float32, shape=(batch_size, Dy), name="obs_t")
+        self.X_ancestor_tm1 = tf.placeholder(tf.float32, shape=(n_particles, batch_size, Dx), name="X_ancestor_tm1")
+        self.log_normalized_W_tm1 = tf.placeholder(tf.float32, shape=(n_particles, batch_size),
+                                                   name="log_normalized_W_tm1")
+        q_f_t_feed = self.X_ancestor_tm1
+
+        use_q2 = self.model.use_2_q and not self.smooth_obs
+        if use_q2:
+            X_t, q_t_log_prob, f_t_log_prob = self.sample_from_2_dist(self.q1,
+                                                                      self.q2,
+                                                                      q_f_t_feed,
+                                                                      self.obs_t,
+                                                                      sample_size=())
+        else:
+            X_t, q_t_log_prob = self.q1.sample_and_log_prob(q_f_t_feed,
+                                                            sample_shape=(),
+                                                            name="q_t_sample_and_log_prob")
+        if not (self.model.use_bootstrap and use_q2):
+            f_t_log_prob = self.f.log_prob(q_f_t_feed, X_t, name="f_t_log_prob")
+
+        g_t_log_prob = self.g.log_prob(X_t, self.obs_t, name="g_t_log_prob")
+
+        log_W_t = f_t_log_prob + g_t_log_prob - q_t_log_prob + self.log_normalized_W_tm1
+        return self.get_step_outputs(X_t, log_W_t)
+
+    def get_step_outputs(self, X_t, log_W_t):
+        """
+        Output:
+            dict of
+            "mean": filtered mean E[x_t | y_0:t], shape (batch_size, Dx)
+            "log_increment": log p(y_t | y_0:t-1) estimate, shape (batch_size,), summing to log_ZSMC over steps
+            "ESS": effective sample size, shape (batch_size,)
+            "X", "log_W": particles and their log weights before resampling
+            "X_ancestor", "log_normalized_W": particles and log weights carried to the next step
+        """
+        with tf.name_scope("step_outputs"):
+            log_increment = tf.reduce_logsumexp(log_W_t, axis=0)
+            mean = tf.reduce_sum(tf.nn.softmax(log_W_t, axis=0)[..., None] * X_t, axis=0)
+
+        with tf.name_scope("resample"):
+            X_ancestor, _, log_normalized_W, ESS = self.resample_and_normalize(X_t, log_W_t)
+
+        return {"mean":             mean,
+                "log_increment":    log_increment,
+                "ESS":              ESS,
+                "X":                X_t,
+                "log_W":            log_W_t,
+                "X_ancestor":       X_ancestor,
+                "log_normalized_W": log_normalized_W}
+
+    def restore(self, checkpoint_path, sess=None):
+        """
+        checkpoint_path: a checkpoint saved by trainer.saver, or the dir it is saved in to use the latest one
+        """
+        self.sess = sess or tf.Session()
+        restore_model_variables(self.sess, self.model_variables, checkpoint_path)
+
+    def reset(self):
+        # start a new sequence at the next call of filter
+        self.state = None
+        self.n_filtered = 0
+
+    def filter(self, obs):
+        """
+        Filter the next observations of the sequence, continuing from the previous call
+        Input:
+            obs.shape = (batch_size, Dy) for one observation, or (batch_size, n_obs, Dy) for a chunk of them.
+            The first call after reset needs at least n_init_obs observations
+        Output:
+            means: filtered means, shape (batch_size, n_obs, Dx)
+            log_increments: log p(y_t | y_0:t-1) estimates, shape (batch_size, n_obs)
+        """
+        outputs = self.filter_steps(obs)
+        means = np.stack([output["mean"] for output in outputs], axis=1)
+        log_increments = np.stack([output["log_increment"] for output in outputs], axis=1)
+        return means, log_increments
+
+    def filter_steps(self, obs):
+        """
+        Input:
+            obs.shape = (batch_size, Dy) or (batch_size, n_obs, Dy), as in filter
+        Output:
+            list of the outputs of each step (see get_step_outputs), of length n_obs
+        """
+        if self.sess is None:
+            raise ValueError("restore a checkpoint before filtering")
+
+        obs = np.asarray(obs)
+        if obs.ndim == 2:
+            obs = obs[:, None]
+
+        outputs = []
+        start = 0
+        if self.state is None:
+            if obs.shape[1] < self.n_init_obs:
+                raise ValueError("the first {} observations are needed to initialize the filter, {} are given"
+                                 .format(self.n_init_obs, obs.shape[1]))
+            outputs.append(self.sess.run(self.init_outputs, feed_dict={self.init_obs: obs[:, :self.n_init_obs]}))
+            start = 1
+
+        for t in range(start, obs.shape[1]):
+            X_ancestor_tm1, log_normalized_W_tm1 = self.state if not outputs else \
+                (outputs[-1]["X_ancestor"], outputs[-1]["log_normalized_W"])
+            outputs.append(self.sess.run(self.step_outputs,
+                                         feed_dict={self.obs_t:                obs[:, t],
+                                                    self.X_ancestor_tm1:       X_ancestor_tm1,
+                                                    self.log_normalized_W_tm1: log_normalized_W_tm1}))
+
+        self.state = (outputs[-1]["X_ancestor"], outputs[-1]["log_normalized_W"])
+        self.n_filtered += obs.shape[1]
+        return outputs
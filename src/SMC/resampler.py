@@ -0,0 +1,78 @@
+import tensorflow as tf
+
+
+def multinomial_uniforms(batch_size, n_samples):
+    # independent u^i ~ U[0, 1)
+    return tf.random.uniform((batch_size, n_samples))
+
+
+def stratified_uniforms(batch_size, n_samples):
+    # one u^i ~ U[i / n, (i + 1) / n) in each of the n strata
+    return (tf.range(n_samples, dtype=tf.float32) + tf.random.uniform((batch_size, n_samples))) / n_samples
+
+
+def systematic_uniforms(batch_size, n_samples):
+    # u^i = (i + u) / n with a single u ~ U[0, 1) shared by all strata
+    return (tf.range(n_samples, dtype=tf.float32) + tf.random.uniform((batch_size, 1))) / n_samples
+
+
+def inverse_cdf(W, u):
+    """
+    idx^i = min{k : W^1 + ... + W^k > u^i}, found by a binary search over the cumulative weights
+    Input:
+        W.shape = (batch_size, n_particles), normalized
+        u.shape = (batch_size, n_samples)
+    Output:
+        idx.shape = (batch_size, n_samples)
+    """
+    n_particles = W.shape.as_list()[-1]
+    idx = tf.searchsorted(tf.cumsum(W, axis=-1), u, side="right")
+
+    # the cumsum may end slightly below 1 due to round-off
+    return tf.minimum(idx, n_particles - 1)
+
+
+def residual_resample(W, n_samples):
+    """
+    Keep floor(n * W^k) copies of particle k, and draw the remaining samples multinomially from the residual weights
+    """
+    batch_size, n_particles = W.shape.as_list()
+    n_copies = tf.floor(n_samples * W)                                  # (batch_size, n_particles)
+    n_deterministic = tf.reduce_sum(n_copies, axis=-1, keepdims=True)  # (batch_size, 1)
+
+    # sample i is the particle whose block of copies covers position i
+    positions = tf.tile(tf.range(n_samples, dtype=tf.float32)[None], (batch_size, 1))
+    deterministic_idx = tf.minimum(tf.searchsorted(tf.cumsum(n_copies, axis=-1), positions, side="right"),
+                                   n_particles - 1)
+
+    residual_W = n_samples * W - n_copies
+    residual_W = residual_W / tf.reduce_sum(residual_W, axis=-1, keepdims=True)
+    residual_idx = inverse_cdf(residual_W, multinomial_uniforms(batch_size, n_samples))
+
+    return tf.where(positions < n_deterministic, deterministic_idx, residual_idx)
+
+
+resample_uniforms = {"multinomial": multinomial_uniforms,
+                     "stratified": stratified_uniforms,
+                     "systematic": systematic_uniforms}
+resample_schemes = list(resample_uniforms.keys()) + ["residual"]
+
+
+def resample(log_W, n_samples, scheme="multinomial"):
+    """
+    Draw ancestor indices along the last axis of log_W
+    Except for multinomial, the indices of each batch are sorted, so the samples are not exchangeable
+    Input:
+        log_W.shape = (batch_size, n_particles), need not be normalized
+        n_samples: int
+        scheme: one of resample_schemes
+    Output:
+        idx.shape = (batch_size, n_samples), int32
+    """
+    W = tf.nn.softmax(log_W, axis=-1)
+    batch_size = log_W.shape.as_list()[0]
+
+    if scheme == "residual":
+        return residual_resample(W, n_samples)
+
+    return inverse_cdf(W, resample_uniforms[scheme](batch_size, n_samples))
@@ -0,0 +1,142 @@
+import numpy as np
+import tensorflow as tf
+from tensorflow_probability import distributions as tfd
+
+from SMC.SVO import SVO
+
+batch_size, Dx = 3, 2
+
+
+def make_SVO(**attributes):
+    # SVO with only the attributes the tested methods use, without building a model
+    svo = SVO.__new__(SVO)
+    svo.validate_args = True
+    for name, value in attributes.items():
+        setattr(svo, name, value)
+    return svo
+
+
+def random_covariance(rng):
+    # shape = (batch_size, Dx, Dx)
+    A = rng.randn(batch_size, Dx, Dx)
+    return A @ np.swapaxes(A, -1, -2) + 0.5 * np.eye(Dx)
+
+
+def test_sample_from_precision():
+    # N(P^-1 b, P^-1) against MultivariateNormalFullCovariance
+    rng = np.random.RandomState(0)
+    precision, precision_mean = random_covariance(rng), rng.randn(batch_size, Dx)
+    cov = np.linalg.inv(precision)
+    mean = (cov @ precision_mean[..., None])[..., 0]
+
+    n_samples = 20000
+    with tf.Graph().as_default():
+        X, log_prob = SVO.sample_from_precision(tf.constant(precision, dtype=tf.float32),
+                                                tf.constant(precision_mean, dtype=tf.float32),
+                                                sample_size=n_samples)
+        X_1, log_prob_1 = SVO.sample_from_precision(tf.constant(precision, dtype=tf.float32),
+                                                    tf.constant(precision_mean, dtype=tf.float32))
+        mvn = tfd.MultivariateNormalFullCovariance(tf.constant(mean, dtype=tf.float32),
+                                                   tf.constant(cov, dtype=tf.float32))
+        with tf.Session() as sess:
+            X, log_prob, mvn_log_prob, X_1, log_prob_1, mvn_log_prob_1 = \
+                sess.run([X, log_prob, mvn.log_prob(X), X_1, log_prob_1, mvn.log_prob(X_1)])
+
+    assert X.shape == (n_samples, batch_size, Dx) and log_prob.shape == (n_samples, batch_size)
+    assert X_1.shape == (batch_size, Dx) and log_prob_1.shape == (batch_size,)
+    np.testing.assert_allclose(log_prob, mvn_log_prob, rtol=1e-4, atol=1e-4)
+    np.testing.assert_allclose(log_prob_1, mvn_log_prob_1, rtol=1e-4, atol=1e-4)
+
+    # sample moments, within several standard errors
+    np.testing.assert_allclose(X.mean(axis=0), mean, atol=5 * np.sqrt(cov.diagonal(axis1=-2, axis2=-1).max() / n_samples))
+    X_centered = X - X.mean(axis=0)
+    sample_cov = np.einsum("sbi,sbj->bij", X_centered, X_centered) / n_samples
+    np.testing.assert_allclose(sample_cov, cov, atol=0.1 * np.abs(cov).max())
+
+
+def test_sample_from_product():
+    # the product of two full covariance Gaussians, against its closed form
+    rng = np.random.RandomState(1)
+    means, covs = [rng.randn(batch_size, Dx) for _ in range(2)], [random_covariance(rng) for _ in range(2)]
+    precisions = [np.linalg.inv(cov) for cov in covs]
+    cov = np.linalg.inv(precisions[0] + precisions[1])
+    mean = (cov @ (precisions[0] @ means[0][..., None] + precisions[1] @ means[1][..., None]))[..., 0]
+
+    with tf.Graph().as_default():
+        d1_mvn, d2_mvn = [tfd.MultivariateNormalFullCovariance(tf.constant(mean_i, dtype=tf.float32),
+                                                               tf.constant(cov_i, dtype=tf.float32))
+                          for mean_i, cov_i in zip(means, covs)]
+        precision = SVO.get_precision(d1_mvn)
+        X, q_log_prob, f_log_prob = make_SVO().sample_from_product(d1_mvn, d2_mvn, sample_size=5)
+        mvn = tfd.MultivariateNormalFullCovariance(tf.constant(mean, dtype=tf.float32),
+                                                   tf.constant(cov, dtype=tf.float32))
+        with tf.Session() as sess:
+            precision, q_log_prob, mvn_log_prob, f_log_prob, d1_log_prob = \
+                sess.run([precision, q_log_prob, mvn.log_prob(X), f_log_prob, d1_mvn.log_prob(X)])
+
+    np.testing.assert_allclose(precision, precisions[0], rtol=1e-4, atol=1e-4)
+    np.testing.assert_allclose(q_log_prob, mvn_log_prob, rtol=1e-4, atol=1e-4)
+    np.testing.assert_allclose(f_log_prob, d1_log_prob, rtol=1e-5)
+
+
+def test_adaptive_resampling():
+    # batches whose ESS is below ESS_threshold * n_particles are resampled, the others are kept
+    n_particles = 6
+    svo = make_SVO(resample_particles=True, use_adaptive_resampling=True, ESS_threshold=0.5,
+                   resample_scheme="systematic")
+    X = np.random.randn(n_particles, batch_size, Dx).astype(np.float32)
+    identity_idx = np.tile(np.arange(n_particles)[:, None], (1, batch_size))
+
+    # batch 0: uniform weights, ESS = 6. batch 1: one particle has all the weight, ESS = 1. batch 2: ESS about 4.5
+    log_Ws = {"one resampled": np.stack([np.zeros(n_particles), [30.0, 0, 0, 0, 0, 0], np.log([1, 1, 1, 1, 2, 3])],
+                                        axis=-1).astype(np.float32),
+              "none resampled": np.zeros((n_particles, batch_size), dtype=np.float32)}
+
+    with tf.Graph().as_default():
+        outputs = {key: svo.resample_and_normalize(tf.constant(X), tf.constant(log_W))
+                   for key, log_W in log_Ws.items()}
+        with tf.Session() as sess:
+            outputs = sess.run(outputs)
+
+    for key, log_W in log_Ws.items():
+        X_ancestor, ancestor_idx, log_normalized_W, ESS = outputs[key]
+        normalized_W = np.exp(log_W) / np.sum(np.exp(log_W), axis=0)
+        np.testing.assert_allclose(ESS, 1 / np.sum(normalized_W ** 2, axis=0), rtol=1e-5)
+
+        kept = [0, 2] if key == "one resampled" else [0, 1, 2]
+        np.testing.assert_array_equal(X_ancestor[:, kept], X[:, kept])
+        np.testing.assert_array_equal(ancestor_idx[:, kept], identity_idx[:, kept])
+        np.testing.assert_allclose(np.exp(log_normalized_W[:, kept]), normalized_W[:, kept], rtol=1e-5)
+
+    # the resampled batch copies the particle that has all the weight, which then have uniform weights
+    X_ancestor, ancestor_idx, log_normalized_W, _ = outputs["one resampled"]
+    np.testing.assert_array_equal(ancestor_idx[:, 1], np.zeros(n_particles))
+    np.testing.assert_array_equal(X_ancestor[:, 1], np.tile(X[0, 1], (n_particles, 1)))
+    np.testing.assert_allclose(np.exp(log_normalized_W[:, 1]), np.full(n_particles, 1 / n_particles), rtol=1e-5)
+
+
+def test_count_unique_ancestors():
+    # against tracing the genealogy back in numpy and counting it with np.unique
+    time, n_particles = 7, 5
+    rng = np.random.RandomState(2)
+    # the ancestors of some steps are drawn among a few particles, so that paths collapse
+    ancestor_idxs = np.stack([rng.randint(0, n_particles if t % 3 else 2, size=(n_particles, batch_size))
+                              for t in range(time)])
+
+    genealogy = np.zeros((time, n_particles, batch_size), dtype=int)
+    genealogy[-1] = np.arange(n_particles)[:, None]
+    for t in reversed(range(time - 1)):
+        for b in range(batch_size):
+            genealogy[t, :, b] = ancestor_idxs[t, genealogy[t + 1, :, b], b]
+    n_unique_ancestors = np.array([[len(np.unique(genealogy[t, :, b])) for b in range(batch_size)]
+                                   for t in range(time)])
+
+    with tf.Graph().as_default():
+        ancestor_idxs = tf.constant(ancestor_idxs, dtype=tf.int32)
+        outputs = [SVO.trace_genealogy(ancestor_idxs), make_SVO().count_unique_ancestors(ancestor_idxs)]
+        with tf.Session() as sess:
+            tf_genealogy, tf_n_unique_ancestors = sess.run(outputs)
+
+    np.testing.assert_array_equal(tf_genealogy, genealogy)
+    np.testing.assert_array_equal(tf_n_unique_ancestors, n_unique_ancestors)
+    assert n_unique_ancestors.min() < n_unique_ancestors.max()
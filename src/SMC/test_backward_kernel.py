@@ -0,0 +1,71 @@
+import numpy as np
+import tensorflow as tf
+
+from SMC.backward_kernel import log_predictive, chunked_log_predictive
+from distribution.mvn import tf_mvn
+from transformation.linear import tf_linear_transformation
+
+n_particles, batch_size, Dx = 7, 2, 3
+# backward particles have leading axes (M, n_particles), as the proposals of PSVO
+X_t_shape = (2, 5, batch_size, Dx)
+
+
+def build_inputs():
+    A = tf.Variable(np.eye(Dx) + 0.3 * np.random.randn(Dx, Dx), dtype=tf.float32, name="A")
+    f = tf_mvn(tf_linear_transformation(A), sigma_init=0.5, sigma_min=0.1, name="f")
+    X_t = tf.Variable(np.random.randn(*X_t_shape), dtype=tf.float32, name="X_t")
+    X_tm1 = tf.Variable(np.random.randn(n_particles, batch_size, Dx), dtype=tf.float32, name="X_tm1")
+    logits = tf.Variable(np.random.randn(n_particles, batch_size), dtype=tf.float32, name="logits")
+    log_W_tm1 = logits - tf.reduce_logsumexp(logits, axis=0)
+    return f, X_t, X_tm1, log_W_tm1
+
+
+def evaluate(log_W_ts):
+    # values of each log_W_t and its gradients to all variables, for a random weighting of its entries
+    variables = tf.trainable_variables()
+    fetches = []
+    for log_W_t in log_W_ts:
+        objective = tf.reduce_sum(log_W_t * tf.constant(np.random.RandomState(0).rand(*X_t_shape[:-1]),
+                                                        dtype=tf.float32))
+        fetches.append([log_W_t] + tf.gradients(objective, variables))
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        return sess.run(fetches)
+
+
+def assert_all_close(rslts):
+    tiled = rslts[0]
+    for rslt in rslts[1:]:
+        assert len(rslt) == len(tiled)
+        for value, tiled_value in zip(rslt, tiled):
+            np.testing.assert_allclose(value, tiled_value, rtol=1e-4, atol=1e-4)
+
+
+def test_chunked_matches_tiled():
+    # the custom gradient of the diagonal Gaussian kernel and the generic blocks, with and without padding,
+    # against the tiled evaluation
+    with tf.Graph().as_default():
+        f, X_t, X_tm1, log_W_tm1 = build_inputs()
+        log_W_ts = [log_predictive(f, X_t, X_tm1, log_W_tm1, chunk_size=0)]
+        for chunk_size in [1, 3, 7]:
+            log_W_ts.append(log_predictive(f, X_t, X_tm1, log_W_tm1, chunk_size=chunk_size))
+        log_W_ts.append(chunked_log_predictive(f, X_t, X_tm1, log_W_tm1, chunk_size=3))
+
+        assert_all_close(evaluate(log_W_ts))
+
+
+def test_chunked_matches_tiled_in_while_loop():
+    # PSVO evaluates the kernel in the while loop of backward simulation
+    with tf.Graph().as_default():
+        f, X_t, X_tm1, log_W_tm1 = build_inputs()
+
+        def in_while_loop(chunk_size):
+            def while_body(i, log_W_t):
+                return i + 1, log_W_t + log_predictive(f, X_t * tf.cast(i, tf.float32), X_tm1, log_W_tm1, chunk_size)
+
+            _, log_W_t = tf.while_loop(lambda i, *unused_args: i < 3, while_body,
+                                       (1, tf.zeros(X_t_shape[:-1])))
+            return log_W_t
+
+        assert_all_close(evaluate([in_while_loop(0), in_while_loop(3)]))
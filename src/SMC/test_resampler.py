@@ -0,0 +1,57 @@
+import numpy as np
+import tensorflow as tf
+
+from SMC.resampler import resample, resample_schemes
+
+# the same weights in every batch, so that the batches are independent draws of the counts.
+# n_samples * W has no integer entry, whose floor would depend on the round-off of the softmax
+n_particles, n_samples, n_draws = 5, 10, 4000
+W = np.array([0.05, 0.37, 0.03, 0.33, 0.22])
+
+
+def draw_counts(scheme):
+    # counts[b, k]: number of copies of particle k in draw b
+    log_W = tf.constant(np.tile(np.log(W), (n_draws, 1)), dtype=tf.float32)
+    with tf.Session() as sess:
+        idx = sess.run(resample(log_W, n_samples, scheme))
+
+    assert idx.shape == (n_draws, n_samples)
+    assert idx.min() >= 0 and idx.max() < n_particles
+    counts = np.stack([np.sum(idx == k, axis=-1) for k in range(n_particles)], axis=-1)
+    return idx, counts
+
+
+def test_counts_are_unbiased():
+    # E[count^k] = n_samples * W^k for every scheme
+    for scheme in resample_schemes:
+        _, counts = draw_counts(scheme)
+        stderr = np.sqrt(n_samples * W * (1 - W) / n_draws)
+        assert np.all(np.abs(counts.mean(axis=0) - n_samples * W) < 5 * stderr + 1e-3), scheme
+
+
+def test_low_variance_schemes():
+    expected = n_samples * W
+
+    # systematic: count^k is floor or ceil of n_samples * W^k
+    _, counts = draw_counts("systematic")
+    assert np.all((counts == np.floor(expected)) | (counts == np.ceil(expected)))
+
+    # stratified: each stratum gives at most one copy more or less than expected, per particle
+    _, counts = draw_counts("stratified")
+    assert np.all(np.abs(counts - expected) < 2)
+
+    # residual: at least floor(n_samples * W^k) copies are kept deterministically
+    _, counts = draw_counts("residual")
+    assert np.all(counts >= np.floor(expected))
+
+    # all of them vary less than multinomial
+    multinomial_var = draw_counts("multinomial")[1].var(axis=0).sum()
+    for scheme in ["systematic", "stratified", "residual"]:
+        assert draw_counts(scheme)[1].var(axis=0).sum() < multinomial_var, scheme
+
+
+def test_sorted_indices():
+    # except for multinomial, the indices of each batch are sorted
+    for scheme in ["systematic", "stratified"]:
+        idx, _ = draw_counts(scheme)
+        assert np.all(np.diff(idx, axis=-1) >= 0), scheme
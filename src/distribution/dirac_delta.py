@@ -10,4 +10,7 @@ class dirac_delta(distribution):
 		self.transformation = transformation
 
 	def sample(self, Input):
-		return self.transformation.transform(Input)
\ No newline at end of file
+		return self.transformation.transform(Input)
+
+	def batch_sample(self, Input):
+		return self.transformation.batch_transform(Input)
@@ -1,3 +1,5 @@
+from contextlib import contextmanager
+
 import numpy as np
 import tensorflow as tf
 from tensorflow_probability import distributions as tfd
@@ -18,6 +20,41 @@ class mvn(distribution):
         mu = self.transformation.transform(Input)
         return mu + np.dot(self.sigmaChol, np.random.randn(len(mu)))
 
+    def batch_sample(self, Input, noise=None):
+        """
+        sample for all Input of Input.shape = [B0, B1, ..., Bn, Dx] at once
+        noise: standard normal of the shape of the samples, drawn here if not given
+        """
+        mu = self.transformation.batch_transform(Input)
+        if noise is None:
+            noise = np.random.randn(*mu.shape)
+        return mu + np.dot(noise, self.sigmaChol.T)
+
+
+def get_dist_cache():
+    # distributions built in the default graph, stored on the graph so that they go with it
+    graph = tf.get_default_graph()
+    if not hasattr(graph, "dist_cache"):
+        graph.dist_cache = {}
+    return graph.dist_cache
+
+
+@contextmanager
+def dist_cache_scope():
+    """
+    Ops built in a while loop body or a cond branch can't be used outside of it, and the other way around,
+    so a tf.while_loop, tf.cond or tf.map_fn in which distributions are built is built in this scope:
+    the distributions cached before are hidden while building it, and the ones it builds are forgotten after
+    """
+    cache = get_dist_cache()
+    outer_cache = dict(cache)
+    cache.clear()
+    try:
+        yield
+    finally:
+        cache.clear()
+        cache.update(outer_cache)
+
 
 # tf ver, used in calculate log_ZSMC
 class tf_mvn(distribution):
@@ -25,17 +62,40 @@ class tf_mvn(distribution):
 
     def __init__(self, transformation,
                  sigma_init=5, sigma_min=1,
+                 validate_args=True,
+                 use_cache=True,
                  name='tf_mvn'):
         self.transformation = transformation
         self.sigma_init = sigma_init
         self.sigma_min = sigma_min
+        self.validate_args = validate_args
         self.name = name
 
+        # reuse distributions already built for the same Input, see get_dist_cache and dist_cache_scope
+        self.use_cache = use_cache
+        # number of get_mvn calls that reused a distribution of the graph, and that built a new one
+        self.n_graph_reuses = 0
+        self.n_graph_builds = 0
+
     def get_mvn(self, Input):
+        # the same Input is often evaluated more than once in a step, e.g. by q1 and f when they share the network,
+        # so reuse the distribution built for it instead of running the transformation again
+        if self.use_cache and isinstance(Input, tf.Tensor):
+            cache = get_dist_cache()
+            cache_key = (self, Input)
+            if cache_key in cache:
+                self.n_graph_reuses += 1
+                return cache[cache_key]
+            self.n_graph_builds += 1
+
         if isinstance(self.transformation, NF):
             dist = self.get_mvn_from_flow(Input)
         else:
             dist = self.get_mvn_from_transformation(Input)
+
+        if self.use_cache and isinstance(Input, tf.Tensor):
+            cache[cache_key] = dist
+
         return dist
 
     def get_mvn_from_flow(self, Input):
@@ -43,7 +103,7 @@ class tf_mvn(distribution):
             assert Input.shape.as_list()[-1] == self.transformation.event_size
             sigma = self.get_sigma(Input)
             dist = tfd.MultivariateNormalDiag(Input, sigma,
-                                              validate_args=True,
+                                              validate_args=self.validate_args,
                                               allow_nan_stats=False)
             dist = self.transformation.transform(dist)
             return dist
@@ -61,18 +121,18 @@ class tf_mvn(distribution):
 
             if sigma is None:
                 mvn = tfd.MultivariateNormalDiag(mu, sigma_con,
-                                                 validate_args=True,
+                                                 validate_args=self.validate_args,
                                                  allow_nan_stats=False)
             else:
                 if len(sigma.shape.as_list()) == len(mu.shape.as_list()):
                     sigma = sigma_con + 0.1 * sigma
                     mvn = tfd.MultivariateNormalDiag(mu, sigma,
-                                                     validate_args=True,
+                                                     validate_args=self.validate_args,
                                                      allow_nan_stats=False)
                 else:
                     sigma = tf.diag(sigma_con) + 0.1 * sigma
                     mvn = tfd.MultivariateNormalFullCovariance(mu, sigma,
-                                                               validate_args=True,
+                                                               validate_args=self.validate_args,
                                                                allow_nan_stats=False)
 
             return mvn
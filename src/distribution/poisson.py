@@ -22,12 +22,22 @@ class poisson(distribution):
         lambdas = safe_softplus(self.transformation.transform(Input))
         return np.random.poisson(lambdas)
 
+    def batch_sample(self, Input):
+        # sample for all Input of Input.shape = [B0, B1, ..., Bn, Dx] at once
+        def safe_softplus(x, limit=30):
+            x[x < limit] = np.log(1.0 + np.exp(x[x < limit]))
+            return x
+
+        lambdas = safe_softplus(self.transformation.batch_transform(Input))
+        return np.random.poisson(lambdas)
+
 
 class tf_poisson(distribution):
     # multivariate poisson distribution, can only be used as emission distribution
 
-    def __init__(self, transformation, name='tf_poisson'):
+    def __init__(self, transformation, validate_args=True, name='tf_poisson'):
         self.transformation = transformation
+        self.validate_args = validate_args
         self.name = name
 
     def get_poisson(self, Input):
@@ -35,7 +45,7 @@ class tf_poisson(distribution):
             lambdas, _ = self.transformation.transform(Input)
             lambdas = tf.nn.softplus(lambdas) + 1e-6
             poisson = tfd.MultivariateNormalDiag(lambdas,
-                                                 validate_args=True,
+                                                 validate_args=self.validate_args,
                                                  allow_nan_stats=False)
             return poisson
 
@@ -0,0 +1,167 @@
+import os
+import sys
+
+import tensorflow as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
+from tensorflow.python.grappler import tf_optimizer
+
+from model import SSM
+from SMC.SVO import SVO
+from SMC.PSVO import PSVO
+from SMC.PSVOwR import PSVOwR
+from SMC.IWAE import IWAE
+from SMC.AESMC import AESMC
+
+from distribution.mvn import dist_cache_scope
+
+from rslts_saving.rslts_saving import load_experiment_param
+from utils.checkpoint import restore_model_variables
+
+
+def build_inference_graph(FLAGS, time, n_steps, batch_size):
+    """
+    Inference graph of a trained model, with a flexible batch dimension:
+        input "obs": shape (None, time, Dy)
+        output "Xs": smoothed trajectories (filtered ones for AESMC and IWAE), shape (None, time, n_particles, Dx)
+        outputs "y_hat_k" for k = 0, ..., n_steps: k-step predictions of obs[:, k:], shape (None, time - k, Dy)
+    The SMC objectives need a static batch size, so the objective is built for batches of batch_size,
+    and mapped over chunks of obs padded to a multiple of it
+    """
+    # the model reads these flags when it is built, they are set back after so that the caller's FLAGS are unchanged,
+    # and inference doesn't need the asserts of argument checks
+    inference_flags = {"batch_size": batch_size, "time": time, "validate_args": False}
+    saved_flags = {name: getattr(FLAGS, name) for name in inference_flags}
+    for name, value in inference_flags.items():
+        setattr(FLAGS, name, value)
+
+    try:
+        # created before the placeholders of SSM, so that it gets the name "obs"
+        obs = tf.placeholder(tf.float32, shape=(None, time, FLAGS.Dy), name="obs")
+
+        SSM_model = SSM(FLAGS)
+        if FLAGS.PSVO:
+            SMC = PSVO(SSM_model, FLAGS)
+        elif FLAGS.PSVOwR:
+            SMC = PSVOwR(SSM_model, FLAGS)
+        elif FLAGS.SVO:
+            SMC = SVO(SSM_model, FLAGS)
+        elif FLAGS.AESMC:
+            SMC = AESMC(SSM_model, FLAGS)
+        elif FLAGS.IWAE:
+            SMC = IWAE(SSM_model, FLAGS)
+        else:
+            raise ValueError("Choose one of objectives among: PSVO, SVO, AESMC, IWAE")
+
+        # the variables are created outside of map_fn, whose while loop can't create them
+        SMC.get_log_ZSMC(SSM_model.obs, SSM_model.hidden)
+
+        with tf.name_scope("chunks"):
+            n_obs = tf.shape(obs)[0]
+            n_chunks = (n_obs + batch_size - 1) // batch_size
+            padded_obs = tf.pad(obs, [[0, n_chunks * batch_size - n_obs], [0, 0], [0, 0]])
+            obs_chunks = tf.reshape(padded_obs, (n_chunks, batch_size, time, FLAGS.Dy))
+
+        hidden = tf.zeros((batch_size, time, FLAGS.Dx))
+
+        def infer(obs_chunk):
+            _, log = SMC.get_log_ZSMC(obs_chunk, hidden)
+            y_hat_N_BxTxDy, _ = SMC.n_step_prediction(n_steps, log["Xs"], obs_chunk)
+            return [log["Xs"]] + y_hat_N_BxTxDy
+
+        with dist_cache_scope():
+            outputs = tf.map_fn(infer, obs_chunks, dtype=[tf.float32] * (n_steps + 2))
+
+        # merge the chunks and remove the padding
+        outputs = [tf.reshape(output, [-1] + output.shape.as_list()[2:])[:n_obs] for output in outputs]
+
+        outputs_dict = {"Xs": tf.identity(outputs[0], name="Xs")}
+        for k, y_hat in enumerate(outputs[1:]):
+            outputs_dict["y_hat_{}".format(k)] = tf.identity(y_hat, name="y_hat_{}".format(k))
+
+        return {"obs": obs}, outputs_dict
+    finally:
+        for name, value in saved_flags.items():
+            setattr(FLAGS, name, value)
+
+
+def optimize_graph_def(graph_def, output_names):
+    # fold constants and simplify arithmetic of the frozen graph with grappler, keeping the outputs
+    # without the collections of the default graph, e.g. the train_op of the trainer
+    meta_graph = tf.train.export_meta_graph(graph_def=graph_def, collection_list=[])
+    meta_graph.collection_def["train_op"].node_list.value.extend(output_names)
+
+    config = tf.ConfigProto()
+    rewrite_options = config.graph_options.rewrite_options
+    rewrite_options.optimizers.extend(["constfold", "arithmetic", "dependency", "loop"])
+    rewrite_options.min_graph_nodes = -1
+    rewrite_options.meta_optimizer_iterations = rewriter_config_pb2.RewriterConfig.TWO
+
+    return tf_optimizer.OptimizeGraph(config, meta_graph)
+
+
+def export_inference_graph(RLT_DIR, export_dir, FLAGS, time=None, n_steps=None, batch_size=None):
+    """
+    Export the model trained in RLT_DIR (its param.json and the latest checkpoint in RLT_DIR/model/)
+    for inference only, without optimizer slots, argument asserts or training placeholders, to
+        export_dir/frozen_graph.pb: GraphDef with the variables frozen into constants, see load_frozen_graph
+        export_dir/saved_model/: SavedModel of the same graph, with the "serving_default" signature
+    time: length of the sequences to infer, default to the one of training
+    n_steps: number of k-step predictions, default to MSE_steps of training
+    batch_size: size of the chunks obs is inferred in, default to the one of training.
+        Requests are padded to a multiple of it, so it should be close to their typical size
+    """
+    load_experiment_param(RLT_DIR, FLAGS)
+    time = time or FLAGS.time
+    n_steps = min(n_steps or FLAGS.MSE_steps, time - 1)
+    batch_size = batch_size or FLAGS.batch_size
+
+    graph = tf.Graph()
+    with graph.as_default():
+        inputs, outputs = build_inference_graph(FLAGS, time, n_steps, batch_size)
+        output_names = [output.op.name for output in outputs.values()]
+
+        with tf.Session() as sess:
+            restore_model_variables(sess, tf.global_variables(), RLT_DIR + "model/")
+            graph_def = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), output_names)
+
+    graph_def = tf.graph_util.extract_sub_graph(graph_def, output_names)
+    graph_def = optimize_graph_def(graph_def, output_names)
+
+    if not os.path.exists(export_dir):
+        os.makedirs(export_dir)
+    with tf.gfile.GFile(os.path.join(export_dir, "frozen_graph.pb"), "wb") as f:
+        f.write(graph_def.SerializeToString())
+
+    frozen_graph = load_frozen_graph(os.path.join(export_dir, "frozen_graph.pb"))
+    with tf.Session(graph=frozen_graph) as sess:
+        signature = tf.saved_model.signature_def_utils.predict_signature_def(
+            inputs={name: frozen_graph.get_tensor_by_name(tensor.name) for name, tensor in inputs.items()},
+            outputs={name: frozen_graph.get_tensor_by_name(tensor.name) for name, tensor in outputs.items()})
+        builder = tf.saved_model.builder.SavedModelBuilder(os.path.join(export_dir, "saved_model"))
+        builder.add_meta_graph_and_variables(sess, [tf.saved_model.tag_constants.SERVING],
+                                             signature_def_map={"serving_default": signature})
+        builder.save()
+
+    print("exported {} to {}".format(RLT_DIR, export_dir))
+
+
+def load_frozen_graph(path):
+    """
+    Graph of export_dir/frozen_graph.pb, whose input is "obs:0" and outputs "Xs:0" and "y_hat_k:0"
+    """
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(path, "rb") as f:
+        graph_def.ParseFromString(f.read())
+
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name="")
+    return graph
+
+
+if __name__ == "__main__":
+    # python export.py path/to/RLT_DIR/ path/to/export_dir [time] [n_steps] [batch_size]
+    from runner_flag import FLAGS
+    FLAGS(sys.argv[:1])
+    time, n_steps, batch_size = [int(arg) for arg in sys.argv[3:6]] + [None] * (6 - max(len(sys.argv), 3))
+    export_inference_graph(sys.argv[1], sys.argv[2], FLAGS, time=time, n_steps=n_steps, batch_size=batch_size)
@@ -50,6 +50,9 @@ class SSM(object):
         self.X0_use_separate_RNN       = FLAGS.X0_use_separate_RNN
         self.use_stack_rnn             = FLAGS.use_stack_rnn
 
+        self.validate_args             = FLAGS.validate_args
+        self.use_dist_cache            = FLAGS.use_dist_cache
+
         self.PSVO                      = FLAGS.PSVO
         self.PSVOwR                    = FLAGS.PSVOwR
         self.SVO                       = FLAGS.SVO
@@ -113,16 +116,22 @@ class SSM(object):
         self.q0_dist = tf_mvn(self.q0_tran,
                               sigma_init=self.q0_sigma_init,
                               sigma_min=self.q0_sigma_min,
+                              validate_args=self.validate_args,
+                              use_cache=self.use_dist_cache,
                               name="q0_dist")
 
         self.q1_dist = tf_mvn(self.q1_tran,
                               sigma_init=self.q1_sigma_init,
                               sigma_min=self.q1_sigma_min,
+                              validate_args=self.validate_args,
+                              use_cache=self.use_dist_cache,
                               name="q1_dist")
         if self.use_2_q:
             self.q2_dist = tf_mvn(self.q2_tran,
                                   sigma_init=self.q2_sigma_init,
                                   sigma_min=self.q2_sigma_min,
+                                  validate_args=self.validate_args,
+                                  use_cache=self.use_dist_cache,
                                   name="q2_dist")
         else:
             self.q2_dist = None
@@ -131,15 +140,21 @@ class SSM(object):
             self.Bsim_q_init_dist = tf_mvn(self.BSim_q_init_tran,
                                            sigma_init=self.q0_sigma_init,
                                            sigma_min=self.q0_sigma_min,
+                                           validate_args=self.validate_args,
+                                           use_cache=self.use_dist_cache,
                                            name="BSim_q_init_dist")
 
             self.q1_inv_dist = tf_mvn(self.q1_inv_tran,
                                       sigma_init=self.q1_sigma_init,
                                       sigma_min=self.q1_sigma_min,
+                                      validate_args=self.validate_args,
+                                      use_cache=self.use_dist_cache,
                                       name="q1_inv_dist")
             self.BSim_q2_dist = tf_mvn(self.BSim_q2_tran,
                                        sigma_init=self.q2_sigma_init,
                                        sigma_min=self.q2_sigma_min,
+                                       validate_args=self.validate_args,
+                                       use_cache=self.use_dist_cache,
                                        name="BSim_q2_dist")
 
         if self.use_bootstrap:
@@ -148,15 +163,20 @@ class SSM(object):
             self.f_dist = tf_mvn(self.f_tran,
                                  sigma_init=self.f_sigma_init,
                                  sigma_min=self.f_sigma_min,
+                                 validate_args=self.validate_args,
+                                 use_cache=self.use_dist_cache,
                                  name="f_dist")
 
         if self.poisson_emission:
             self.g_dist = tf_poisson(self.g_tran,
+                                     validate_args=self.validate_args,
                                      name="g_dist")
         else:
             self.g_dist = tf_mvn(self.g_tran,
                                  sigma_init=self.g_sigma_init,
                                  sigma_min=self.g_sigma_min,
+                                 validate_args=self.validate_args,
+                                 use_cache=self.use_dist_cache,
                                  name="g_dist")
 
     def init_RNNs(self):
@@ -47,6 +47,17 @@ def save_experiment_param(RLT_DIR, FLAGS):
         json.dump(params_dict, f, indent=4, cls=NumpyEncoder)
 
 
+def load_experiment_param(RLT_DIR, FLAGS):
+    # set FLAGS to the values save_experiment_param saved in RLT_DIR, e.g. to rebuild a trained model
+    with open(RLT_DIR + "param.json", "r") as f:
+        params_dict = json.load(f)
+
+    # values were saved as str, so only flags that differ from their current value are parsed again
+    for param, value in params_dict.items():
+        if param in FLAGS and value != str(FLAGS[param].value):
+            FLAGS[param].parse(value)
+
+
 class NumpyEncoder(json.JSONEncoder):
     # Special json encoder for numpy types
     def default(self, obj):
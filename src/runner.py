@@ -25,7 +25,9 @@ from rslts_saving.fhn_rslts_saving import *
 from rslts_saving.lorenz_rslts_saving import *
 
 from utils.data_generator import generate_dataset
-from utils.data_loader import load_data
+from utils.data_loader import load_data, is_variable_length
+from utils.profiling import graph_build_profiler
+from export import export_inference_graph
 
 
 def main(_):
@@ -44,7 +46,7 @@ def main(_):
     # ============================================= dataset part ============================================= #
     # generate data from simulation
     if FLAGS.generateTrainingData:
-        model = "fhn"
+        model = "lorenz" if Dx == 3 else "fhn"
         hidden_train, hidden_test, obs_train, obs_test  = \
             generate_dataset(FLAGS.n_train, FLAGS.n_test, FLAGS.time, model=model, Dy=FLAGS.Dy, lb=-2.5, ub=2.5)
 
@@ -54,6 +56,15 @@ def main(_):
             load_data(FLAGS.datadir + FLAGS.datadict, Dx, FLAGS.isPython2, FLAGS.q_uses_true_X)
         FLAGS.n_train, FLAGS.n_test, FLAGS.time = obs_train.shape[0], obs_test.shape[0], obs_test.shape[1]
 
+        # sequences of different lengths are padded with NaN
+        if is_variable_length(FLAGS.datadir + FLAGS.datadict, obs_train, obs_test):
+            FLAGS.variable_length = True
+
+        # memory maps of a dir of .npy files are read batch by batch, rather than fed to the input pipeline at once
+        if os.path.isdir(FLAGS.datadir + FLAGS.datadict) and not FLAGS.stream_input_data:
+            print("data is loaded from a dir of .npy files, so the input pipeline streams it (stream_input_data)")
+            FLAGS.stream_input_data = True
+
     # clip saving_num to avoid it > n_train or n_test
     FLAGS.MSE_steps  = min(FLAGS.MSE_steps, FLAGS.time - 1)
     FLAGS.saving_num = saving_num = min(FLAGS.saving_num, FLAGS.n_train, FLAGS.n_test)
@@ -61,24 +72,27 @@ def main(_):
     print("finished preparing dataset")
 
     # ============================================== model part ============================================== #
-    SSM_model = SSM(FLAGS)
+    profiler = graph_build_profiler(enabled=FLAGS.profile_graph_build)
+    with profiler.phase("SSM.__init__"):
+        SSM_model = SSM(FLAGS)
 
     # at most one of them can be set to True
     assert FLAGS.PSVO + FLAGS.SVO + FLAGS.AESMC + FLAGS.IWAE < 2
 
     # SMC class to calculate loss
-    if FLAGS.PSVO:
-        SMC_train = PSVO(SSM_model, FLAGS)
-    elif FLAGS.PSVOwR:
-        SMC_train = PSVOwR(SSM_model, FLAGS)
-    elif FLAGS.SVO:
-        SMC_train = SVO(SSM_model, FLAGS)
-    elif FLAGS.AESMC:
-        SMC_train = AESMC(SSM_model, FLAGS)
-    elif FLAGS.IWAE:
-        SMC_train = IWAE(SSM_model, FLAGS)
-    else:
-        raise ValueError("Choose one of objectives among: PSVO, SVO, AESMC, IWAE")
+    with profiler.phase("SMC.__init__"):
+        if FLAGS.PSVO:
+            SMC_train = PSVO(SSM_model, FLAGS)
+        elif FLAGS.PSVOwR:
+            SMC_train = PSVOwR(SSM_model, FLAGS)
+        elif FLAGS.SVO:
+            SMC_train = SVO(SSM_model, FLAGS)
+        elif FLAGS.AESMC:
+            SMC_train = AESMC(SSM_model, FLAGS)
+        elif FLAGS.IWAE:
+            SMC_train = IWAE(SSM_model, FLAGS)
+        else:
+            raise ValueError("Choose one of objectives among: PSVO, SVO, AESMC, IWAE")
 
     # =========================================== data saving part =========================================== #
     # create dir to save results
@@ -90,12 +104,16 @@ def main(_):
                          "seed":          FLAGS.seed,
                          "rslt_dir_name": FLAGS.rslt_dir_name}
 
-    RLT_DIR = create_RLT_DIR(Experiment_params)
+    if FLAGS.resume_from:
+        RLT_DIR = os.path.join(FLAGS.resume_from, "")
+    else:
+        RLT_DIR = create_RLT_DIR(Experiment_params)
     save_experiment_param(RLT_DIR, FLAGS)
     print("RLT_DIR:", RLT_DIR)
 
     # ============================================= training part ============================================ #
-    mytrainer = trainer(SSM_model, SMC_train, FLAGS)
+    with profiler.phase("trainer.__init__"):
+        mytrainer = trainer(SSM_model, SMC_train, FLAGS, profiler=profiler)
     mytrainer.init_data_saving(RLT_DIR)
 
     history, log = mytrainer.train(obs_train, obs_test,
@@ -131,3 +149,7 @@ def main(_):
 
     plot_R_square(RLT_DIR, history["R_square_trains"], history["R_square_tests"], print_freq)
     plot_log_ZSMC(RLT_DIR, history["log_ZSMC_trains"], history["log_ZSMC_tests"], print_freq)
+
+    # export_inference_graph sets FLAGS to the ones of the saved model, so it comes last
+    if FLAGS.save_model and FLAGS.export_model:
+        export_inference_graph(RLT_DIR, RLT_DIR + "export/", FLAGS)
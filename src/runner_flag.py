@@ -27,12 +27,22 @@ lr = 3e-3               # learning rate
 epoch = 200
 seed = 2
 
+# True (debug): all distributions check their arguments, which adds assertion ops at every step
+# False (fast): build distributions without the checks
+validate_args = True
+
+# whether distributions reuse what they have built for the same input, e.g. when q1 and f share the network,
+# instead of evaluating their networks again
+use_dist_cache = True
+
 # ------------------------------- Data ------------------------------- #
 # True: generate data set from simulation
 # False: read data set from the file
 generateTrainingData = False
 
 # if reading data from file
+# datadict is either a pickled dict or a dir of .npy files converted from it by utils/data_loader.py,
+# which are memory-mapped instead of loaded at once
 datadir = "data/fhn/[1,0]_obs_cov_0.01/"
 datadict = "datadict"
 
@@ -47,6 +57,10 @@ time = 5
 n_train = 2 * batch_size
 n_test = 2 * batch_size
 
+# whether sequences have different lengths and are padded with NaN after their end,
+# set to True automatically if the loaded data contains NaN
+variable_length = False
+
 # ------------------------ Networks parameters ----------------------- #
 # Feed-Forward Networks (FFN), number of units in each hidden layer
 # For example, [64, 64] means 2 hidden layers, 64 units in each hidden layer
@@ -106,12 +120,32 @@ SVO = False      # Smoothing Variational Objective (use proposal based on bRNN)
 AESMC = False    # Auto-Encoding Sequential Monte Carlo
 IWAE = False     # Importance Weighted Auto-Encoder
 
+# how ancestors are drawn when resampling: multinomial, stratified, systematic or residual
+# stratified, systematic and residual resampling have lower variance than multinomial
+resample_scheme = "multinomial"
+
+# whether only resample when the effective sample size (ESS) of particles drops below ESS_threshold * n_particles,
+# otherwise carry the normalized weights to the next step. If False, resample at every step
+use_adaptive_resampling = False
+ESS_threshold = 0.5
+
 # number of subparticles sampled when augmenting the trajectory backwards
 n_particles_for_BSim_proposal = 16
 
 # whether Backward Simulation proposal use unidirectional RNN or bidirectional RNN
 BSim_use_single_RNN = False
 
+# how backward particles are weighted against forward particles at t - 1 in backward simulation
+#   exhaustive: sum over all n_particles forward particles, O(n_particles) per backward particle
+#   sampled:    unbiased estimate from BSim_n_ancestors forward particles drawn from the filtering weights, O(1),
+#               reweighted so that the gradient w.r.t. the filtering weights is unbiased as well
+BSim_kernel = "exhaustive"
+BSim_n_ancestors = 4
+
+# number of forward particles evaluated at once when marginalizing them out in backward simulation
+# 0 evaluates all of them together, which takes O(n_particles_for_BSim_proposal * n_particles^2) memory
+BSim_chunk_size = 0
+
 # ----------------------------- Training ----------------------------- #
 
 # stop training early if validation set does not improve
@@ -126,10 +160,45 @@ lr_reduce_factor = 1 / np.sqrt(2)
 # minimum lr
 min_lr = lr / 10
 
+# train on a random window of train_window_size steps of each sequence instead of the whole sequence,
+# so that the memory and time of a training step don't grow with the length of the recordings.
+# Evaluation still uses whole sequences. 0 to train on whole sequences
+train_window_size = 0
+
+# read minibatches from a tf.data pipeline (shuffling, batching and prefetching in the graph) instead of feed_dict
+use_input_pipeline = True
+
+# whether the input pipeline caches data sets after their first pass
+# (except the shuffled training set, which is read in a new order at each epoch)
+cache_input_data = False
+
+# whether the input pipeline reads trials one by one from the data arrays while training, instead of loading them
+# into the graph at once, e.g. for data sets converted to .npy by utils/data_loader.py that don't fit in memory.
+# It is turned on when datadict is such a dir of .npy files
+stream_input_data = False
+
 # --------------------- printing and data saving params --------------------- #
 # frequency to evaluate testing loss & other metrics and save results
 print_freq = 1
 
+# number of training trials to evaluate metrics on, 0 to use the whole training set
+#   "fixed": the same random subset at every evaluation
+#   "rotating": consecutive shards, cycling through the training set across evaluations
+eval_subset_size = 0
+eval_subset_mode = "fixed"
+
+# evaluate metrics on a snapshot of the weights in a separate session and thread while training continues,
+# metrics, lr adjustment and model saving then lag one evaluation behind
+async_evaluation = False
+
+# record wall time and number of ops of each phase of graph building, and save them in graph_build_profile.json,
+# and print how many distributions of the graph the distribution cache reused
+profile_graph_build = False
+
+# trace the runtime of each op in this training step (counted from 0 across epochs), save it as a chrome trace
+# and summarize it by scope in the SMC while loops, < 0 for no tracing. Skip the first steps, which warm up
+trace_step = -1
+
 # whether to save the followings during training
 #   hidden trajectories
 #   k-step y-hat
@@ -152,6 +221,18 @@ save_tensorboard = False
 # whether to save model
 save_model = False
 
+# whether to export the saved model as a frozen inference graph and a SavedModel to RLT_DIR/export/ after training,
+# see export.py. Needs save_model
+export_model = False
+
+# minutes between checkpoints of the complete training state (variables, optimizer slots, lr scheduling,
+# early stopping, metric histories and numpy's random state) to RLT_DIR/resume/, 0 for no checkpoints
+checkpoint_interval = 0.0
+
+# RLT_DIR of a run to resume from its last training state checkpoint, e.g. after the job was preempted.
+# The resumed run continues saving its results in that dir. Other flags should be the ones of the run
+resume_from = ""
+
 q0_layers = ",".join([str(x) for x in q0_layers])
 q1_layers = ",".join([str(x) for x in q1_layers])
 q2_layers = ",".join([str(x) for x in q2_layers])
@@ -177,6 +258,10 @@ flags.DEFINE_float("lr", lr, "learning rate")
 flags.DEFINE_integer("epoch", epoch, "number of epoch")
 
 flags.DEFINE_integer("seed", seed, "random seed for np.random and tf")
+flags.DEFINE_boolean("validate_args", validate_args, "whether distributions check their arguments, "
+                                                     "True for debugging and False for speed")
+flags.DEFINE_boolean("use_dist_cache", use_dist_cache, "whether distributions reuse what they have built for "
+                                                       "the same input instead of evaluating their networks again")
 
 
 # ------------------------------- Data ------------------------------- #
@@ -192,6 +277,10 @@ flags.DEFINE_integer("time", time, "number of timesteps for simulated data")
 flags.DEFINE_integer("n_train", n_train, "number of trajactories for traning set")
 flags.DEFINE_integer("n_test", n_test, "number of trajactories for testing set")
 
+flags.DEFINE_boolean("variable_length", variable_length, "whether sequences have different lengths and are padded "
+                                                         "with NaN after their end, set to True automatically if "
+                                                         "the loaded data contains NaN")
+
 
 # ------------------------ Networks parameters ----------------------- #
 # Feed-Forward Network (FFN) architectures
@@ -247,11 +336,25 @@ flags.DEFINE_boolean("SVO", SVO, "Smoothing Variational Objective (use proposal
 flags.DEFINE_boolean("AESMC", AESMC, "Auto-Encoding Sequential Monte Carlo")
 flags.DEFINE_boolean("IWAE", IWAE, "Importance Weighted Auto-Encoder")
 
+flags.DEFINE_string("resample_scheme", resample_scheme, "how ancestors are drawn when resampling: "
+                                                        "multinomial, stratified, systematic or residual")
+flags.DEFINE_boolean("use_adaptive_resampling", use_adaptive_resampling, "whether only resample when ESS drops below "
+                                                                         "ESS_threshold * n_particles")
+flags.DEFINE_float("ESS_threshold", ESS_threshold, "fraction of n_particles below which ESS triggers resampling")
 flags.DEFINE_integer("n_particles_for_BSim_proposal", n_particles_for_BSim_proposal, "number of particles used for"
                                                                                      " each trajectory in "
                                                                                      "backward simulation proposal")
 flags.DEFINE_boolean("BSim_use_single_RNN", BSim_use_single_RNN, "whether Backward Simulation proposal "
                                                                  "use unidirectional RNN or bidirectional RNN")
+flags.DEFINE_string("BSim_kernel", BSim_kernel, "how backward particles are weighted against forward particles, "
+                                                "exhaustive: sum over all forward particles, "
+                                                "sampled: estimate from BSim_n_ancestors forward particles "
+                                                "drawn from the filtering weights")
+flags.DEFINE_integer("BSim_n_ancestors", BSim_n_ancestors, "number of forward particles drawn for each backward "
+                                                           "particle when BSim_kernel = sampled")
+flags.DEFINE_integer("BSim_chunk_size", BSim_chunk_size, "number of forward particles evaluated at once when "
+                                                         "marginalizing them out in backward simulation, "
+                                                         "0 evaluates all of them together")
 
 # ----------------------------- Training ----------------------------- #
 
@@ -263,11 +366,34 @@ flags.DEFINE_integer("lr_reduce_patience", lr_reduce_patience,
 flags.DEFINE_float("lr_reduce_factor", lr_reduce_factor,
                    "the factor to reduce learning rate, new_lr = old_lr * lr_reduce_factor")
 flags.DEFINE_float("min_lr", min_lr, "minimum learning rate")
+flags.DEFINE_integer("train_window_size", train_window_size, "train on random windows of this many steps of each "
+                                                             "sequence, 0 to train on whole sequences")
+
+flags.DEFINE_boolean("use_input_pipeline", use_input_pipeline, "read minibatches from a tf.data pipeline "
+                                                               "instead of feed_dict")
+flags.DEFINE_boolean("cache_input_data", cache_input_data, "whether the input pipeline caches data sets "
+                                                           "after their first pass")
+flags.DEFINE_boolean("stream_input_data", stream_input_data, "whether the input pipeline reads trials from the "
+                                                             "data arrays while training instead of loading them "
+                                                             "at once")
 
 # --------------------- printing and data saving params --------------------- #
 
 flags.DEFINE_integer("print_freq", print_freq, "frequency to evaluate testing loss & other metrics and save results")
 
+flags.DEFINE_integer("eval_subset_size", eval_subset_size, "number of training trials to evaluate metrics on, "
+                                                           "0 to use the whole training set")
+flags.DEFINE_string("eval_subset_mode", eval_subset_mode, "how to choose the training trials to evaluate: "
+                                                          "fixed (a random subset chosen once) or rotating "
+                                                          "(consecutive shards cycling through the training set)")
+flags.DEFINE_boolean("async_evaluation", async_evaluation, "evaluate metrics on a snapshot of the weights in a "
+                                                           "separate thread while training continues")
+flags.DEFINE_boolean("profile_graph_build", profile_graph_build, "record wall time and number of ops of each "
+                                                                 "phase of graph building, and the distributions "
+                                                                 "reused by the distribution cache")
+flags.DEFINE_integer("trace_step", trace_step, "training step (counted from 0 across epochs) to trace the "
+                                               "runtime of each op, < 0 for no tracing")
+
 flags.DEFINE_boolean("save_trajectory", save_trajectory, "whether to save hidden trajectories during training")
 flags.DEFINE_boolean("save_y_hat", save_y_hat, "whether to save k-step y-hat during training")
 
@@ -280,6 +406,14 @@ flags.DEFINE_integer("saving_num", saving_num, "number of testing data used to "
 
 flags.DEFINE_boolean("save_tensorboard", save_tensorboard, "whether to save tensorboard")
 flags.DEFINE_boolean("save_model", save_model, "whether to save model")
+flags.DEFINE_boolean("export_model", export_model, "whether to export the saved model as a frozen inference graph "
+                                                   "and a SavedModel to RLT_DIR/export/ after training, "
+                                                   "needs save_model")
+flags.DEFINE_float("checkpoint_interval", checkpoint_interval, "minutes between checkpoints of the complete "
+                                                               "training state to RLT_DIR/resume/, "
+                                                               "0 for no checkpoints")
+flags.DEFINE_string("resume_from", resume_from, "RLT_DIR of a run to resume from its last training state "
+                                                "checkpoint, the resumed run continues saving its results in it")
 
 FLAGS = flags.FLAGS
 
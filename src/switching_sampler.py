@@ -3,6 +3,8 @@ import numpy as np
 # for data saving stuff
 import pickle
 import os
+import tempfile
+from multiprocessing import Pool
 
 # import from files
 from transformation.fhn import fhn_transformation, tf_fhn_transformation
@@ -42,47 +44,117 @@ def generate_hidden_obs(time, Dx, Dy, x_0, f, g, keep_first=True):
         return X[1:], Y[1:]
 
 
-def create_dataset(n_train, n_test, time_list, Dx, Dy, f, g, f_params_list, x_0_in=None, lb=None, ub=None):
-    time = np.sum(time_list)
+def generate_hidden_obs_batch(time, Dx, Dy, x_0, f, g, keep_first=True, g_noise=None):
+    """
+    generate_hidden_obs for all trajectories at once
+    x_0: initial hidden states, shape (n, Dx)
+    g_noise: standard normal noise of the emission, shape (n, time + 1, Dy), only used when g is mvn
+    """
+    n = x_0.shape[0]
+    X = np.zeros((n, time + 1, Dx))
 
-    hidden_train, obs_train = np.zeros((n_train, time, Dx)), np.zeros((n_train, time, Dy))
-    hidden_test, obs_test = np.zeros((n_test, time, Dx)), np.zeros((n_test, time, Dy))
+    X[:, 0] = x_0
+    for t in range(1, time + 1):
+        X[:, t] = f.batch_sample(X[:, t - 1])
+
+    if isinstance(g, mvn):
+        Y = g.batch_sample(X, noise=g_noise)
+    else:
+        Y = g.batch_sample(X)
 
+    if keep_first:
+        return X[:, :-1], Y[:, :-1]
+    else:
+        return X[:, 1:], Y[:, 1:]
+
+
+def create_dataset(n_train, n_test, time_list, Dx, Dy, f, g, f_params_list, x_0_in=None, lb=None, ub=None):
     if x_0_in is None and (lb and ub) is None:
         assert False, 'must specify x_0 or (lb and ub)'
 
-    x_0_in_copy = x_0_in
-
+    # random numbers are drawn trajectory by trajectory in the order generate_hidden_obs draws them
+    # (time_part + 1 emission samples for each part), so the same seed gives the same data as generating
+    # each trajectory on its own, up to the tolerance of odeint
+    x_0 = np.zeros((n_train + n_test, Dx))
+    g_noise = np.zeros((n_train + n_test, np.sum(time_list) + len(time_list), Dy)) if isinstance(g, mvn) else None
     for i in range(n_train + n_test):
-        hidden_list = []
-        obs_list = []
+        x_0[i] = np.random.uniform(low=lb, high=ub, size=Dx) if x_0_in is None else x_0_in
+        if g_noise is not None:
+            g_noise[i] = np.random.randn(g_noise.shape[1], Dy)
 
-        x_0_in = x_0_in_copy
-        for time_part, f_params in zip(time_list, f_params_list):
-            f.transformation.params = f_params
-            if x_0_in is None:
-                x_0_in = np.random.uniform(low=lb, high=ub, size=Dx)
+    hidden_list = []
+    obs_list = []
+    noise_start = 0
+    for time_part, f_params in zip(time_list, f_params_list):
+        f.transformation.params = f_params
 
-            keep_first = (len(hidden_list) == 0)
-            hidden, obs = generate_hidden_obs(time_part, Dx, Dy, x_0_in, f, g, keep_first)
-            x_0_in = hidden[-1]
+        keep_first = (len(hidden_list) == 0)
+        part_noise = None if g_noise is None else g_noise[:, noise_start:noise_start + time_part + 1]
+        hidden, obs = generate_hidden_obs_batch(time_part, Dx, Dy, x_0, f, g, keep_first, part_noise)
+        x_0 = hidden[:, -1]
+        noise_start += time_part + 1
 
-            hidden_list.append(hidden)
-            obs_list.append(obs)
+        hidden_list.append(hidden)
+        obs_list.append(obs)
 
-        hidden = np.concatenate(hidden_list)
-        obs = np.concatenate(obs_list)
+    hidden = np.concatenate(hidden_list, axis=1)
+    obs = np.concatenate(obs_list, axis=1)
 
-        if i < n_train:
-            hidden_train[i] = hidden
-            obs_train[i] = obs
-        else:
-            hidden_test[i - n_train] = hidden
-            obs_test[i - n_train] = obs
+    hidden_train, obs_train = hidden[:n_train], obs[:n_train]
+    hidden_test, obs_test = hidden[n_train:], obs[n_train:]
 
     return hidden_train, obs_train, hidden_test, obs_test
 
 
+def create_dataset_shard(args):
+    # create trajectories start:end of create_dataset_parallel with their own seed, in a worker process
+    start, end, seed_seq, out_paths, time_list, Dx, Dy, f, g, f_params_list, x_0_in, lb, ub = args
+    np.random.seed(seed_seq.generate_state(4))
+
+    hidden, obs, _, _ = create_dataset(end - start, 0, time_list, Dx, Dy, f, g, f_params_list, x_0_in, lb, ub)
+
+    for path, data in zip(out_paths, [hidden, obs]):
+        out = np.lib.format.open_memmap(path, mode="r+")
+        out[start:end] = data
+        out.flush()
+        del out
+
+
+def create_dataset_parallel(n_train, n_test, time_list, Dx, Dy, f, g, f_params_list, x_0_in=None, lb=None, ub=None,
+                            seed=0, shard_size=1000, n_workers=None, out_dir=None):
+    """
+    create_dataset with trajectories split into shards of shard_size, generated by a pool of n_workers processes
+    (all cpus by default) and written directly into hidden.npy and obs.npy in out_dir (a new temporary dir by default)
+    Each shard is seeded with its own child of np.random.SeedSequence(seed), so the data only depends on seed and
+    shard_size, not on n_workers or the order in which shards finish, and doesn't use the global numpy random state.
+    Trajectories of a shard are simulated together, so shards should be large enough to amortize the python loop
+    over time steps, while still giving each worker at least one shard
+    Output:
+        hidden_train, obs_train, hidden_test, obs_test, as read-only memory maps of the saved arrays
+    """
+    n_trajectories = n_train + n_test
+    time = np.sum(time_list)
+
+    if out_dir is None:
+        out_dir = tempfile.mkdtemp()
+    out_paths = [os.path.join(out_dir, "hidden.npy"), os.path.join(out_dir, "obs.npy")]
+    for path, D in zip(out_paths, [Dx, Dy]):
+        out = np.lib.format.open_memmap(path, mode="w+", dtype=np.float64, shape=(n_trajectories, time, D))
+        del out
+
+    starts = list(range(0, n_trajectories, shard_size))
+    seed_seqs = np.random.SeedSequence(seed).spawn(len(starts))
+    shards = [(start, min(start + shard_size, n_trajectories), seed_seq, out_paths,
+               time_list, Dx, Dy, f, g, f_params_list, x_0_in, lb, ub)
+              for start, seed_seq in zip(starts, seed_seqs)]
+
+    with Pool(n_workers) as pool:
+        pool.map(create_dataset_shard, shards)
+
+    hidden, obs = [np.load(path, mmap_mode="r") for path in out_paths]
+    return hidden[:n_train], obs[:n_train], hidden[n_train:], obs[n_train:]
+
+
 def plot_fhn_results(RLT_DIR, Xs_val):
     if not os.path.exists(RLT_DIR + "/FHN 2D plots"):
         os.makedirs(RLT_DIR + "/FHN 2D plots")
@@ -6,12 +6,17 @@ import tensorflow as tf
 import os
 import pickle
 import time
+import threading
 import pdb
 
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 
 from rslts_saving.rslts_saving import plot_R_square_epoch
+from distribution.mvn import tf_mvn
+from utils.input_pipeline import input_pipeline
+from utils.R_square import R_square_accumulator
+from utils.profiling import graph_build_profiler, summarize_trace, print_trace_summary, save_trace
 
 
 class StopTraining(Exception):
@@ -19,11 +24,16 @@ class StopTraining(Exception):
 
 
 class trainer:
-    def __init__(self, model, SMC, FLAGS):
+    def __init__(self, model, SMC, FLAGS, profiler=None):
         self.model = model
         self.SMC = SMC
         self.FLAGS = FLAGS
 
+        # records the time and ops of each phase of graph building
+        if profiler is None:
+            profiler = graph_build_profiler(enabled=self.FLAGS.profile_graph_build)
+        self.profiler = profiler
+
         self.Dx = self.FLAGS.Dx
         self.Dy = self.FLAGS.Dy
         self.time = self.FLAGS.time
@@ -42,6 +52,15 @@ class trainer:
         self.obs = self.model.obs
         self.hidden = self.model.hidden
 
+        # read minibatches from a tf.data pipeline instead of feeding them
+        self.use_input_pipeline = self.FLAGS.use_input_pipeline
+        if self.use_input_pipeline:
+            self.input_pipeline = input_pipeline(self.obs, self.hidden,
+                                                 cache=self.FLAGS.cache_input_data,
+                                                 from_generator=self.FLAGS.stream_input_data,
+                                                 seed=self.FLAGS.seed)
+            self.obs, self.hidden = self.input_pipeline.obs, self.input_pipeline.hidden
+
     def init_training_param(self):
         self.batch_size = self.FLAGS.batch_size
         self.lr = self.FLAGS.lr
@@ -55,9 +74,31 @@ class trainer:
         # lr auto decreasing
         self.lr_reduce_factor = self.FLAGS.lr_reduce_factor
         self.lr_reduce_patience = self.FLAGS.lr_reduce_patience
+
+        # train on random windows of the sequences, if shorter than them
+        self.train_window_size = self.FLAGS.train_window_size
         self.min_lr = self.FLAGS.min_lr
         self.lr_reduce_count = 0
 
+        # evaluation scheduling
+        self.eval_subset_size = self.FLAGS.eval_subset_size
+        self.eval_subset_mode = self.FLAGS.eval_subset_mode
+        if self.eval_subset_mode not in ["fixed", "rotating"]:
+            raise ValueError("Unknown eval_subset_mode {}".format(self.eval_subset_mode))
+        self.eval_subset_idx = None
+        self.eval_shard_start = 0
+        self.async_evaluation = self.FLAGS.async_evaluation
+        self.eval_thread = None
+
+        # the training step to trace, counted from 0 across epochs, < 0 for no tracing
+        self.trace_step = self.FLAGS.trace_step
+        self.n_steps = 0
+
+        # checkpoints of the complete training state to resume from, every checkpoint_interval minutes,
+        # in RLT_DIR/resume/ so they need init_data_saving
+        self.checkpoint_interval = self.FLAGS.checkpoint_interval
+        self.resume_from = self.FLAGS.resume_from
+
     def init_data_saving(self, RLT_DIR):
         self.save_res = True
         self.RLT_DIR = RLT_DIR
@@ -70,19 +111,21 @@ class trainer:
         self.log_ZSMC_tests = []
         self.R_square_trains = []
         self.R_square_tests = []
+        self.ESS_trains = []
+        self.ESS_tests = []
 
         # epoch data (trajectory, y_hat and quiver lattice)
         epoch_data_DIR = self.RLT_DIR.split("/")
         epoch_data_DIR.insert(epoch_data_DIR.index("rslts") + 1, "epoch_data")
         self.epoch_data_DIR = "/".join(epoch_data_DIR)
 
+        self.resume_DIR = self.RLT_DIR + "resume/"
+
         # tensorboard and model saver
         self.save_tensorboard = self.FLAGS.save_tensorboard
         self.save_model = self.FLAGS.save_model
         if self.save_tensorboard:
             self.writer = tf.summary.FileWriter(self.RLT_DIR)
-        if self.save_model:
-            self.saver = tf.train.Saver(max_to_keep=1)
 
     def init_quiver_plotting(self):
         if self.Dx == 2:
@@ -105,20 +148,51 @@ class trainer:
         self.obs_train,    self.obs_test    = obs_train,    obs_test
         self.hidden_train, self.hidden_test = hidden_train, hidden_test
 
-        self.log_ZSMC, log = self.SMC.get_log_ZSMC(self.obs, self.hidden)
+        # the NaN padding is kept in obs and hidden, SMC replaces it at the steps the mask marks as padded
+        obs, hidden, mask = self.obs, self.hidden, None
+        if self.FLAGS.variable_length:
+            mask = self.get_mask(self.obs)
+
+        # the objective on windows is built first, so that the variables get the same names as without windows,
+        # and the whole-sequence one last, so that SMC keeps its state for n_step_prediction
+        use_windows = 0 < self.train_window_size < self.obs.shape.as_list()[1]
+        if use_windows:
+            with self.profiler.phase("SMC.get_log_ZSMC (windows)"):
+                window_log_ZSMC, _ = self.SMC.get_log_ZSMC(*self.get_random_windows(obs, hidden, mask))
+
+        with self.profiler.phase("SMC.get_log_ZSMC"):
+            self.log_ZSMC, log = self.SMC.get_log_ZSMC(obs, hidden, mask)
+        self.ESS = log["ESS"]
 
         # n_step_MSE now takes Xs as input rather than self.hidden
         # so there is no need to evalute enumerical value of Xs and feed it into self.hidden
         Xs = log["Xs"]
-        y_hat_N_BxTxDy, y_N_BxTxDy = self.SMC.n_step_prediction(self.MSE_steps, Xs, self.obs)
+        with self.profiler.phase("SMC.n_step_prediction"):
+            y_hat_N_BxTxDy, y_N_BxTxDy = self.SMC.n_step_prediction(self.MSE_steps, Xs, self.obs)
 
-        with tf.variable_scope("train"):
+        self.print_dist_cache_stats()
+
+        with self.profiler.phase("gradients"), tf.variable_scope("train"):
             lr = tf.placeholder(tf.float32, name="lr")
             optimizer = tf.train.AdamOptimizer(lr)
-            train_op = optimizer.minimize(-self.log_ZSMC)
+            train_op = optimizer.minimize(-window_log_ZSMC if use_windows else -self.log_ZSMC)
+
+        # variables of the model, without the ones of the optimizer, to copy into the evaluation session
+        optimizer_variables = [variable.name for variable in optimizer.variables()]
+        self.model_variables = [variable for variable in tf.global_variables()
+                                if variable.name not in optimizer_variables]
 
         init = tf.global_variables_initializer()
 
+        # the saver is created once all variables exist, otherwise checkpoints would miss them
+        if self.save_model:
+            self.saver = tf.train.Saver(max_to_keep=1)
+
+        # saver of all variables, optimizer slots included, keeping two in case the job is killed while saving
+        self.save_training_states = self.save_res and self.checkpoint_interval > 0
+        if self.save_training_states or self.resume_from:
+            self.resume_saver = tf.train.Saver(max_to_keep=2)
+
         # if self.model.TFS and self.model.flow_transition:
         #     from tensorflow.core.protobuf import rewriter_config_pb2
         #     config_proto = tf.ConfigProto()
@@ -129,39 +203,78 @@ class trainer:
         self.sess = tf.Session(config=tf.ConfigProto(log_device_placement=False))
 
         print("initializing variables...")
-        self.sess.run(init)
+        with self.profiler.phase("variable_init"):
+            self.sess.run(init)
+
+        if self.async_evaluation:
+            with self.profiler.phase("eval_session_init"):
+                self.eval_sess = tf.Session(config=tf.ConfigProto(log_device_placement=False))
+                self.eval_sess.run(init)
+
+        # order of the training trials, shuffled in place of the data so that it can be checkpointed
+        self.train_order = np.arange(len(obs_train))
+
+        # restored before the input pipeline is initialized, which continues from the pass of the next epoch
+        start_epoch = 0
+        if self.resume_from:
+            with self.profiler.phase("restore"):
+                start_epoch = self.restore_training_state(os.path.join(self.resume_from, "resume", ""))
+
+        if self.use_input_pipeline:
+            with self.profiler.phase("input_pipeline_init"):
+                self.input_pipeline.initialize(self.sess, obs_train, hidden_train, obs_test, hidden_test,
+                                               first_pass=start_epoch)
+
+        self.profiler.print_report()
+        if self.save_res:
+            self.profiler.save(self.RLT_DIR + "graph_build_profile.json")
 
         # unused tensorboard stuff
         if self.save_res and self.save_tensorboard:
             self.writer.add_graph(self.sess.graph)
 
-        for i in range(self.epoch):
+        if self.save_res:
+            self.saving_feed_dict = {self.obs:    obs_test[0:self.saving_num],
+                                     self.hidden: hidden_test[0:self.saving_num]}
+
+        self.last_checkpoint_time = time.time()
+
+        for i in range(start_epoch, self.epoch):
             start = time.time()
 
             if i == 0:
-                log_ZSMC_train, log_ZSMC_test, R_square_train, R_square_test = \
-                    self.evaluate_and_save_metrics(i, y_hat_N_BxTxDy, y_N_BxTxDy)
+                if self.async_evaluation:
+                    self.evaluate_and_save_metrics_async(i, y_hat_N_BxTxDy, y_N_BxTxDy)
+                else:
+                    log_ZSMC_train, log_ZSMC_test, R_square_train, R_square_test = \
+                        self.evaluate_and_save_metrics(i, y_hat_N_BxTxDy, y_N_BxTxDy)
 
             # training
-            obs_train, hidden_train = shuffle(obs_train, hidden_train)
-            for j in range(0, len(obs_train), self.batch_size):
-                self.sess.run(train_op,
-                              feed_dict={self.obs:    obs_train[j:j + self.batch_size],
-                                         self.hidden: hidden_train[j:j + self.batch_size],
-                                         lr:          self.lr})
+            if self.use_input_pipeline:
+                for j in range(self.input_pipeline.n_batches["train_shuffled"]):
+                    self.run_train_op(train_op,
+                                      feed_dict=self.input_pipeline.get_feed_dict("train_shuffled", {lr: self.lr}))
+            else:
+                self.train_order = shuffle(self.train_order)
+                for j in range(0, len(obs_train), self.batch_size):
+                    batch_idx = self.train_order[j:j + self.batch_size]
+                    self.run_train_op(train_op,
+                                      feed_dict={self.obs:    obs_train[batch_idx],
+                                                 self.hidden: hidden_train[batch_idx],
+                                                 lr:          self.lr})
 
             if (i + 1) % print_freq == 0:
                 try:
-                    log_ZSMC_train, log_ZSMC_test, R_square_train, R_square_test = \
-                        self.evaluate_and_save_metrics(i, y_hat_N_BxTxDy, y_N_BxTxDy)
-                    self.adjust_lr(i, print_freq)
+                    if self.async_evaluation:
+                        self.evaluate_and_save_metrics_async(i, y_hat_N_BxTxDy, y_N_BxTxDy, print_freq)
+                    else:
+                        log_ZSMC_train, log_ZSMC_test, R_square_train, R_square_test = \
+                            self.evaluate_and_save_metrics(i, y_hat_N_BxTxDy, y_N_BxTxDy)
+                        self.adjust_lr(i, print_freq)
                 except StopTraining:
                     break
 
                 if self.save_res:
-                    self.saving_feed_dict = {self.obs:    obs_test[0:self.saving_num],
-                                             self.hidden: hidden_test[0:self.saving_num]}
-
                     Xs_val = self.evaluate(Xs, self.saving_feed_dict, average=False)
 
                     if self.save_trajectory:
@@ -184,39 +297,281 @@ class trainer:
             end = time.time()
             print("epoch {:<4} took {:.3f} seconds".format(i + 1, end - start))
 
+            if self.save_training_states and end - self.last_checkpoint_time >= self.checkpoint_interval * 60:
+                try:
+                    self.save_training_state(i + 1)
+                except StopTraining:
+                    break
+
+        if self.async_evaluation:
+            try:
+                self.collect_async_evaluation()
+            except StopTraining:
+                pass
+
         print("finished training...")
 
         metrics = {"log_ZSMC_trains": self.log_ZSMC_trains,
                    "log_ZSMC_tests":  self.log_ZSMC_tests,
                    "R_square_trains": self.R_square_trains,
-                   "R_square_tests":  self.R_square_tests}
+                   "R_square_tests":  self.R_square_tests,
+                   "ESS_trains":      self.ESS_trains,
+                   "ESS_tests":       self.ESS_tests}
         log["y_hat"] = y_hat_N_BxTxDy
 
         return metrics, log
 
+    def save_training_state(self, n_epochs_done):
+        """
+        Checkpoint everything needed to resume training after n_epochs_done epochs: variables with optimizer slots,
+        lr scheduling and early stopping counters, metric histories, the order of training trials and numpy's random
+        state. The input pipeline draws the order of each epoch from its seed and the epoch, so it continues from
+        n_epochs_done without a state of its own. Only the random state of TF ops, e.g. the sampling of particles,
+        can't be saved, and restarts.
+        """
+        # metrics of a pending async evaluation belong to the state
+        if self.async_evaluation:
+            self.collect_async_evaluation()
+
+        if not os.path.exists(self.resume_DIR):
+            os.makedirs(self.resume_DIR)
+        checkpoint_path = self.resume_saver.save(self.sess, self.resume_DIR + "training_state",
+                                                 global_step=n_epochs_done)
+
+        # relative to resume_DIR, so that results can be moved before resuming
+        training_state = {"checkpoint_name":  os.path.basename(checkpoint_path),
+                          "n_epochs_done":    n_epochs_done,
+                          "n_steps":          self.n_steps,
+                          "lr":               self.lr,
+                          "bestCost":         self.bestCost,
+                          "early_stop_count": self.early_stop_count,
+                          "lr_reduce_count":  self.lr_reduce_count,
+                          "log_ZSMC_trains":  self.log_ZSMC_trains,
+                          "log_ZSMC_tests":   self.log_ZSMC_tests,
+                          "R_square_trains":  self.R_square_trains,
+                          "R_square_tests":   self.R_square_tests,
+                          "ESS_trains":       self.ESS_trains,
+                          "ESS_tests":        self.ESS_tests,
+                          "eval_subset_idx":  self.eval_subset_idx,
+                          "eval_shard_start": self.eval_shard_start,
+                          "train_order":      self.train_order,
+                          "random_state":     np.random.get_state()}
+
+        # written to a temporary file first, so that a job killed while writing leaves the previous state intact
+        with open(self.resume_DIR + "training_state.p.tmp", "wb") as f:
+            pickle.dump(training_state, f)
+        os.replace(self.resume_DIR + "training_state.p.tmp", self.resume_DIR + "training_state.p")
+
+        self.last_checkpoint_time = time.time()
+        print("saved training state after epoch {} to {}".format(n_epochs_done, checkpoint_path))
+
+    def restore_training_state(self, resume_DIR):
+        # restore the state saved by save_training_state in resume_DIR, and return the number of epochs done
+        with open(resume_DIR + "training_state.p", "rb") as f:
+            training_state = pickle.load(f)
+
+        self.resume_saver.restore(self.sess, resume_DIR + training_state.pop("checkpoint_name"))
+        if self.async_evaluation:
+            for variable, value in zip(self.model_variables, self.sess.run(self.model_variables)):
+                variable.load(value, self.eval_sess)
+
+        np.random.set_state(training_state.pop("random_state"))
+        n_epochs_done = training_state.pop("n_epochs_done")
+        for key, value in training_state.items():
+            setattr(self, key, value)
+
+        print("resumed training state after epoch {} from {}".format(n_epochs_done, resume_DIR))
+        print("the random state of TF ops isn't checkpointed, so the sampling of particles restarts its sequence")
+        return n_epochs_done
+
+    def run_train_op(self, train_op, feed_dict):
+        # run a training step, with a full trace of op runtimes if it is self.trace_step
+        if self.n_steps != self.trace_step:
+            self.sess.run(train_op, feed_dict=feed_dict)
+        else:
+            run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+            run_metadata = tf.RunMetadata()
+            self.sess.run(train_op, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
+
+            print("op time by scope of training step {}:".format(self.n_steps))
+            print_trace_summary(summarize_trace(run_metadata))
+            if self.save_res:
+                save_trace(run_metadata, self.RLT_DIR + "trace_step_{}".format(self.n_steps))
+
+        self.n_steps += 1
+
+    @staticmethod
+    def get_mask(obs):
+        """
+        Sequences shorter than time are padded with NaN after their end.
+        Get the mask of valid steps, mask.shape = (batch_size, time)
+        """
+        with tf.name_scope("get_mask"):
+            mask = tf.logical_not(tf.reduce_all(tf.is_nan(obs), axis=-1))
+
+        return tf.cast(mask, tf.float32, name="mask")
+
+    def get_random_windows(self, obs, hidden, mask=None):
+        """
+        Crop a window of self.train_window_size steps from each sequence, starting at a random step among the ones
+        where it fits in the valid steps of the sequence (all of them if shorter than the window, with the rest masked).
+        The SMC initializes X0 of each window from the observations of the window itself
+        """
+        window_size = self.train_window_size
+        batch_size, time = obs.shape.as_list()[:2]
+
+        with tf.variable_scope("random_windows"):
+            if mask is None:
+                lengths = tf.fill([batch_size], time)
+            else:
+                lengths = tf.cast(tf.reduce_sum(mask, axis=1), tf.int32)
+            n_starts = tf.maximum(lengths - window_size, 0) + 1
+            starts = tf.cast(tf.random_uniform([batch_size]) * tf.cast(n_starts, tf.float32), tf.int32)
+            starts = tf.minimum(starts, n_starts - 1)
+
+            # gather_idx.shape = (batch_size, window_size, 2)
+            step_idx = starts[:, None] + tf.range(window_size)[None, :]
+            batch_idx = tf.tile(tf.range(batch_size)[:, None], (1, window_size))
+            gather_idx = tf.stack([batch_idx, step_idx], axis=-1)
+
+            obs = tf.gather_nd(obs, gather_idx, name="obs")
+            hidden = tf.gather_nd(hidden, gather_idx, name="hidden")
+            if mask is not None:
+                mask = tf.gather_nd(mask, gather_idx, name="mask")
+
+        return obs, hidden, mask
+
+    def print_dist_cache_stats(self):
+        # count distributions of the graph reused for the same input instead of built again. These are counted
+        # when the graph is built, so a reuse in a while loop body saves one network evaluation at every step,
+        # and one outside of it saves one per run. Printed along with the report of graph building
+        if not self.profiler.enabled:
+            return
+
+        dists = []
+        for dist in vars(self.model).values():
+            if isinstance(dist, tf_mvn) and dist.use_cache and dist not in dists:
+                dists.append(dist)
+        if not dists:
+            return
+
+        n_reuses = sum([dist.n_graph_reuses for dist in dists])
+        n_calls = n_reuses + sum([dist.n_graph_builds for dist in dists])
+        print("distribution cache: {} of {} distributions of the graph reused instead of built again"
+              .format(n_reuses, n_calls))
+        for dist in dists:
+            print("\t{:<16} reused: {:<4} built: {}".format(dist.name, dist.n_graph_reuses, dist.n_graph_builds))
+
     def close_session(self):
         self.sess.close()
+        if self.async_evaluation:
+            self.eval_sess.close()
+
+    def get_eval_data(self):
+        """
+        Data to evaluate metrics on, either names of data sets of self.input_pipeline or feed dicts of all batches.
+        The training set is reduced to eval_subset_size trials if eval_subset_size > 0:
+            "fixed": the same random subset at every evaluation
+            "rotating": consecutive shards, cycling through the training set across evaluations
+        """
+        # iterators of the input pipeline only exist in self.sess
+        if self.use_input_pipeline and not self.async_evaluation:
+            train_data, test_data = "train", "test"
+        else:
+            train_data = {self.obs: self.obs_train, self.hidden: self.hidden_train}
+            test_data = {self.obs: self.obs_test, self.hidden: self.hidden_test}
+
+        n_train = len(self.obs_train)
+        if 0 < self.eval_subset_size < n_train:
+            # whole batches only, as the batch size of the graph is fixed
+            subset_size = max(self.eval_subset_size // self.batch_size, 1) * self.batch_size
+            if self.eval_subset_mode == "fixed":
+                if self.eval_subset_idx is None:
+                    self.eval_subset_idx = np.sort(np.random.choice(n_train, subset_size, replace=False))
+                idx = self.eval_subset_idx
+            else:
+                idx = (self.eval_shard_start + np.arange(subset_size)) % n_train
+                self.eval_shard_start = (self.eval_shard_start + subset_size) % n_train
+            train_data = {self.obs: self.obs_train[idx], self.hidden: self.hidden_train[idx]}
+
+        return train_data, test_data
+
+    def compute_metrics(self, y_hat_N_BxTxDy, y_N_BxTxDy, train_data, test_data, sess=None):
+        # metrics are accumulated batch by batch, so that k-step predictions of the whole data set are never kept
+        metrics = []
+        for data in [train_data, test_data]:
+            log_ZSMCs = []
+            ESS_sum, n_trials = 0, 0
+            R_square = R_square_accumulator()
+            for log_ZSMC, y_hat, y, ESS in self.run_batches([self.log_ZSMC, y_hat_N_BxTxDy, y_N_BxTxDy, self.ESS],
+                                                            data, sess=sess):
+                log_ZSMCs.append(log_ZSMC)
+                ESS_sum, n_trials = ESS_sum + np.sum(ESS, axis=0), n_trials + len(ESS)
+                R_square.update(y_hat, y)
+
+            # ESS at each step, averaged across trials, shape = (time,)
+            metrics.append((np.mean(log_ZSMCs), R_square.R_square(), ESS_sum / n_trials))
+
+        (log_ZSMC_train, R_square_train, ESS_train), (log_ZSMC_test, R_square_test, ESS_test) = metrics
+
+        return log_ZSMC_train, log_ZSMC_test, R_square_train, R_square_test, ESS_train, ESS_test
 
     def evaluate_and_save_metrics(self, iter_num, y_hat_N_BxTxDy, y_N_BxTxDy):
-        log_ZSMC_train, y_hat_train, y_train = \
-            self.evaluate([self.log_ZSMC, y_hat_N_BxTxDy, y_N_BxTxDy],
-                          {self.obs:    self.obs_train,
-                           self.hidden: self.hidden_train})
-        log_ZSMC_test, y_hat_test, y_test = \
-            self.evaluate([self.log_ZSMC, y_hat_N_BxTxDy, y_N_BxTxDy],
-                          {self.obs:    self.obs_test,
-                           self.hidden: self.hidden_test})
-
-        log_ZSMC_train, log_ZSMC_test = np.mean(log_ZSMC_train), np.mean(log_ZSMC_test)
-        R_square_train = self.evaluate_R_square(y_hat_train, y_train)
-        R_square_test = self.evaluate_R_square(y_hat_test, y_test)
+        start = time.time()
+        train_data, test_data = self.get_eval_data()
+        metrics = self.compute_metrics(y_hat_N_BxTxDy, y_N_BxTxDy, train_data, test_data)
+        print("evaluation took {:.3f} seconds".format(time.time() - start))
+        return self.save_metrics(iter_num, *metrics)
 
+    def evaluate_and_save_metrics_async(self, iter_num, y_hat_N_BxTxDy, y_N_BxTxDy, print_freq=None):
+        """
+        Evaluate metrics of a snapshot of the current weights in self.eval_sess on a separate thread, while
+        training continues, and save (and adjust lr with, if print_freq is given) the metrics of the previous
+        call once they are ready. Metrics, lr adjustment and model saving thus lag one evaluation behind.
+        """
+        self.collect_async_evaluation()
+
+        weights = self.sess.run(self.model_variables)
+        train_data, test_data = self.get_eval_data()
+
+        def run_evaluation():
+            try:
+                for variable, value in zip(self.model_variables, weights):
+                    variable.load(value, self.eval_sess)
+                metrics = self.compute_metrics(y_hat_N_BxTxDy, y_N_BxTxDy, train_data, test_data,
+                                               sess=self.eval_sess)
+                self.eval_result = (iter_num, print_freq, metrics)
+            except Exception as e:
+                self.eval_result = e
+
+        self.eval_thread = threading.Thread(target=run_evaluation, name="async_evaluation")
+        self.eval_thread.start()
+
+    def collect_async_evaluation(self):
+        # wait for the evaluation in progress, if any, and save its metrics
+        if self.eval_thread is None:
+            return
+
+        self.eval_thread.join()
+        self.eval_thread = None
+        if isinstance(self.eval_result, Exception):
+            raise self.eval_result
+
+        iter_num, print_freq, metrics = self.eval_result
+        self.save_metrics(iter_num, *metrics)
+        if print_freq is not None:
+            self.adjust_lr(iter_num, print_freq)
+
+    def save_metrics(self, iter_num, log_ZSMC_train, log_ZSMC_test, R_square_train, R_square_test,
+                     ESS_train, ESS_test):
         print()
         print("iter", iter_num + 1)
         print("Train log_ZSMC: {:>7.3f}, valid log_ZSMC: {:>7.3f}"
               .format(log_ZSMC_train, log_ZSMC_test))
 
         print("Train, Valid k-step Rsq:\n", R_square_train, "\n", R_square_test)
+        print("Train, Valid mean ESS: {:.2f}, {:.2f} (min over steps: {:.2f}, {:.2f}) out of {} particles"
+              .format(np.mean(ESS_train), np.mean(ESS_test), np.min(ESS_train), np.min(ESS_test), self.n_particles))
 
         if not math.isfinite(log_ZSMC_train):
             print("Nan in log_ZSMC, stop training")
@@ -227,6 +582,8 @@ class trainer:
             self.log_ZSMC_tests.append(log_ZSMC_test)
             self.R_square_trains.append(R_square_train)
             self.R_square_tests.append(R_square_test)
+            self.ESS_trains.append(ESS_train)
+            self.ESS_tests.append(ESS_test)
 
             plot_R_square_epoch(self.RLT_DIR, R_square_train, R_square_test, iter_num + 1)
 
@@ -235,7 +592,9 @@ class trainer:
             metric_dict = {"log_ZSMC_train": log_ZSMC_train,
                            "log_ZSMC_test":  log_ZSMC_test,
                            "R_square_train": R_square_train,
-                           "R_square_test":  R_square_test}
+                           "R_square_test":  R_square_test,
+                           "ESS_train":      ESS_train,
+                           "ESS_test":       ESS_test}
             with open(self.epoch_data_DIR + "metric_{}.p".format(iter_num + 1), "wb") as f:
                 pickle.dump(metric_dict, f)
 
@@ -267,30 +626,28 @@ class trainer:
                 os.makedirs(self.RLT_DIR + "model/")
             if self.bestCost == len(self.log_ZSMC_tests) - 1:
                 print("Test log_ZSMC improves to {}, save model".format(self.log_ZSMC_tests[-1]))
-                self.saver.save(self.sess, self.RLT_DIR + "model/model_epoch", global_step=iter_num + 1)
+                # with async_evaluation, self.eval_sess holds the weights that were evaluated
+                sess = self.eval_sess if self.async_evaluation else self.sess
+                self.saver.save(sess, self.RLT_DIR + "model/model_epoch", global_step=iter_num + 1)
 
-    def evaluate(self, fetches, feed_dict_w_batches={}, average=False, keepdims=False):
+    def evaluate(self, fetches, feed_dict_w_batches={}, average=False, keepdims=False, sess=None):
         """
         Evaluate fetches across multiple batches of feed_dict
         fetches: a single tensor or list of tensor to evaluate
-        feed_dict_w_batches: {placeholder: input of multiple batches}
+        feed_dict_w_batches: {placeholder: input of multiple batches},
+            or the name of a data set of self.input_pipeline ("train" or "test")
         average: whether to average fetched values across batches
         keepdims: if not averaging across batches, for N-d tensor in feteches, whether to keep
             the dimension for different batches.
+        sess: session to run fetches in, self.sess by default
         """
-        if not feed_dict_w_batches:
-            return self.sess.run(fetches)
+        if sess is None:
+            sess = self.sess
 
-        n_batches = len(list(feed_dict_w_batches.values())[0])
-        assert n_batches >= self.batch_size
+        if not feed_dict_w_batches:
+            return sess.run(fetches)
 
-        fetches_list = []
-        feed_dict = {}
-        for i in range(0, n_batches, self.batch_size):
-            for key, value in feed_dict_w_batches.items():
-                feed_dict[key] = value[i:i + self.batch_size]
-            fetches_val = self.sess.run(fetches, feed_dict=feed_dict)
-            fetches_list.append(fetches_val)
+        fetches_list = list(self.run_batches(fetches, feed_dict_w_batches, sess))
 
         res = []
         if isinstance(fetches, list):
@@ -319,20 +676,31 @@ class trainer:
 
         return res
 
-    def evaluate_R_square(self, y_hat, y):
-        n_steps = len(y_hat) - 1
+    def run_batches(self, fetches, feed_dict_w_batches, sess=None):
+        """
+        Generator of the values of fetches on each batch of feed_dict_w_batches, see evaluate for the arguments
+        """
+        if sess is None:
+            sess = self.sess
+
+        if isinstance(feed_dict_w_batches, str):
+            for fetches_val in self.input_pipeline.run_batches(sess, fetches, feed_dict_w_batches):
+                yield fetches_val
+            return
 
-        def get_R_square(y_hat_i, y_i):
-            MSE = np.sum((y_hat_i - y_i) ** 2)
-            y_i_mean = np.mean(y_i, axis=0, keepdims=True)
-            y_i_var = np.sum((y_i - y_i_mean) ** 2)
-            return 1 - MSE / y_i_var
+        n_batches = len(list(feed_dict_w_batches.values())[0])
+        assert n_batches >= self.batch_size
 
-        R_square = np.zeros(n_steps + 1)
-        for i, (y_hat_i, y_i) in enumerate(zip(y_hat, y)):
-            R_square[i] = get_R_square(y_hat_i, y_i)
+        feed_dict = {}
+        for i in range(0, n_batches, self.batch_size):
+            for key, value in feed_dict_w_batches.items():
+                feed_dict[key] = value[i:i + self.batch_size]
+            yield sess.run(fetches, feed_dict=feed_dict)
 
-        return R_square
+    def evaluate_R_square(self, y_hat, y):
+        R_square = R_square_accumulator()
+        R_square.update(y_hat, y)
+        return R_square.R_square()
 
     def draw_2D_quiver_plot(self, Xs_val, nextX, lattice, epoch):
         # Xs_val.shape = (saving_num, time, n_particles, Dx)
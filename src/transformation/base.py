@@ -1,5 +1,7 @@
 from abc import ABC, abstractmethod
 
+import numpy as np
+
 # base class for transformation
 class transformation(object):
 	def __init__(self, params = None):
@@ -8,4 +10,27 @@ class transformation(object):
 	@abstractmethod
 	def transform(self, X_prev):
 		pass
+
+	def batch_transform(self, X_prev):
+		"""
+		transform each X of X_prev.shape = [B0, B1, ..., Bn, Dx],
+		subclasses override it to transform all of them at once
+		"""
+		return np.apply_along_axis(self.transform, -1, X_prev)
+
+
+def rk4(dXdt, X, dt, n_substeps = 8):
+	"""
+	Integrates dX/dt = dXdt(X) over dt with n_substeps steps of the classical Runge-Kutta method,
+	for all X of X.shape = [B0, B1, ..., Bn, Dx] at once.
+	With 8 substeps, it agrees with odeint up to the tolerance of odeint for the fhn and lorenz step sizes we use
+	"""
+	h = dt / n_substeps
+	for _ in range(n_substeps):
+		k1 = dXdt(X)
+		k2 = dXdt(X + h / 2 * k1)
+		k3 = dXdt(X + h / 2 * k2)
+		k4 = dXdt(X + h * k3)
+		X = X + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+	return X
 		
\ No newline at end of file
@@ -3,7 +3,7 @@ from scipy.integrate import odeint
 import tensorflow as tf
 from tensorflow.contrib.integrate import odeint as tf_odeint
 
-from transformation.base import transformation
+from transformation.base import transformation, rk4
 
 class fhn_transformation(transformation):
 	def transform(self, X_prev):
@@ -36,6 +36,20 @@ class fhn_transformation(transformation):
 
 		return X
 
+	def batch_transform(self, X_prev):
+		"""
+		X_prev.shape = [B0, B1, ..., Bn, Dx], integrated with RK4
+		"""
+		a, b, c, I, dt = self.params
+
+		def fhn_equation(X):
+			V, w = X[..., 0], X[..., 1]
+			dVdt = V-V**3/3 - w + I
+			dwdt = a*(b*V - c*w)
+			return np.stack([dVdt, dwdt], axis = -1)
+
+		return rk4(fhn_equation, X_prev, dt)
+
 class tf_fhn_transformation(transformation):
 	def transform(self, X_prev):
 		"""
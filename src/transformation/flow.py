@@ -17,6 +17,7 @@ class NF:
                  log_scale_min_clip=-0.1,
                  log_scale_max_clip=0.1,
                  log_scale_clip_gradient=False,
+                 validate_args=True,
                  name="NF"):
         if flow_to_reverse is None:
             self.event_size              = event_size
@@ -26,14 +27,16 @@ class NF:
             self.log_scale_min_clip      = log_scale_min_clip
             self.log_scale_max_clip      = log_scale_max_clip
             self.log_scale_clip_gradient = log_scale_clip_gradient
+            self.validate_args           = validate_args
             self.name                    = name
             self.bijector                = self.init_bijectors(n_layers, hidden_layers)
         else:
-            self.event_size = flow_to_reverse.event_size
-            self.sample_num = flow_to_reverse.sample_num
-            self.flow_type  = flow_to_reverse.flow_type + "_reversed"
-            self.name       = flow_to_reverse.name + "_reversed"
-            self.bijector   = tfb.Invert(flow_to_reverse.bijector)
+            self.event_size    = flow_to_reverse.event_size
+            self.sample_num    = flow_to_reverse.sample_num
+            self.flow_type     = flow_to_reverse.flow_type + "_reversed"
+            self.validate_args = flow_to_reverse.validate_args
+            self.name          = flow_to_reverse.name + "_reversed"
+            self.bijector      = tfb.Invert(flow_to_reverse.bijector, validate_args=self.validate_args)
 
     @staticmethod
     def init_once(x, name):
@@ -97,7 +100,9 @@ class NF:
                 #     )
                 # )
 
-            flow_bijector = tfb.Chain(list(reversed(bijectors[:-1])), validate_args=True, name="NF_chain")
+            flow_bijector = tfb.Chain(list(reversed(bijectors[:-1])),
+                                      validate_args=self.validate_args,
+                                      name="NF_chain")
 
             return flow_bijector
 
@@ -105,7 +110,7 @@ class NF:
         dist = tfd.TransformedDistribution(
             distribution=base_dist,
             bijector=self.bijector,
-            validate_args=True,
+            validate_args=self.validate_args,
             name=name or self.name)
 
         return dist
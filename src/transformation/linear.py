@@ -11,6 +11,11 @@ class linear_transformation(transformation):
         A = self.params
         return np.dot(A, Input)
 
+    def batch_transform(self, Input):
+        # Input.shape = [B0, B1, ..., Bn, Dx]
+        A = self.params
+        return np.dot(Input, A.T)
+
 class tf_linear_transformation(transformation):
     def transform(self, Input):
         '''
@@ -3,7 +3,7 @@ from scipy.integrate import odeint
 import tensorflow as tf
 from tensorflow.contrib.integrate import odeint as tf_odeint
 
-from transformation.base import transformation
+from transformation.base import transformation, rk4
 
 class lorenz_transformation(transformation):
     def transform(self, X_prev):
@@ -26,6 +26,23 @@ class lorenz_transformation(transformation):
 
         return X
 
+    def batch_transform(self, X_prev):
+        """
+        X_prev.shape = [B0, B1, ..., Bn, Dx], integrated with RK4
+        """
+        sigma, rho, beta, dt = self.params
+
+        def lorenz_equation(X):
+            x, y, z = X[..., 0], X[..., 1], X[..., 2]
+
+            xd = sigma * (y - x)
+            yd = (rho - z) * x - y
+            zd = x * y - beta * z
+
+            return np.stack([xd, yd, zd], axis=-1)
+
+        return rk4(lorenz_equation, X_prev, dt)
+
 class tf_lorenz_transformation(transformation):
     def transform(self, X_prev):
         """
@@ -0,0 +1,44 @@
+import numpy as np
+
+
+class R_square_accumulator:
+    """
+    Streaming k-step R^2 = 1 - sum (y_hat - y)^2 / sum (y - y_mean)^2, where y_mean is the mean across trials
+    at each (step, dim), for k = 0, ..., n_steps.
+    Only the squared error and the count, mean and sum of squared deviations of y at each (k, step, dim) are kept,
+    merged batch by batch with the parallel update of Chan et al., so memory doesn't grow with the number of trials.
+    NaN, the padding of variable length sequences, is skipped.
+    """
+    def __init__(self):
+        self.SSE = None
+
+    def update(self, y_hat, y):
+        """
+        Input:
+            y_hat, y: lists of length n_steps + 1, the k-th item is of shape (batch_size, time - k, Dy)
+        """
+        if self.SSE is None:
+            self.SSE = np.zeros(len(y))
+            self.count = [np.zeros(y_k.shape[1:]) for y_k in y]
+            self.mean = [np.zeros(y_k.shape[1:]) for y_k in y]
+            self.M2 = [np.zeros(y_k.shape[1:]) for y_k in y]
+
+        for k, (y_hat_k, y_k) in enumerate(zip(y_hat, y)):
+            self.SSE[k] += np.nansum((y_hat_k - y_k) ** 2)
+
+            # statistics of the batch
+            count_b = np.sum(~np.isnan(y_k), axis=0)
+            mean_b = np.nansum(y_k, axis=0) / np.maximum(count_b, 1)
+            M2_b = np.nansum((y_k - mean_b) ** 2, axis=0)
+
+            # merge them into the running ones
+            count = self.count[k] + count_b
+            delta = mean_b - self.mean[k]
+            self.mean[k] += delta * count_b / np.maximum(count, 1)
+            self.M2[k] += M2_b + delta ** 2 * self.count[k] * count_b / np.maximum(count, 1)
+            self.count[k] = count
+
+    def R_square(self):
+        # shape = (n_steps + 1,)
+        SST = np.array([np.sum(M2_k) for M2_k in self.M2])
+        return 1 - self.SSE / SST
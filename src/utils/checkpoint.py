@@ -0,0 +1,34 @@
+import os
+import re
+
+import tensorflow as tf
+
+
+def get_scope_free_name(name):
+    # networks get their scope where they are first called, e.g. log_ZSMC_1/... or log_ZSMC/while/...
+    # depending on what the trainer built before the objective (quiver plotting),
+    # so variables are matched without the suffix of the outer scope and without while loop scopes
+    scopes = name.split("/")
+    scopes[0] = re.sub(r"_\d+$", "", scopes[0])
+    return "/".join([scope for scope in scopes if not re.match(r"while(_\d+)?$", scope)])
+
+
+def restore_model_variables(sess, variables, checkpoint_path):
+    """
+    Restore variables of a model rebuilt outside of the trainer from a checkpoint saved by trainer.saver
+    Input:
+        variables: list of variables to restore, all of them have to be in the checkpoint
+        checkpoint_path: a checkpoint, or the dir it is saved in to use the latest one
+    """
+    if os.path.isdir(checkpoint_path):
+        checkpoint_path = tf.train.latest_checkpoint(checkpoint_path)
+
+    checkpoint_names = {get_scope_free_name(name): name for name, _ in tf.train.list_variables(checkpoint_path)}
+    var_list = {}
+    for variable in variables:
+        name = get_scope_free_name(variable.op.name)
+        if name not in checkpoint_names:
+            raise ValueError("{} is not in checkpoint {}".format(variable.op.name, checkpoint_path))
+        var_list[checkpoint_names[name]] = variable
+
+    tf.train.Saver(var_list=var_list).restore(sess, checkpoint_path)
@@ -26,6 +26,28 @@ def generate_hidden_obs(time, Dx, Dy, x_0, f, g):
     return X, Y
 
 
+def generate_hidden_obs_batch(time, Dx, Dy, x_0, f, g, g_noise=None):
+    """
+    generate_hidden_obs for all trajectories at once
+    x_0: initial hidden states, shape (n, Dx)
+    g_noise: standard normal noise of the emission, shape (n, time, Dy), only used when g is mvn
+    Output:
+        hidden, obs: shape (n, time, Dx) and (n, time, Dy)
+    """
+    n = x_0.shape[0]
+    X = np.zeros((n, time, Dx))
+
+    X[:, 0] = x_0
+    for t in range(1, time):
+        X[:, t] = f.batch_sample(X[:, t - 1])
+
+    if isinstance(g, mvn):
+        Y = g.batch_sample(X, noise=g_noise)
+    else:
+        Y = g.batch_sample(X)
+    return X, Y
+
+
 def generate_dataset(n_train, n_test, time,
                      model="lorenz", Dy=1, Di=1,
                      f=None, g=None,
@@ -63,23 +85,21 @@ def generate_dataset(n_train, n_test, time,
         g_tran = linear_transformation(g_params)
         g = mvn(g_tran, g_cov)
 
-    hidden_train, obs_train = np.zeros((n_train, time, Dx)), np.zeros((n_train, time, Dy))
-    hidden_test, obs_test = np.zeros((n_test, time, Dx)), np.zeros((n_test, time, Dy))
-
     if x_0_in is None and (lb and ub) is None:
         assert False, 'must specify x_0 or (lb and ub)'
 
+    # random numbers are drawn trajectory by trajectory in the order generate_hidden_obs draws them,
+    # so the same seed gives the same data as generating each trajectory on its own, up to the tolerance of odeint.
+    # Poisson samples can't be drawn ahead, so with poisson emission only all x_0 are drawn first
+    x_0 = np.zeros((n_train + n_test, Dx))
+    g_noise = np.zeros((n_train + n_test, time, Dy)) if isinstance(g, mvn) else None
     for i in range(n_train + n_test):
-        if x_0_in is None:
-            x_0 = np.random.uniform(low=lb, high=ub, size=Dx)
-            hidden, obs = generate_hidden_obs(time, Dx, Dy, x_0, f, g)
-        else:
-            hidden, obs = generate_hidden_obs(time, Dx, Dy, x_0_in, f, g)
-        if i < n_train:
-            hidden_train[i] = hidden
-            obs_train[i] = obs
-        else:
-            hidden_test[i - n_train] = hidden
-            obs_test[i - n_train] = obs
+        x_0[i] = np.random.uniform(low=lb, high=ub, size=Dx) if x_0_in is None else x_0_in
+        if g_noise is not None:
+            g_noise[i] = np.random.randn(time, Dy)
+
+    hidden, obs = generate_hidden_obs_batch(time, Dx, Dy, x_0, f, g, g_noise)
+    hidden_train, hidden_test = hidden[:n_train], hidden[n_train:]
+    obs_train, obs_test = obs[:n_train], obs[n_train:]
 
     return hidden_train, hidden_test, obs_train, obs_test
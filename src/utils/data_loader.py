@@ -1,18 +1,28 @@
+import json
+import os
 import pickle
+import sys
+
 import numpy as np
 
+# arrays of sequences in a datadict, the others are parameters of the simulation
+sequence_keys = ["Ytrain", "Yvalid", "Ytest", "Xtrue", "Xtrain", "Xtest"]
+
 
 def load_data(path, Dx, isPython2, q_uses_true_X):
-    with open(path, "rb") as handle:
-        if isPython2:
-            data = pickle.load(handle, encoding="latin1")
-        else:
-            data = pickle.load(handle)
+    """
+    path: a pickled datadict, or a dir of .npy files written by convert_datadict, whose arrays are opened as
+        read-only memory maps, so that they are read from disk when used instead of loaded at once
+    """
+    if os.path.isdir(path):
+        data = load_npy_dir(path)
+    else:
+        data = load_datadict(path, isPython2)
 
     obs_train = data["Ytrain"]
     if "Ytest" in data and "Yvalid" in data:
         Ytest, Yvalid = data["Ytest"], data["Yvalid"]
-        obs_test = Ytest if Ytest.shape[0] > Yvalid.shape[0] else Yvalid
+        obs_test = Ytest if len(Ytest) > len(Yvalid) else Yvalid
     else:
         if "Ytest" in data:
             obs_test = data["Ytest"]
@@ -21,6 +31,11 @@ def load_data(path, Dx, isPython2, q_uses_true_X):
         else:
             raise ValueError("obs test set is not found")
 
+    # sequences of different lengths are padded with NaN to the longest one,
+    # the arrays of a dir written by convert_datadict already have the same length, so they are never copied
+    time = max(get_max_length(obs_train), get_max_length(obs_test))
+    obs_train, obs_test = pad_sequences(obs_train, time), pad_sequences(obs_test, time)
+
     if len(obs_train.shape) == 2:
         obs_train = np.expand_dims(obs_train, axis=2)
         obs_test = np.expand_dims(obs_test, axis=2)
@@ -30,11 +45,11 @@ def load_data(path, Dx, isPython2, q_uses_true_X):
     time = obs_train.shape[1]
 
     if "Xtrue" in data:
-        hidden_train = data["Xtrue"][:n_train]
-        hidden_test = data["Xtrue"][n_train:]
+        hidden_train = pad_sequences(data["Xtrue"][:n_train], time)
+        hidden_test = pad_sequences(data["Xtrue"][n_train:], time)
     elif "Xtrain" in data and "Xtest" in data:
-        hidden_train = data["Xtrain"]
-        hidden_test = data["Xtest"]
+        hidden_train = pad_sequences(data["Xtrain"], time)
+        hidden_test = pad_sequences(data["Xtest"], time)
     else:
         if q_uses_true_X:
             raise ValueError("hidden train and hidden test is not found")
@@ -43,3 +58,105 @@ def load_data(path, Dx, isPython2, q_uses_true_X):
             hidden_test = np.zeros((n_test, time, Dx))
 
     return hidden_train, hidden_test, obs_train, obs_test
+
+
+def load_datadict(path, isPython2):
+    with open(path, "rb") as handle:
+        if isPython2:
+            return pickle.load(handle, encoding="latin1")
+        else:
+            return pickle.load(handle)
+
+
+def is_variable_length(path, obs_train, obs_test):
+    """
+    Whether the sequences of obs are padded with NaN. A dir written by convert_datadict says so in attrs.json,
+    otherwise obs are scanned chunk by chunk until the first NaN, so that memory maps aren't read at once
+    """
+    attrs_path = os.path.join(path, "attrs.json")
+    if os.path.isdir(path) and os.path.exists(attrs_path):
+        with open(attrs_path, "r") as f:
+            attrs = json.load(f)
+        if "variable_length" in attrs:
+            return attrs["variable_length"]
+
+    return contains_nan(obs_train) or contains_nan(obs_test)
+
+
+def contains_nan(array, chunk_size=256):
+    # scan chunk_size trials at a time
+    for i in range(0, len(array), chunk_size):
+        if np.isnan(array[i:i + chunk_size]).any():
+            return True
+    return False
+
+
+def load_npy_dir(path):
+    # arrays of a dir written by convert_datadict, as read-only memory maps
+    return {file_name[:-len(".npy")]: np.load(os.path.join(path, file_name), mmap_mode="r")
+            for file_name in os.listdir(path) if file_name.endswith(".npy")}
+
+
+def convert_datadict(path, out_dir, isPython2=False):
+    """
+    Save each array of a pickled datadict as out_dir/<key>.npy, to be loaded by load_data as memory maps.
+    The sequences of all data sets are padded with NaN to the longest one, so that load_data can use the memory maps
+    as they are. Values that aren't arrays (parameters of the simulation) are saved in out_dir/attrs.json,
+    along with "variable_length", whether the observations are padded
+    """
+    data = load_datadict(path, isPython2)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    time = max(get_max_length(data[key]) for key in sequence_keys if key in data)
+
+    attrs = {"variable_length": False}
+    for key, value in data.items():
+        if key in sequence_keys:
+            padded = pad_sequences(value, time)
+            np.save(os.path.join(out_dir, key + ".npy"), padded)
+            if key.startswith("Y"):
+                attrs["variable_length"] = attrs["variable_length"] or bool(np.isnan(padded).any())
+        elif isinstance(value, np.ndarray) and value.dtype != object:
+            np.save(os.path.join(out_dir, key + ".npy"), value)
+        else:
+            attrs[key] = value
+
+    with open(os.path.join(out_dir, "attrs.json"), "w") as f:
+        json.dump(attrs, f, indent=4, default=lambda x: x.tolist() if hasattr(x, "tolist") else str(x))
+
+
+def get_max_length(sequences):
+    if isinstance(sequences, np.ndarray) and sequences.dtype != object:
+        return sequences.shape[1]
+    return max(len(sequence) for sequence in sequences)
+
+
+def pad_sequences(sequences, time=None, value=np.nan):
+    """
+    Stack sequences of different lengths into one array, padding them with value after their end
+    Input:
+        sequences: array of shape (n_sequences, time, ...) or list of arrays of shape (time_i, D) or (time_i,)
+        time: length to pad to, None to use the longest sequence
+    Output:
+        padded sequences of shape (n_sequences, time, D), or sequences itself if it's already an array of that length.
+        Their dtype is the one of sequences, unless it can't hold value, e.g. NaN for integers
+    """
+    if isinstance(sequences, np.ndarray) and sequences.dtype != object and sequences.shape[1] == time:
+        return sequences
+
+    sequences = [np.reshape(sequence, (len(sequence), -1)) for sequence in sequences]
+    if time is None:
+        time = max(len(sequence) for sequence in sequences)
+
+    dtype = np.result_type(*[sequence.dtype for sequence in sequences], value)
+    padded = np.full((len(sequences), time, sequences[0].shape[-1]), value, dtype=dtype)
+    for i, sequence in enumerate(sequences):
+        padded[i, :len(sequence)] = sequence
+
+    return padded
+
+
+if __name__ == "__main__":
+    # python data_loader.py path/to/datadict path/to/out_dir [isPython2]
+    convert_datadict(sys.argv[1], sys.argv[2], isPython2=len(sys.argv) > 3 and sys.argv[3] == "True")
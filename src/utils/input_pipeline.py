@@ -0,0 +1,160 @@
+import numpy as np
+import tensorflow as tf
+
+
+class input_pipeline:
+    """
+    Shuffle, batch and prefetch (obs, hidden) with tf.data, so that the training and evaluation loops
+    read minibatches inside the graph instead of slicing numpy arrays and feeding them at every step.
+    The arrays are fed only once, when the iterators are initialized, or, with from_generator, read from them
+    while iterating, so that arrays larger than memory (e.g. memory-mapped .npy files) are never loaded at once.
+
+    Each data set has its own iterator, which is selected by feeding its handle to self.handle:
+        "train_shuffled": training set, reshuffled at every epoch
+        "train", "test": training and test set in their original order, for evaluation
+    Feeding self.obs and self.hidden directly still works and bypasses the iterators.
+    """
+    def __init__(self, obs, hidden, cache=False, from_generator=False, n_prefetch=2, seed=None, name="input_pipeline"):
+        """
+        obs, hidden: placeholders of shape (batch_size, time, Dy) and (batch_size, time, Dx)
+        cache: whether to cache the training and test sets in their original order after their first pass,
+            the shuffled training set is read in a new order at each pass, so it isn't cached
+        from_generator: whether to read trials from the arrays given to initialize while iterating,
+            instead of feeding the arrays to the graph
+        n_prefetch: number of batches to prepare in the background
+        seed: seed of the orders of the shuffled training set, see get_order
+        """
+        self.batch_size = obs.shape.as_list()[0]
+        self.cache = cache
+        self.from_generator = from_generator
+        self.n_prefetch = n_prefetch
+        self.seed = np.random.randint(2 ** 31) if seed is None else seed
+        # the pass the shuffled training set starts from, set in initialize
+        self.first_pass = 0
+        self.trial_shapes = (obs.shape[1:], hidden.shape[1:])
+
+        with tf.variable_scope(name):
+            if not self.from_generator:
+                self.obs_train = tf.placeholder(tf.float32, shape=[None] + obs.shape.as_list()[1:],
+                                                name="obs_train")
+                self.hidden_train = tf.placeholder(tf.float32, shape=[None] + hidden.shape.as_list()[1:],
+                                                   name="hidden_train")
+                self.obs_test = tf.placeholder(tf.float32, shape=[None] + obs.shape.as_list()[1:], name="obs_test")
+                self.hidden_test = tf.placeholder(tf.float32, shape=[None] + hidden.shape.as_list()[1:],
+                                                  name="hidden_test")
+
+            datasets = {"train_shuffled": self.make_dataset("train", shuffle=True),
+                        "train":          self.make_dataset("train", shuffle=False),
+                        "test":           self.make_dataset("test", shuffle=False)}
+            self.iterators = {key: dataset.make_initializable_iterator() for key, dataset in datasets.items()}
+
+            self.handle = tf.placeholder(tf.string, shape=[], name="handle")
+            iterator = tf.data.Iterator.from_string_handle(self.handle,
+                                                           datasets["train"].output_types,
+                                                           datasets["train"].output_shapes)
+            next_obs, next_hidden = iterator.get_next()
+
+            self.obs = tf.placeholder_with_default(next_obs, obs.shape, name="obs")
+            self.hidden = tf.placeholder_with_default(next_hidden, hidden.shape, name="hidden")
+
+    def make_dataset(self, key, shuffle):
+        # batches never cross the end of the data set, so every pass of n_batches steps covers each trial once
+        if shuffle:
+            return self.make_shuffled_dataset(key)
+
+        if self.from_generator:
+            dataset = tf.data.Dataset.from_generator(lambda: self.generate_trials(key),
+                                                     (tf.float32, tf.float32),
+                                                     self.trial_shapes)
+        else:
+            obs, hidden = (self.obs_train, self.hidden_train) if key == "train" else (self.obs_test, self.hidden_test)
+            dataset = tf.data.Dataset.from_tensor_slices((obs, hidden))
+
+        if self.cache:
+            dataset = dataset.cache()
+        dataset = dataset.batch(self.batch_size, drop_remainder=True).repeat()
+        return dataset.prefetch(self.n_prefetch)
+
+    def make_shuffled_dataset(self, key):
+        # batches of data set key in the orders of get_order, pass after pass, so no shuffle buffer holds trials
+        if self.from_generator:
+            batch_shapes = tuple(tf.TensorShape([self.batch_size]).concatenate(shape) for shape in self.trial_shapes)
+            dataset = tf.data.Dataset.from_generator(lambda: self.generate_batches(key),
+                                                     (tf.float32, tf.float32),
+                                                     batch_shapes)
+        else:
+            obs, hidden = (self.obs_train, self.hidden_train) if key == "train" else (self.obs_test, self.hidden_test)
+            dataset = tf.data.Dataset.from_generator(lambda: self.generate_batch_idxs(key),
+                                                     tf.int64,
+                                                     tf.TensorShape([self.batch_size]))
+            dataset = dataset.map(lambda batch_idx: (tf.gather(obs, batch_idx), tf.gather(hidden, batch_idx)))
+
+        return dataset.prefetch(self.n_prefetch)
+
+    def get_order(self, n_trials, i_pass):
+        """
+        Order of the trials in pass i_pass over the shuffled training set. It comes from a random state seeded by
+        (self.seed, i_pass) rather than the global one, which tf.data would draw from in a background thread
+        in between the draws of the training loop, so the orders are reproducible, and training resumed
+        after n passes continues with the order of pass n
+        """
+        return np.random.RandomState([self.seed, i_pass]).permutation(n_trials)
+
+    def generate_batch_idxs(self, key):
+        # indices of the batches of data set key, in a new order at each pass, starting from pass self.first_pass
+        n_trials = self.n_trials[key]
+        n_batches = n_trials // self.batch_size
+
+        i_pass = self.first_pass
+        while True:
+            order = self.get_order(n_trials, i_pass)
+            for batch_idx in order[:n_batches * self.batch_size].reshape((n_batches, self.batch_size)):
+                yield batch_idx
+            i_pass += 1
+
+    def generate_batches(self, key):
+        obs, hidden = self.data[key]
+        for batch_idx in self.generate_batch_idxs(key):
+            yield obs[batch_idx], hidden[batch_idx]
+
+    def generate_trials(self, key):
+        # one pass over the trials of data set key in their original order
+        obs, hidden = self.data[key]
+        for i in range(len(obs)):
+            yield obs[i], hidden[i]
+
+    def initialize(self, sess, obs_train, hidden_train, obs_test, hidden_test, first_pass=0):
+        # first_pass: the pass the shuffled training set starts from, e.g. the number of epochs done when resuming
+        self.first_pass = first_pass
+        self.n_trials = {"train": len(obs_train),
+                         "test":  len(obs_test)}
+
+        if self.from_generator:
+            self.data = {"train": (obs_train, hidden_train),
+                         "test":  (obs_test, hidden_test)}
+            sess.run([iterator.initializer for iterator in self.iterators.values()])
+        else:
+            if any(isinstance(array, np.memmap) for array in [obs_train, hidden_train, obs_test, hidden_test]):
+                print("warning: memory-mapped data is fed to the input pipeline at once, "
+                      "use from_generator (stream_input_data) to read it batch by batch")
+            sess.run([iterator.initializer for iterator in self.iterators.values()],
+                     feed_dict={self.obs_train:    obs_train,
+                                self.hidden_train: hidden_train,
+                                self.obs_test:     obs_test,
+                                self.hidden_test:  hidden_test})
+
+        self.handles = sess.run({key: iterator.string_handle() for key, iterator in self.iterators.items()})
+        self.n_batches = {"train_shuffled": len(obs_train) // self.batch_size,
+                          "train":          len(obs_train) // self.batch_size,
+                          "test":           len(obs_test) // self.batch_size}
+
+    def get_feed_dict(self, key, feed_dict={}):
+        # feed_dict that reads the next batch of data set key
+        feed_dict = dict(feed_dict)
+        feed_dict[self.handle] = self.handles[key]
+        return feed_dict
+
+    def run_batches(self, sess, fetches, key):
+        # evaluate fetches on each batch of one pass over data set key, yielding the values batch by batch
+        for _ in range(self.n_batches[key]):
+            yield sess.run(fetches, feed_dict=self.get_feed_dict(key))
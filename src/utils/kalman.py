@@ -0,0 +1,173 @@
+import numpy as np
+
+
+class linear_gaussian_ssm:
+    """
+    Linear-Gaussian state space model
+        x_0 ~ N(mu0, Sigma0),  x_t = A x_t-1 + w_t, w_t ~ N(0, Q)
+        y_t = C x_t + v_t, v_t ~ N(0, R)
+    with exact filtering, smoothing, log-likelihood and EM, vectorized over trials.
+    obs is of shape (n_trials, time, Dy). Time steps where obs has NaN are treated as missing,
+    so NaN-padded sequences of different lengths can be batched together.
+    """
+    def __init__(self, A, C, Q, R, mu0=None, Sigma0=None):
+        self.A, self.C, self.Q, self.R = A, C, Q, R
+        self.Dx, self.Dy = A.shape[0], C.shape[0]
+        self.mu0 = np.zeros(self.Dx) if mu0 is None else mu0
+        self.Sigma0 = np.eye(self.Dx) if Sigma0 is None else Sigma0
+
+    @classmethod
+    def from_obs(cls, obs, Dx):
+        """
+        Initial parameters for EM: C spans the top Dx principal directions of obs (padded with small random columns
+        when Dx > Dy), R is the variance of obs, and A, Q are close to a random walk
+        """
+        Dy = obs.shape[-1]
+        Y = obs.reshape((-1, Dy))
+        Y = Y[~np.isnan(Y).any(axis=1)]
+        Y_centered = Y - Y.mean(axis=0)
+
+        _, s, Vt = np.linalg.svd(Y_centered, full_matrices=False)
+        C = 0.1 * np.random.randn(Dy, Dx)
+        n_components = min(Dx, Dy)
+        C[:, :n_components] = Vt[:n_components].T * s[:n_components] / np.sqrt(len(Y))
+
+        A = 0.9 * np.eye(Dx)
+        Q = 0.1 * np.eye(Dx)
+        R = np.diag(np.var(Y, axis=0) + 1e-6)
+        return cls(A, C, Q, R)
+
+    def sample(self, n_trials, time):
+        hidden = np.zeros((n_trials, time, self.Dx))
+        hidden[:, 0] = np.random.multivariate_normal(self.mu0, self.Sigma0, size=n_trials)
+        for t in range(1, time):
+            hidden[:, t] = hidden[:, t - 1] @ self.A.T + \
+                np.random.multivariate_normal(np.zeros(self.Dx), self.Q, size=n_trials)
+        obs = hidden @ self.C.T + np.random.multivariate_normal(np.zeros(self.Dy), self.R, size=(n_trials, time))
+        return hidden, obs
+
+    def filter(self, obs):
+        """
+        Output:
+            dict of
+            "log_likelihood": log p(y_0:T-1) of each trial, shape (n_trials,)
+            "filtered_mean", "filtered_cov": of p(x_t | y_0:t), shape (n_trials, time, Dx), (n_trials, time, Dx, Dx)
+            "predicted_mean", "predicted_cov": of p(x_t | y_0:t-1), same shapes
+        """
+        n_trials, time, Dy = obs.shape
+        Dx = self.Dx
+        observed = ~np.isnan(obs).any(axis=-1)  # (n_trials, time)
+        obs = np.where(observed[..., None], obs, 0.0)
+
+        predicted_mean = np.zeros((n_trials, time, Dx))
+        predicted_cov = np.zeros((n_trials, time, Dx, Dx))
+        filtered_mean = np.zeros((n_trials, time, Dx))
+        filtered_cov = np.zeros((n_trials, time, Dx, Dx))
+        log_likelihood = np.zeros(n_trials)
+
+        mean = np.tile(self.mu0, (n_trials, 1))
+        cov = np.tile(self.Sigma0, (n_trials, 1, 1))
+        for t in range(time):
+            if t > 0:
+                mean = mean @ self.A.T
+                cov = self.A @ cov @ self.A.T + self.Q
+            predicted_mean[:, t], predicted_cov[:, t] = mean, cov
+
+            # innovation and its covariance S, shape (n_trials, Dy) and (n_trials, Dy, Dy)
+            innovation = obs[:, t] - mean @ self.C.T
+            S = self.C @ cov @ self.C.T + self.R
+            S_chol = np.linalg.cholesky(S)
+            whitened = np.linalg.solve(S_chol, innovation[..., None])[..., 0]
+            log_det_S = 2 * np.sum(np.log(np.diagonal(S_chol, axis1=-2, axis2=-1)), axis=-1)
+            log_likelihood += observed[:, t] * \
+                -0.5 * (np.sum(whitened ** 2, axis=-1) + log_det_S + Dy * np.log(2 * np.pi))
+
+            # Kalman gain K = cov C^T S^-1, shape (n_trials, Dx, Dy), zeroed where y_t is missing
+            K = np.swapaxes(np.linalg.solve(S, self.C @ cov), -1, -2)
+            K = K * observed[:, t, None, None]
+            mean = mean + (K @ innovation[..., None])[..., 0]
+            cov = cov - K @ self.C @ cov
+            cov = (cov + np.swapaxes(cov, -1, -2)) / 2
+            filtered_mean[:, t], filtered_cov[:, t] = mean, cov
+
+        return {"log_likelihood": log_likelihood,
+                "filtered_mean":  filtered_mean,
+                "filtered_cov":   filtered_cov,
+                "predicted_mean": predicted_mean,
+                "predicted_cov":  predicted_cov}
+
+    def log_likelihood(self, obs):
+        return self.filter(obs)["log_likelihood"]
+
+    def smooth(self, obs):
+        """
+        Rauch-Tung-Striebel smoother
+        Output:
+            the dict of self.filter, and
+            "smoothed_mean", "smoothed_cov": of p(x_t | y_0:T-1), shape (n_trials, time, Dx), (n_trials, time, Dx, Dx)
+            "smoothed_cross_cov": Cov(x_t+1, x_t | y_0:T-1), shape (n_trials, time - 1, Dx, Dx)
+        """
+        rslts = self.filter(obs)
+        filtered_mean, filtered_cov = rslts["filtered_mean"], rslts["filtered_cov"]
+        predicted_mean, predicted_cov = rslts["predicted_mean"], rslts["predicted_cov"]
+        n_trials, time, Dx = filtered_mean.shape
+
+        smoothed_mean = np.zeros_like(filtered_mean)
+        smoothed_cov = np.zeros_like(filtered_cov)
+        smoothed_cross_cov = np.zeros((n_trials, time - 1, Dx, Dx))
+
+        smoothed_mean[:, -1], smoothed_cov[:, -1] = filtered_mean[:, -1], filtered_cov[:, -1]
+        for t in reversed(range(time - 1)):
+            # smoother gain J = filtered_cov_t A^T predicted_cov_t+1^-1
+            J = np.swapaxes(np.linalg.solve(predicted_cov[:, t + 1], self.A @ filtered_cov[:, t]), -1, -2)
+            smoothed_mean[:, t] = filtered_mean[:, t] + \
+                (J @ (smoothed_mean[:, t + 1] - predicted_mean[:, t + 1])[..., None])[..., 0]
+            cov = filtered_cov[:, t] + J @ (smoothed_cov[:, t + 1] - predicted_cov[:, t + 1]) @ np.swapaxes(J, -1, -2)
+            smoothed_cov[:, t] = (cov + np.swapaxes(cov, -1, -2)) / 2
+            smoothed_cross_cov[:, t] = smoothed_cov[:, t + 1] @ np.swapaxes(J, -1, -2)
+
+        rslts.update({"smoothed_mean":      smoothed_mean,
+                      "smoothed_cov":       smoothed_cov,
+                      "smoothed_cross_cov": smoothed_cross_cov})
+        return rslts
+
+    def em(self, obs, n_iter=10, verbose=False):
+        """
+        Fit all parameters to all trials of obs at once with EM
+        Output:
+            log-likelihood summed over trials before each M step, shape (n_iter,)
+        """
+        n_trials, time, _ = obs.shape
+        observed = ~np.isnan(obs).any(axis=-1)  # (n_trials, time)
+        mask = observed[..., None, None].astype(float)
+        obs_filled = np.where(observed[..., None], obs, 0.0)
+
+        log_likelihoods = []
+        for i in range(n_iter):
+            # E step
+            rslts = self.smooth(obs)
+            log_likelihoods.append(np.sum(rslts["log_likelihood"]))
+            if verbose:
+                print("EM iter {:<4} log-likelihood: {:.3f}".format(i + 1, log_likelihoods[-1]))
+
+            mean, cov, cross_cov = rslts["smoothed_mean"], rslts["smoothed_cov"], rslts["smoothed_cross_cov"]
+            E_xx = cov + mean[..., :, None] * mean[..., None, :]  # E[x_t x_t^T]
+            E_x1x0 = cross_cov + mean[:, 1:, :, None] * mean[:, :-1, None, :]  # E[x_t+1 x_t^T]
+
+            # M step
+            self.A = np.linalg.solve(np.sum(E_xx[:, :-1], axis=(0, 1)), np.sum(E_x1x0, axis=(0, 1)).T).T
+            Q = np.sum(E_xx[:, 1:], axis=(0, 1)) - self.A @ np.sum(E_x1x0, axis=(0, 1)).T
+            Q = Q / (n_trials * (time - 1))
+            self.Q = (Q + Q.T) / 2
+
+            yx = np.sum(mask * obs_filled[..., :, None] * mean[..., None, :], axis=(0, 1))
+            self.C = np.linalg.solve(np.sum(mask * E_xx, axis=(0, 1)), yx.T).T
+            yy = np.sum(mask * obs_filled[..., :, None] * obs_filled[..., None, :], axis=(0, 1))
+            R = (yy - self.C @ yx.T) / np.sum(observed)
+            self.R = (R + R.T) / 2
+
+            self.mu0 = np.mean(mean[:, 0], axis=0)
+            diff = mean[:, 0] - self.mu0
+            self.Sigma0 = np.mean(cov[:, 0] + diff[:, :, None] * diff[:, None, :], axis=0)
+
+        return np.array(log_likelihoods)
@@ -0,0 +1,109 @@
+import json
+import re
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+
+class graph_build_profiler:
+    """
+    Record the wall time of each phase of building and initializing the model,
+    and the number of ops each phase adds to the default graph
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        graph = tf.get_default_graph()
+        n_ops = len(graph.get_operations())
+        start = time.time()
+
+        yield
+
+        self.phases.append({"phase":   name,
+                            "seconds": time.time() - start,
+                            "n_ops":   len(graph.get_operations()) - n_ops})
+
+    def get_report(self):
+        return {"phases":        self.phases,
+                "total_seconds": sum([phase["seconds"] for phase in self.phases]),
+                "total_n_ops":   len(tf.get_default_graph().get_operations())}
+
+    def print_report(self):
+        if not self.enabled:
+            return
+        print("graph building:")
+        for phase in self.phases:
+            print("\t{:<24} {:>8.3f} seconds {:>8} ops".format(phase["phase"], phase["seconds"], phase["n_ops"]))
+
+    def save(self, path):
+        if not self.enabled:
+            return
+        with open(path, "w") as f:
+            json.dump(self.get_report(), f, indent=4)
+
+
+def get_trace_scope(node_name):
+    """
+    Scope to attribute an op to: the scope right inside the outermost while loop the op is in,
+    e.g. log_ZSMC/while/resample for the resampling of the forward SMC loop,
+    or the first two levels of node_name for ops outside while loops
+    """
+    scopes = node_name.split(":")[0].split("/")
+    for i, scope in enumerate(scopes):
+        if re.match(r"while(_\d+)?$", scope):
+            return "/".join(scopes[:i + 2])
+    return "/".join(scopes[:2])
+
+
+def summarize_trace(run_metadata):
+    """
+    Aggregate op time of a FULL_TRACE run by scope (see get_trace_scope)
+    Output:
+        list of {"scope", "milliseconds", "n_ops"} sorted by decreasing time, where n_ops counts op executions,
+        so ops in while loops count once per step
+    """
+    milliseconds = defaultdict(float)
+    n_ops = defaultdict(int)
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        # on GPU, kernels are recorded again in stream devices
+        if "/stream:" in dev_stats.device or "/memcpy" in dev_stats.device:
+            continue
+        for node_stats in dev_stats.node_stats:
+            scope = get_trace_scope(node_stats.node_name)
+            milliseconds[scope] += node_stats.all_end_rel_micros / 1000
+            n_ops[scope] += 1
+
+    summary = [{"scope": scope, "milliseconds": milliseconds[scope], "n_ops": n_ops[scope]} for scope in milliseconds]
+    return sorted(summary, key=lambda x: -x["milliseconds"])
+
+
+def print_trace_summary(summary):
+    # ops may run in parallel, so percentages are of the total op time rather than of wall time
+    total = sum([x["milliseconds"] for x in summary])
+    print("{:<64}{:>12}{:>8}{:>10}".format("scope", "time (ms)", "%", "n_ops"))
+    for x in summary:
+        print("{:<64}{:>12.3f}{:>8.1f}{:>10}"
+              .format(x["scope"], x["milliseconds"], 100 * x["milliseconds"] / total, x["n_ops"]))
+
+
+def save_trace(run_metadata, path_prefix):
+    """
+    Save the chrome trace (open in chrome://tracing) of a FULL_TRACE run in path_prefix + ".json",
+    and its summary by scope in path_prefix + "_summary.json"
+    """
+    trace = timeline.Timeline(run_metadata.step_stats)
+    with open(path_prefix + ".json", "w") as f:
+        f.write(trace.generate_chrome_trace_format())
+
+    with open(path_prefix + "_summary.json", "w") as f:
+        json.dump(summarize_trace(run_metadata), f, indent=4)
@@ -0,0 +1,34 @@
+import numpy as np
+
+from utils.R_square import R_square_accumulator
+
+
+def batch_R_square(y_hat, y):
+    # R^2 of the whole data set at once, as computed before R_square_accumulator
+    R_square = np.zeros(len(y))
+    for k, (y_hat_k, y_k) in enumerate(zip(y_hat, y)):
+        MSE = np.nansum((y_hat_k - y_k) ** 2)
+        y_k_mean = np.nanmean(y_k, axis=0, keepdims=True)
+        y_k_var = np.nansum((y_k - y_k_mean) ** 2)
+        R_square[k] = 1 - MSE / y_k_var
+    return R_square
+
+
+def test_R_square_accumulator():
+    n_trials, time, Dy, n_steps = 23, 10, 3, 4
+    y_full = np.random.randn(n_trials, time, Dy) + np.arange(time)[:, None]
+
+    # NaN padding of sequences of different lengths, at least n_steps + 2 steps long
+    lengths = np.random.randint(n_steps + 2, time + 1, size=n_trials)
+    y_full[np.arange(time) >= lengths[:, None]] = np.nan
+
+    y = [y_full[:, k:] for k in range(n_steps + 1)]
+    y_hat = [y_k + 0.5 * np.random.randn(*y_k.shape) for y_k in y]
+
+    # batches of different sizes, the last one smaller
+    accumulator = R_square_accumulator()
+    for start in range(0, n_trials, 5):
+        accumulator.update([y_hat_k[start:start + 5] for y_hat_k in y_hat],
+                           [y_k[start:start + 5] for y_k in y])
+
+    np.testing.assert_allclose(accumulator.R_square(), batch_R_square(y_hat, y), rtol=1e-10)
@@ -0,0 +1,71 @@
+import json
+import os
+import pickle
+
+import numpy as np
+
+from utils.data_loader import convert_datadict, get_max_length, is_variable_length, load_data, pad_sequences
+
+
+def test_get_max_length():
+    assert get_max_length(np.zeros((4, 7, 2))) == 7
+    assert get_max_length([np.zeros((3, 2)), np.zeros((5, 2)), np.zeros((1, 2))]) == 5
+
+    # ragged sequences loaded as an object array
+    ragged = np.empty(2, dtype=object)
+    ragged[0], ragged[1] = np.zeros((2, 1)), np.zeros((6, 1))
+    assert get_max_length(ragged) == 6
+
+
+def test_pad_sequences():
+    sequences = [np.arange(6.0).reshape((3, 2)), np.arange(2.0).reshape((1, 2))]
+
+    padded = pad_sequences(sequences)
+    assert padded.shape == (2, 3, 2)
+    np.testing.assert_array_equal(padded[0], sequences[0])
+    np.testing.assert_array_equal(padded[1, :1], sequences[1])
+    assert np.isnan(padded[1, 1:]).all()
+
+    # to a given length, with a given value
+    padded = pad_sequences(sequences, time=5, value=0.0)
+    assert padded.shape == (2, 5, 2)
+    assert (padded[0, 3:] == 0).all() and (padded[1, 1:] == 0).all()
+
+    # the dtype of the sequences is kept
+    assert pad_sequences([sequence.astype(np.float32) for sequence in sequences]).dtype == np.float32
+
+    # sequences of scalars get a trailing axis
+    padded = pad_sequences([np.array([1.0, 2.0]), np.array([3.0])])
+    assert padded.shape == (2, 2, 1)
+    np.testing.assert_array_equal(padded[:, 0, 0], [1.0, 3.0])
+    assert np.isnan(padded[1, 1, 0])
+
+    # an array already of the right length is returned as is
+    array = np.random.randn(3, 4, 2)
+    assert pad_sequences(array, time=4) is array
+    np.testing.assert_array_equal(pad_sequences(array), array)
+
+
+def test_convert_datadict(tmp_path):
+    # training and test sets with different longest sequences
+    datadict = {"Ytrain": [np.random.randn(time, 2).astype(np.float32) for time in [5, 9, 7]],
+                "Ytest":  [np.random.randn(time, 2).astype(np.float32) for time in [4, 6]]}
+    with open(os.path.join(str(tmp_path), "datadict.p"), "wb") as f:
+        pickle.dump(datadict, f)
+
+    out_dir = os.path.join(str(tmp_path), "npy")
+    convert_datadict(os.path.join(str(tmp_path), "datadict.p"), out_dir)
+    with open(os.path.join(out_dir, "attrs.json"), "r") as f:
+        assert json.load(f)["variable_length"]
+
+    # all data sets have the same length, so load_data uses the memory maps without copying them
+    _, _, obs_train, obs_test = load_data(out_dir, 2, False, False)
+    assert isinstance(obs_train, np.memmap) and isinstance(obs_test, np.memmap)
+    assert obs_train.shape == (3, 9, 2) and obs_test.shape == (2, 9, 2) and obs_train.dtype == np.float32
+    np.testing.assert_array_equal(obs_test[1, :6], datadict["Ytest"][1])
+    assert is_variable_length(out_dir, obs_train, obs_test)
+
+    # without attrs.json, obs are scanned for NaN
+    os.remove(os.path.join(out_dir, "attrs.json"))
+    assert is_variable_length(out_dir, obs_train, obs_test)
+    assert not is_variable_length(out_dir, obs_train[:, :4], obs_test[:, :4])
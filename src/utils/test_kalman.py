@@ -0,0 +1,92 @@
+import numpy as np
+
+from utils.kalman import linear_gaussian_ssm
+
+Dx, Dy, time = 2, 3, 6
+
+
+def random_ssm():
+    A = np.array([[0.9, 0.2], [-0.1, 0.8]])
+    C = np.random.randn(Dy, Dx)
+    Q = np.diag([0.3, 0.2])
+    R = 0.5 * np.eye(Dy) + 0.1
+    return linear_gaussian_ssm(A, C, Q, R, mu0=np.array([1.0, -1.0]), Sigma0=np.diag([0.5, 2.0]))
+
+
+def joint_gaussian(ssm):
+    # mean and covariance of (x_0, ..., x_T-1, y_0, ..., y_T-1), flattened, in closed form
+    x_mean = [ssm.mu0]
+    x_cov = [ssm.Sigma0]
+    for t in range(1, time):
+        x_mean.append(ssm.A @ x_mean[-1])
+        x_cov.append(ssm.A @ x_cov[-1] @ ssm.A.T + ssm.Q)
+
+    # Cov(x_s, x_t) = A^(s - t) Cov(x_t) for s >= t
+    xx = np.zeros((time, Dx, time, Dx))
+    for t in range(time):
+        for s in range(t, time):
+            xx[s, :, t] = np.linalg.matrix_power(ssm.A, s - t) @ x_cov[t]
+            xx[t, :, s] = xx[s, :, t].T
+    xx = xx.reshape((time * Dx, time * Dx))
+
+    C_blocks = np.kron(np.eye(time), ssm.C)
+    mean = np.concatenate([np.concatenate(x_mean), C_blocks @ np.concatenate(x_mean)])
+    cov = np.block([[xx,                xx @ C_blocks.T],
+                    [C_blocks @ xx,     C_blocks @ xx @ C_blocks.T + np.kron(np.eye(time), ssm.R)]])
+    return mean, cov
+
+
+def condition(mean, cov, y, observed_steps):
+    # log p(y of observed_steps), and the mean and covariance of all x given them
+    y_idx = np.concatenate([time * Dx + t * Dy + np.arange(Dy) for t in observed_steps])
+    x_idx = np.arange(time * Dx)
+    y_observed = np.concatenate([y[t] for t in observed_steps])
+
+    S = cov[np.ix_(y_idx, y_idx)]
+    residual = y_observed - mean[y_idx]
+    log_likelihood = -0.5 * (residual @ np.linalg.solve(S, residual) + np.linalg.slogdet(S)[1]
+                             + len(y_idx) * np.log(2 * np.pi))
+
+    gain = np.linalg.solve(S, cov[np.ix_(y_idx, x_idx)]).T
+    x_mean = mean[x_idx] + gain @ residual
+    x_cov = cov[np.ix_(x_idx, x_idx)] - gain @ cov[np.ix_(y_idx, x_idx)]
+    return log_likelihood, x_mean.reshape((time, Dx)), x_cov.reshape((time, Dx, time, Dx))
+
+
+def test_filter_and_smoother_match_closed_form():
+    ssm = random_ssm()
+    _, obs = ssm.sample(2, time)
+    # the second trial is shorter, padded with NaN, and misses a step in the middle
+    obs[1, 4:] = np.nan
+    obs[1, 2] = np.nan
+    observed_steps = [list(range(time)), [0, 1, 3]]
+
+    rslts = ssm.smooth(obs)
+    mean, cov = joint_gaussian(ssm)
+    for i in range(2):
+        log_likelihood, smoothed_mean, smoothed_cov = condition(mean, cov, obs[i], observed_steps[i])
+        np.testing.assert_allclose(rslts["log_likelihood"][i], log_likelihood, rtol=1e-8)
+        np.testing.assert_allclose(rslts["smoothed_mean"][i], smoothed_mean, atol=1e-8)
+        for t in range(time):
+            np.testing.assert_allclose(rslts["smoothed_cov"][i, t], smoothed_cov[t, :, t], atol=1e-8)
+        for t in range(time - 1):
+            np.testing.assert_allclose(rslts["smoothed_cross_cov"][i, t], smoothed_cov[t + 1, :, t], atol=1e-8)
+
+        # filtering at t conditions on the observed steps up to t
+        for t in range(time):
+            _, filtered_mean, filtered_cov = condition(mean, cov, obs[i], [s for s in observed_steps[i] if s <= t])
+            np.testing.assert_allclose(rslts["filtered_mean"][i, t], filtered_mean[t], atol=1e-8)
+            np.testing.assert_allclose(rslts["filtered_cov"][i, t], filtered_cov[t, :, t], atol=1e-8)
+
+
+def test_em_increases_log_likelihood():
+    _, obs = random_ssm().sample(20, time)
+    obs[:5, 4:] = np.nan
+
+    ssm = linear_gaussian_ssm.from_obs(obs, Dx)
+    initial_log_likelihood = np.sum(ssm.log_likelihood(obs))
+    log_likelihoods = ssm.em(obs, n_iter=20)
+
+    assert log_likelihoods[0] == initial_log_likelihood
+    assert np.all(np.diff(log_likelihoods) > -1e-6)
+    assert np.sum(ssm.log_likelihood(obs)) >= log_likelihoods[-1]